@@ -7,20 +7,79 @@ except ImportError as e:
     raise
 
 import argparse
+import hashlib
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
 
 ACCOUNTS_FILE = 'accounts.yml'
 
+# Successfully verified credentials are remembered for a while to avoid running bcrypt on every request
+VERIFIED_CREDENTIALS_CACHE_SIZE = 1024
+VERIFIED_CREDENTIALS_CACHE_TTL = 300
+
+# Eve deep copies the auth instance in its resources settings, the lock cannot be an instance attribute
+_verified_credentials_lock = threading.Lock()
+
+
 class BCryptAuth(BasicAuth):
     _accounts = { 'api': '$2a$12$HHKaH4pKaz1iiv2lmqQXmuF1./zWsFIDphpU9JXOFHRrBIkhbF.si' }
 
     def __init__(self):
+        # Passwords are never kept in memory, only their HMAC with a key unique to this process
+        self._cache_key = os.urandom(32)
+        self._verified_credentials = OrderedDict()
+        self._accounts_mtime = get_accounts_mtime()
         read_accounts(self._accounts)
 
-    def check_auth(self, username, password, allowed_roles, resource, method):
-        stored_password = self._accounts.get(username, None)
+    def _reload_accounts_if_changed(self):
+        accounts_mtime = get_accounts_mtime()
+        if accounts_mtime != self._accounts_mtime:
+            self._accounts_mtime = accounts_mtime
+            read_accounts(self._accounts)
+            self._verified_credentials.clear()
+
+    def _get_credentials_digest(self, username, password):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.new(self._cache_key, password, hashlib.sha256).digest()
 
-        return stored_password and bcrypt.hashpw(password, stored_password) == stored_password
+    def check_auth(self, username, password, allowed_roles, resource, method):
+        with _verified_credentials_lock:
+            self._reload_accounts_if_changed()
+            stored_password = self._accounts.get(username, None)
+            if not stored_password:
+                return False
+
+            digest = self._get_credentials_digest(username, password)
+            verified = self._verified_credentials.get(username, None)
+            if verified:
+                verified_digest, verified_stored_password, expiration = verified
+                if (expiration > time.time() and verified_stored_password == stored_password and
+                        hmac.compare_digest(verified_digest, digest)):
+                    # Keep the most recently used credentials at the end of the LRU cache
+                    del self._verified_credentials[username]
+                    self._verified_credentials[username] = verified
+                    return True
+
+        if bcrypt.hashpw(password, stored_password) != stored_password:
+            return False
+
+        with _verified_credentials_lock:
+            self._verified_credentials.pop(username, None)
+            self._verified_credentials[username] = (digest, stored_password, time.time() + VERIFIED_CREDENTIALS_CACHE_TTL)
+            while len(self._verified_credentials) > VERIFIED_CREDENTIALS_CACHE_SIZE:
+                self._verified_credentials.popitem(last=False)
+        return True
+
+
+def get_accounts_mtime():
+    try:
+        return os.stat(ACCOUNTS_FILE).st_mtime
+    except OSError:
+        return None
 
 
 def read_accounts(accounts):
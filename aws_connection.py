@@ -3,18 +3,59 @@ import boto
 import boto.s3
 import boto.s3.connection
 import boto3
+import calendar
 import os
+import threading
+import time
 from boto import vpc, iam
 from boto.ec2 import autoscale
 from boto.sts import STSConnection
+from boto.utils import parse_ts
 from boto3.session import Session
 from cloud_connection import ACloudConnection
 
 from ghost_log import log
+from ghost_metrics import count_boto3_throttling
 from ghost_tools import config
+from libs.tracing import trace_boto2_connection, trace_boto3_client
 
 os.environ["BOTO_USE_ENDPOINT_HEURISTICS"] = "True"
 
+# Assumed role credentials are renewed this many seconds before their expiration
+ASSUMED_ROLE_CREDENTIALS_REFRESH_MARGIN = 300
+
+# Process-wide caches shared by every AWSConnection instance:
+# * assumed role credentials, keyed by (role ARN, STS region)
+# * boto3 connections, keyed by (boto version, services, region, role ARN)
+# boto2 connections are not thread-safe and are cached per thread, so that they are released with their thread.
+# The lock only guards the caches: STS calls and connections creations are made outside of it.
+_cache_lock = threading.RLock()
+_cache_pid = None
+_credentials_cache = {}
+_connections_cache = {}
+_thread_caches = threading.local()
+
+
+def _get_caches():
+    """
+    Returns the process-wide credentials and connections caches, and the boto2 connections cache of the thread.
+    Caches are reset after a fork as boto connections must not be shared between processes.
+    """
+    global _cache_pid
+    with _cache_lock:
+        if _cache_pid != os.getpid():
+            _credentials_cache.clear()
+            _connections_cache.clear()
+            _cache_pid = os.getpid()
+    if getattr(_thread_caches, 'pid', None) != os.getpid():
+        _thread_caches.connections = {}
+        _thread_caches.pid = os.getpid()
+    return _credentials_cache, _connections_cache, _thread_caches.connections
+
+
+def _are_credentials_valid(credentials):
+    return credentials and credentials['expiration'] - ASSUMED_ROLE_CREDENTIALS_REFRESH_MARGIN > time.time()
+
 
 class AWSConnection(ACloudConnection):
 
@@ -47,23 +88,47 @@ class AWSConnection(ACloudConnection):
                 return(getattr(boto_obj, attributes[0]))
             return(self._get_boto_service(getattr(boto_obj, attributes[0]), attributes[1:]))
 
+    def _assume_role(self):
+        """
+        Calls STS to assume the configured role and returns the temporary credentials with their expiration timestamp
+        """
+        if self._parameters.get('assumed_region_name', None):
+            sts_connection = boto.sts.connect_to_region(self._parameters['assumed_region_name'])
+        else:
+            sts_connection = STSConnection()
+        assumed_role_object = sts_connection.assume_role(
+                role_arn=self._role_arn,
+                role_session_name=self._role_session
+        )
+        return {
+            'access_key': assumed_role_object.credentials.access_key,
+            'secret_key': assumed_role_object.credentials.secret_key,
+            'session_token': assumed_role_object.credentials.session_token,
+            'expiration': calendar.timegm(parse_ts(assumed_role_object.credentials.expiration).timetuple()),
+        }
+
     def check_credentials(self):
         result = False
         if not self._role_arn:
             result = True
         else:
             try:
-                if self._parameters.get('assumed_region_name', None):
-                    sts_connection = boto.sts.connect_to_region(self._parameters['assumed_region_name'])
-                else:
-                    sts_connection = STSConnection()
-                assumed_role_object = sts_connection.assume_role(
-                        role_arn=self._role_arn,
-                        role_session_name=self._role_session
-                )
-                self._parameters['access_key'] = assumed_role_object.credentials.access_key
-                self._parameters['secret_key'] = assumed_role_object.credentials.secret_key
-                self._parameters['session_token'] = assumed_role_object.credentials.session_token
+                credentials_cache, _, _ = _get_caches()
+                cache_key = (self._role_arn, self._parameters.get('assumed_region_name', None))
+                with _cache_lock:
+                    credentials = credentials_cache.get(cache_key)
+                if not _are_credentials_valid(credentials):
+                    credentials = self._assume_role()
+                    with _cache_lock:
+                        # Keep the credentials renewed by another thread meanwhile, if any
+                        cached_credentials = credentials_cache.get(cache_key)
+                        if _are_credentials_valid(cached_credentials):
+                            credentials = cached_credentials
+                        else:
+                            credentials_cache[cache_key] = credentials
+                self._parameters['access_key'] = credentials['access_key']
+                self._parameters['secret_key'] = credentials['secret_key']
+                self._parameters['session_token'] = credentials['session_token']
                 result = True
             except:
                 if self._log_file:
@@ -90,40 +155,76 @@ class AWSConnection(ACloudConnection):
                 raise
         return(credentials)
 
-    def get_connection(self, region, services, boto_version='boto2'):
+    def _create_connection(self, region, services, boto_version):
         connection = None
-        try:
-            if boto_version == 'boto2':
-                aws_service = self._get_boto_service(boto, services)
-
-                kwargs = {}
-                if aws_service == boto.s3:
-                    # Use base S3 endpoint to support buckets with dots in their names
-                    kwargs['calling_format'] = boto.s3.connection.OrdinaryCallingFormat()
-
-                if not self._role_arn:
-                    connection = aws_service.connect_to_region(region, **kwargs)
-                elif self.check_credentials():
-                    connection = aws_service.connect_to_region(
-                            region,
-                            aws_access_key_id=self._parameters['access_key'],
-                            aws_secret_access_key=self._parameters['secret_key'],
-                            security_token=self._parameters['session_token'],
-                            **kwargs
-                    )
-            elif boto_version == 'boto3':
-                if not self._role_arn:
-                    connection = boto3.client(services[0], region_name=region)
-                elif self.check_credentials():
-                    connection = boto3.client(
-                        services[0],
-                        region_name=region,
+        if boto_version == 'boto2':
+            aws_service = self._get_boto_service(boto, services)
+
+            kwargs = {}
+            if aws_service == boto.s3:
+                # Use base S3 endpoint to support buckets with dots in their names
+                kwargs['calling_format'] = boto.s3.connection.OrdinaryCallingFormat()
+
+            if not self._role_arn:
+                connection = aws_service.connect_to_region(region, **kwargs)
+            else:
+                connection = aws_service.connect_to_region(
+                        region,
                         aws_access_key_id=self._parameters['access_key'],
                         aws_secret_access_key=self._parameters['secret_key'],
-                        aws_session_token=self._parameters['session_token']
-                    )
+                        security_token=self._parameters['session_token'],
+                        **kwargs
+                )
+        elif boto_version == 'boto3':
+            if not self._role_arn:
+                connection = boto3.client(services[0], region_name=region)
             else:
-                raise ValueError('{0} is not a supported boto version.'.format(boto_version))
+                connection = boto3.client(
+                    services[0],
+                    region_name=region,
+                    aws_access_key_id=self._parameters['access_key'],
+                    aws_secret_access_key=self._parameters['secret_key'],
+                    aws_session_token=self._parameters['session_token']
+                )
+        else:
+            raise ValueError('{0} is not a supported boto version.'.format(boto_version))
+        if connection is None:
+            return None
+        if boto_version == 'boto2':
+            return trace_boto2_connection(connection, '.'.join(services))
+        return trace_boto3_client(count_boto3_throttling(connection))
+
+    def get_connection(self, region, services, boto_version='boto2'):
+        """
+        Returns a boto2/boto3 connection for the given region and services.
+
+        Connections are cached for the whole process (for the thread with boto2) and shared by every AWSConnection
+        instance: they are only re-created when the assumed role credentials they were built with have been renewed.
+        """
+        connection = None
+        try:
+            if self.check_credentials():
+                _, connections_cache, thread_connections_cache = _get_caches()
+                cache_key = (boto_version, tuple(services), region, self._role_arn)
+                access_key = self._parameters.get('access_key') if self._role_arn else None
+                if boto_version == 'boto2':
+                    cached_access_key, connection = thread_connections_cache.get(cache_key, (None, None))
+                    if connection is None or cached_access_key != access_key:
+                        connection = self._create_connection(region, services, boto_version)
+                        if connection is not None:
+                            thread_connections_cache[cache_key] = (access_key, connection)
+                else:
+                    with _cache_lock:
+                        cached_access_key, connection = connections_cache.get(cache_key, (None, None))
+                    if connection is None or cached_access_key != access_key:
+                        connection = self._create_connection(region, services, boto_version)
+                        with _cache_lock:
+                            # Keep the connection created by another thread meanwhile, if any
+                            cached_access_key, cached_connection = connections_cache.get(cache_key, (None, None))
+                            if cached_connection is not None and cached_access_key == access_key:
+                                connection = cached_connection
+                            elif connection is not None:
+                                connections_cache[cache_key] = (access_key, connection)
         except:
             if self._log_file:
                 log("An error occured when creating connection, check the exception error message for more details", self._log_file)
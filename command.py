@@ -1,27 +1,64 @@
-import logging
+import copy
 import os
+import pkgutil
+import socket
 import sys
 import traceback
 import yaml
 
 from bson.objectid import ObjectId
 from datetime import datetime
-from pymongo import MongoClient
-from redis import Redis
 from rq import get_current_job, Connection
-from sh import tail
 
-from ghost_aws import push_file_to_s3
+from ghost_data import get_db_connection, close_db_connection, get_redis_connection
 from ghost_log import log
-from ghost_tools import get_job_log_remote_path, GHOST_JOB_STATUSES_COLORS
+from ghost_metrics import inc_counter, observe_histogram
+from ghost_outbox import push_outbox_entries
+from ghost_tools import get_job_log_part_remote_path, GHOST_JOB_STATUSES_COLORS
+from libs.job_log import JobLogFile
+from libs.ssh import close_ssh_executor
+from libs.tracing import start_tracing, get_trace
 
-from notification import Notification
 from settings import cloud_connections, DEFAULT_PROVIDER
-from settings import MONGO_DBNAME, MONGO_HOST, MONGO_PORT, REDIS_HOST
 
 LOG_ROOT = '/var/log/ghost'
+# Interval in seconds between two log chunks shipped to S3 while a job runs
+JOB_LOG_SHIPPING_INTERVAL = 30
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
-MAIL_LOG_FROM_DEFAULT = 'no-reply@morea.fr'
+
+# Config and command modules loaded once by the warm runner, before forking the RQ workers
+_preloaded_config = None
+_command_modules = {}
+
+
+def load_config():
+    with open(ROOT_PATH + "/config.yml", 'r') as conf_file:
+        return yaml.load(conf_file)
+
+
+def get_command_module(command_name):
+    """
+    Returns the module of a command, importing it only once per process
+    """
+    if command_name not in _command_modules:
+        _command_modules[command_name] = __import__('commands.' + command_name,
+                                                    fromlist=[command_name.title(), 'RELATED_APP_FIELDS'])
+    return _command_modules[command_name]
+
+
+def preload_commands():
+    """
+    Loads the config and imports every command module, along with their dependencies (boto, fabric, pypacker...).
+    Called before forking the RQ workers so that each job work horse only pays the copy-on-write fork cost.
+    Returns the names of the preloaded commands.
+    """
+    global _preloaded_config
+    import commands
+    _preloaded_config = load_config()
+    command_names = [name for _, name, is_pkg in pkgutil.iter_modules(commands.__path__) if not is_pkg]
+    for command_name in command_names:
+        get_command_module(command_name)
+    return command_names
 
 
 def format_html_mail_body(app, job, config):
@@ -171,16 +208,22 @@ class Command:
 
     def __init__(self, dry_run=False):
         self._dry_run = dry_run
-        rootdir = os.path.dirname(os.path.realpath(__file__))
-        conf_file_path = rootdir + "/config.yml"
-        conf_file = open(conf_file_path, 'r')
-        self._config = yaml.load(conf_file)
+
+    def _load_config(self):
+        """
+        Loads the config in the job work horse: the Command instance is created and pickled by the API
+        """
+        if _preloaded_config is not None:
+            # Commands may alter their config, keep the preloaded one intact for the next jobs
+            self._config = copy.deepcopy(_preloaded_config)
+        else:
+            self._config = load_config()
 
     def _connect_db(self):
-        self._db = MongoClient(host=MONGO_HOST, port=MONGO_PORT)[MONGO_DBNAME]
+        self._db = get_db_connection()
 
     def _disconnect_db(self):
-        MongoClient().close()
+        close_db_connection()
 
     # FIXME: not used anymore
     def _update_progress(self, message, **kwargs):
@@ -216,73 +259,80 @@ class Command:
         # it is safe to redirect sys.stdout and sys.stderr to the job's log file.
         # This is mainly needed to capture all fabric & paramiko outputs,
         # but may also serve in other cases.
-        sys.stdout = sys.stderr = self.log_file = open(log_path, 'a', 1)
+        sys.stdout = sys.stderr = self.log_file = JobLogFile(
+            log_path, ship_chunk=self._ship_log_chunk,
+            ship_interval=self._config.get('job_log_shipping_interval', JOB_LOG_SHIPPING_INTERVAL))
+
+    def _ship_log_chunk(self, sequence, data):
+        cloud_connection = cloud_connections.get(self.app.get('provider', DEFAULT_PROVIDER))(None)
+        region = self._config.get('bucket_region', self.app['region'])
+        s3_client = cloud_connection.get_connection(region, ["s3"], boto_version='boto3')
+        s3_client.put_object(Bucket=self._config['bucket_s3'], Body=data, ContentType='application/gzip',
+                             Key=get_job_log_part_remote_path(self._worker_job.id, sequence))
 
     def _close_log_file(self):
         self.log_file.close()
 
-    def _push_log_to_s3(self):
-        cloud_connection = cloud_connections.get(self.app.get('provider', DEFAULT_PROVIDER))(None)
+    def _get_finalization_actions(self):
+        """
+        Returns the side effects of the finished job to push to the outbox, as (action, payload) couples
+        """
+        subject, body, slack_msg = format_notif(self.app, self.job)
         log_path = self._get_log_path()
-        bucket = self._config['bucket_s3']
-        region = self._config.get('bucket_region', self.app['region'])
-        key_path = get_job_log_remote_path(self._worker_job.id)
-        try:
-            push_file_to_s3(cloud_connection, bucket, region, key_path, log_path)
-        except:
-            self._init_log_file()
-            logging.exception("An exception occurred when trying to push job log to s3.")
-            traceback.print_exc()
-            self._close_log_file()
+        actions = [('slack', {
+            'slack_conf': slack_conf,
+            'slack_msg': slack_msg,
+            'app': {'name': self.app['name'], 'env': self.app['env'], 'role': self.app['role']},
+            'job': self.job,
+            'log_path': log_path,
+        }) for slack_conf in self._config.get('slack_configs') or []]
+        if self.app.get('log_notifications'):
+            html_body = format_html_mail_body(self.app, self.job, self._config)
+            actions += [('mail', {
+                'to': mail,
+                'subject': subject,
+                'body': body,
+                'html_body': html_body,
+                'log_path': log_path,
+                'log_filename': os.path.basename(log_path),
+            }) for mail in self.app['log_notifications']]
+        actions.append(('s3_log', {
+            'log_id': self._worker_job.id,
+            'log_path': log_path,
+            'provider': self.app.get('provider', DEFAULT_PROVIDER),
+            'region': self.app['region'],
+        }))
+        return actions
 
-    def _mail_log_action(self, subject, body):
-        ses_settings = self._config['ses_settings']
-        notif = Notification(aws_access_key=ses_settings['aws_access_key'],
-                             aws_secret_key=ses_settings['aws_secret_key'], region=ses_settings['region'])
-        html_body = format_html_mail_body(self.app, self.job, self._config)
-        log_path = self._get_log_path()
-        log = {
-            'original_log_path': log_path,
-            'filename': os.path.basename(log_path),
-        }
-        try:
-            for mail in self.app.get('log_notifications', []):
-                notif.send_mail(From=ses_settings.get('mail_from', MAIL_LOG_FROM_DEFAULT), To=mail, subject=subject,
-                                body_text=body, body_html=html_body, attachments=[log])
-                pass
-        except:
-            self._init_log_file()
-            logging.exception("An exception occurred when trying to send the Job mail notification.")
-            traceback.print_exc()
-            self._close_log_file()
+    def _record_job_metrics(self, started):
+        redis_connection = get_redis_connection()
+        labels = {'command': self.job['command'], 'status': self.job['status']}
+        inc_counter(redis_connection, 'ghost_jobs_finished_total', labels)
+        observe_histogram(redis_connection, 'ghost_job_duration_seconds',
+                          (datetime.utcnow() - started).total_seconds(), labels)
 
-    def _slack_notification_action(self, slack_msg):
-        log_path = self._get_log_path()
-        notif = Notification()
-        slack_configs = self._config.get('slack_configs')
-        ghost_base_url = self._config.get('ghost_base_url')
-        job_log_tail = ''.join(tail('-n', '5', log_path))
-        job_log = '[...]\n' + job_log_tail
-        try:
-            if slack_configs and len(slack_configs):
-                for slack_conf in slack_configs:
-                    slack_conf['ghost_base_url'] = ghost_base_url
-                    notif.send_slack_notification(slack_conf, slack_msg, self.app, self.job,
-                                                  job_log)  # , self.log_file) # Log file for debug purpose only
-        except:
-            logging.exception("An exception occurred when trying to send the Slack notifications.")
-            traceback.print_exc()
+    def _store_trace(self):
+        self._db.jobs.update({'_id': self.job['_id']}, {'$set': {'trace': get_trace()}})
 
     def execute(self, job_id):
-        with Connection(Redis(host=REDIS_HOST)):
+        self._load_config()
+        # Every span recorded during the job is a descendant of the job span
+        tracer = start_tracing()
+        job_span = tracer.start_span('job', {'job_id': job_id})
+        tracer.root_span_id = job_span['id']
+        with Connection(get_redis_connection()):
             self._worker_job = get_current_job()
         self._connect_db()
         self.job = self._db.jobs.find_one({'_id': ObjectId(job_id)})
         self.app = self._db.apps.find_one({'_id': ObjectId(self.job['app_id'])})
         self._init_log_file()
         self._db.jobs.update({'_id': self.job['_id']}, {'$set': {'log_id': self._worker_job.id}})
+        job_span['attributes']['command'] = self.job['command']
+        started = datetime.utcnow()
+        observe_histogram(get_redis_connection(), 'ghost_job_wait_seconds',
+                          max(0, (started - self.job['_created']).total_seconds()), {'command': self.job['command']})
         klass_name = self.job['command'].title()
-        mod = __import__('commands.' + self.job['command'], fromlist=[klass_name, 'RELATED_APP_FIELDS'])
+        mod = get_command_module(self.job['command'])
         command = getattr(mod, klass_name)(self)
 
         # Execute command and always mark the job as 'failed' in case of an unexpected exception
@@ -302,9 +352,13 @@ class Command:
             self.update_status("failed", str(message))
             raise
         finally:
-            subject, body, slack_msg = format_notif(self.app, self.job)
-            self._slack_notification_action(slack_msg)
+            close_ssh_executor()
             self._close_log_file()
-            self._mail_log_action(subject, body)
-            self._push_log_to_s3()
+            tracer.end_span(job_span)
+            self._store_trace()
+            self._record_job_metrics(started)
+            # Notifications and log upload are performed by the outbox consumer, releasing this worker right now
+            # The notifications and the log upload read the local log of the job
+            push_outbox_entries(self._db, self.job['_id'], self._get_finalization_actions(),
+                                host=socket.gethostname())
             self._disconnect_db()
@@ -1,26 +1,46 @@
 import calendar
 import datetime
+import hashlib
 import io
+import json
 import os
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 from sh import git
+from subprocess import Popen, PIPE
 
 from ghost_tools import b64decode_utf8, boolify
 from ghost_tools import GCallException, gcall, get_app_module_name_list, clean_local_module_workspace, refresh_stage2
-from ghost_tools import get_aws_connection_data
-from ghost_tools import get_module_package_rev_from_manifest, keep_n_recent_elements_from_list
-from ghost_tools import get_mirror_path_from_module, get_lock_path_from_repo
+from ghost_tools import get_aws_connection_data, get_ghost_env_variables
+from ghost_tools import get_mirror_path_from_module
 from ghost_log import log
-from settings import cloud_connections, DEFAULT_PROVIDER
-from libs.git_helper import git_acquire_lock, git_release_lock
+from ghost_outbox import push_outbox_entries
+from settings import cloud_connections, DEFAULT_PROVIDER, RQ_JOB_TIMEOUT
+from libs.git_mirror import update_mirror
 from libs.host_deployment_manager import HostDeploymentManager
-from libs.deploy import execute_module_script_on_ghost
-from libs.deploy import get_path_from_app_with_color
+from libs.package_catalog import record_package, PACKAGE_METADATA_SUFFIX
+from libs.deploy import execute_module_script_on_ghost, prepare_module_cache, limit_module_cache_size
+from libs.deploy import get_path_from_app_with_color, get_module_cache_path_from_module
 from libs.deploy import get_buildpack_clone_path_from_module, get_intermediate_clone_path_from_module
-from libs.deploy import update_app_manifest, rollback_app_manifest
+from libs.deploy import update_app_manifest_modules, rollback_app_manifest, PartialDeployException
+from libs.tracing import span
+from libs.workspace import update_workspace, evict_workspaces, record_workspace_size
 
 COMMAND_DESCRIPTION = "Deploy module(s)"
 RELATED_APP_FIELDS = ['modules']
 
+# Packages are streamed to S3 in parts of this size, several parts being uploaded at the same time
+PACKAGE_UPLOAD_PART_SIZE = 16 * 1024 * 1024
+PACKAGE_UPLOAD_CONCURRENCY = 8
+
+# Bump to invalidate all the cached builds when the packaging changes
+BUILD_CACHE_VERSION = 1
+# Module fields changing the content of its package
+BUILD_CACHE_MODULE_FIELDS = ['path', 'uid', 'gid', 'build_pack', 'pre_deploy', 'post_deploy', 'after_all_deploy',
+                             'cache_version']
+
 
 def is_available(app_context=None):
     return True
@@ -63,68 +83,281 @@ class Deploy():
                         result.append(item)
         return result
 
-    def _deploy_module(self, module, fabric_execution_strategy, safe_deployment_strategy):
-        deploy_manager = HostDeploymentManager(self._cloud_connection, self._app, module, self._log_file,
+    def _deploy_modules(self, modules, fabric_execution_strategy, safe_deployment_strategy):
+        deploy_manager = HostDeploymentManager(self._cloud_connection, self._app, modules, self._log_file,
                                                self._app.get('safe-deployment', {}), fabric_execution_strategy)
         deploy_manager.deployment(safe_deployment_strategy)
 
-    def _purge_s3_package(self, path, bucket, module, pkg_name, deployment_package_retention=42):
+    def _record_package(self, module, pkg_name):
+        record_package(self._worker._db, self._config['bucket_s3'],
+                       get_buildpack_clone_path_from_module(self._app, module).lstrip('/'), pkg_name, self._app['_id'],
+                       module['name'])
+
+    def _get_purge_packages_actions(self, modules_packages):
         """
-        Purge N old packages deployment for the current module from the current app
+        Returns the outbox actions purging the old packages of the deployed modules, according to the
+        `deployment_package_retention` of the app env
+
+        >>> class worker:
+        ...   app = {'_id': 1, 'name': 'AppName', 'env': 'prod', 'role': 'webfront', 'region': 'eu-west-1'}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = {'bucket_s3': 'my-bucket', 'deployment_package_retention': {'prod': 10}}
+        >>> actions = Deploy(worker=worker())._get_purge_packages_actions([({'name': 'mod1'}, '1500000000_mod1_abcdef1')])
+        >>> [(action, payload['prefix'], payload['retention'], payload['kept_packages']) for action, payload in actions]
+        [('purge_packages', 'ghost/AppName/prod/webfront/mod1', 10, ['1500000000_mod1_abcdef1'])]
+        >>> worker._config['deployment_package_retention'] = {'preprod': 10}
+        >>> Deploy(worker=worker())._get_purge_packages_actions([({'name': 'mod1'}, '1500000000_mod1_abcdef1')])
+        []
         """
-        try:
-            # Get all packages in S3 related to the current module
-            keys_list = [i.name.split("/")[-1] for i in bucket.list(path[+1:])]
-
-            # Get app manifest and extract package name
-            manifest_key_path = '{path}/MANIFEST'.format(path=get_path_from_app_with_color(self._app))
-            manifest_module_pkg_name = get_module_package_rev_from_manifest(bucket, manifest_key_path, module)
-
-            # Remove the current production/used package from the purge list
-            keys_list.remove(manifest_module_pkg_name)
-
-            # Remove the current deployment package just generated from the purge list
-            keys_list.remove(pkg_name)
-
-            if len(keys_list) > deployment_package_retention:
-                keys_list = keep_n_recent_elements_from_list(keys_list, deployment_package_retention, self._log_file)
-                for obj in keys_list:
-                    key_path_to_purge = '{path}/{obj}'.format(path=path, obj=obj)
-                    try:
-                        bucket.get_key(key_path_to_purge).delete()
-                        log("Packages Purge: Deleted S3 Object: %s" % key_path_to_purge, self._log_file)
-                    except:
-                        log("Packages Purge: Delete FAILED for S3 Object: %s" % key_path_to_purge, self._log_file)
-        except Exception, e:
-            log("Packages Purge: Global exception | " + str(e), self._log_file)
+        deployment_package_retention_config = self._config.get('deployment_package_retention', None)
+        if not deployment_package_retention_config or self._app['env'] not in deployment_package_retention_config:
+            return []
+        return [('purge_packages', {
+            'bucket': self._config['bucket_s3'],
+            'prefix': get_buildpack_clone_path_from_module(self._app, module).lstrip('/'),
+            'module': module['name'],
+            'manifest_key_path': get_path_from_app_with_color(self._app) + '/MANIFEST',
+            'retention': deployment_package_retention_config.get(self._app['env'], 42),
+            'kept_packages': [pkg_name],
+            'provider': self._app.get('provider', DEFAULT_PROVIDER),
+            'region': self._app['region'],
+        }) for module, pkg_name in modules_packages]
+
+    def _get_package_command(self, module):
+        """
+        Returns the shell pipeline writing the gzipped tarball of the module to its standard output.
+        pigz is used to compress on all CPU cores when available. Git metadata are never packaged from persistent
+        workspaces, which hold the complete history of the module.
 
-    def _package_module(self, module, ts, commit):
-        path = get_buildpack_clone_path_from_module(self._app, module)
-        os.chdir(path)
-        pkg_name = "{0}_{1}_{2}".format(ts, module['name'], commit)
-        pkg_path = '../{0}'.format(pkg_name)
+        >>> class worker:
+        ...   app = {}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = {}
+        >>> import commands.deploy
+        >>> find_executable = commands.deploy.find_executable
+        >>> commands.deploy.find_executable = lambda name: None
+        >>> Deploy(worker=worker())._get_package_command({'uid': 1001, 'gid': 1002})
+        'tar c --owner=1001 --group=1002  . | gzip -c'
+        >>> commands.deploy.find_executable = lambda name: '/usr/bin/pigz'
+        >>> worker._config = {'deployment_package_exclude_git_metadata': True}
+        >>> Deploy(worker=worker())._get_package_command({'uid': 1001, 'gid': 1002})
+        "tar c --owner=1001 --group=1002 --exclude '.git' . | pigz -c"
+        >>> worker._config = {'deployment_persistent_workspaces': True}
+        >>> Deploy(worker=worker())._get_package_command({'uid': 1001, 'gid': 1002})
+        "tar c --owner=1001 --group=1002 --exclude '.git' . | pigz -c"
+        >>> commands.deploy.find_executable = find_executable
+        """
         uid = module.get('uid', os.geteuid())
         gid = module.get('gid', os.getegid())
-        tar_exclude_git = "--exclude '.git'" if boolify(self._config.get('deployment_package_exclude_git_metadata', False)) else ''
-        gcall("tar czf {0} --owner={1} --group={2} {3} .".format(pkg_path, uid, gid, tar_exclude_git), "Creating package: %s" % pkg_name, self._log_file)
+        exclude_git = (boolify(self._config.get('deployment_package_exclude_git_metadata', False)) or
+                       boolify(self._config.get('deployment_persistent_workspaces', False)))
+        tar_exclude_git = "--exclude '.git'" if exclude_git else ''
+        compressor = 'pigz' if find_executable('pigz') else 'gzip'
+        return "tar c --owner={0} --group={1} {2} . | {3} -c".format(uid, gid, tar_exclude_git, compressor)
+
+    def _get_build_cache_key(self, module, commit):
+        """
+        Returns the hash of the inputs of a module build: the commit, the module scripts and settings and
+        all the environment variables given to the buildpack, but those listed in `deployment_build_cache_shared_env_vars`.
+
+        >>> import base64
+        >>> class worker:
+        ...   app = {'name': 'app1', 'env': 'prod', 'role': 'webfront', 'env_vars': [{'var_key': 'API_URL', 'var_value': 'http://api'}]}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = {}
+        >>> module = {'name': 'mod1', 'path': '/var/www', 'build_pack': base64.b64encode('npm run build')}
+        >>> key = Deploy(worker=worker())._get_build_cache_key(module, 'a' * 40)
+        >>> Deploy(worker=worker())._get_build_cache_key(module, 'a' * 40) == key
+        True
+        >>> Deploy(worker=worker())._get_build_cache_key(module, 'b' * 40) == key
+        False
+        >>> worker.app = dict(worker.app, env='preprod')
+        >>> Deploy(worker=worker())._get_build_cache_key(module, 'a' * 40) == key
+        False
+
+        Packages are only shared between envs when the Ghost variables which differ are explicitly allowed:
+
+        >>> worker._config = {'deployment_build_cache_shared_env_vars': ['GHOST_ENV']}
+        >>> key = Deploy(worker=worker())._get_build_cache_key(module, 'a' * 40)
+        >>> worker.app = dict(worker.app, env='prod')
+        >>> Deploy(worker=worker())._get_build_cache_key(module, 'a' * 40) == key
+        True
+        """
+        shared_env_vars = self._config.get('deployment_build_cache_shared_env_vars') or []
+        build_inputs = {
+            'version': BUILD_CACHE_VERSION,
+            'commit': commit,
+            'module': {field: module.get(field) for field in BUILD_CACHE_MODULE_FIELDS},
+            'env_vars': {key: value for key, value in self._get_buildpack_env_variables(module).items()
+                         if key not in shared_env_vars},
+            'container_image': (self._app.get('build_infos') or {}).get('container_image'),
+            'exclude_git_metadata': boolify(self._config.get('deployment_package_exclude_git_metadata', False)),
+        }
+        return hashlib.sha256(json.dumps(build_inputs, sort_keys=True)).hexdigest()
+
+    def _get_buildpack_env_variables(self, module):
+        """
+        Returns the Ghost and custom environment variables given to the buildpack by `execute_module_script_on_ghost`
+        """
+        env_vars = get_ghost_env_variables(self._app, module)
+        if boolify(self._config.get('deployment_module_cache', False)):
+            env_vars['GHOST_MODULE_CACHE_DIR'] = get_module_cache_path_from_module(self._app, module)
+        return env_vars
+
+    def _get_package_name(self, module, ts, commit):
+        return "{0}_{1}_{2}".format(ts, module['name'], commit)
 
-        log("Uploading package: %s" % pkg_name, self._log_file)
+    def _get_s3_client(self):
+        bucket_region = self._config.get('bucket_region', self._app['region'])
         cloud_connection = cloud_connections.get(self._app.get('provider', DEFAULT_PROVIDER))(self._log_file)
-        conn = cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']), ["s3"])
-        bucket = conn.get_bucket(self._config['bucket_s3'])
-        key_path = '{path}/{pkg_name}'.format(path=path, pkg_name=pkg_name)
-        key = bucket.get_key(path)
-        if not key:
-            key = bucket.new_key(key_path)
-        key.set_contents_from_filename(pkg_path)
+        return cloud_connection.get_connection(bucket_region, ["s3"], boto_version='boto3')
 
-        gcall("rm -f {0}".format(pkg_path), "Deleting local package: %s" % pkg_name, self._log_file)
+    def _get_cached_package(self, build_cache_key, module, git_repo, build):
+        """
+        Copies the package of a previous build with the same inputs, possibly of another app or color, among the
+        packages of the module. The package is copied within S3 and the module metadata of this build are shipped
+        beside it, the instances apply them over the ones of the cached build.
+        The package is only downloaded when the module has an after_all_deploy script, which runs in the built module.
+        Returns the name of the copy, None if no cached package is available.
+        """
+        cached_build = self._worker._db.build_cache.find_one({'_id': build_cache_key})
+        if not cached_build:
+            return None
+        pkg_name = self._get_package_name(module, build['ts'], build['commit'])
+        key_path = '{path}/{pkg_name}'.format(path=get_buildpack_clone_path_from_module(self._app, module),
+                                             pkg_name=pkg_name).lstrip('/')
+        log("Build cache hit: copying package s3://{b}/{k} instead of building the module".format(
+            b=cached_build['bucket'], k=cached_build['key']), self._log_file)
+        s3_client = self._get_s3_client()
+        try:
+            if 'after_all_deploy' in module:
+                build['package_path'] = get_intermediate_clone_path_from_module(self._app, module)
+                self._extract_cached_package(s3_client, cached_build, build['package_path'])
+                self._write_module_metadata(build['package_path'], git_repo, build)
+            # Server side copy, the package is not downloaded
+            s3_client.copy({'Bucket': cached_build['bucket'], 'Key': cached_build['key']},
+                           self._config['bucket_s3'], key_path,
+                           Config=TransferConfig(multipart_chunksize=PACKAGE_UPLOAD_PART_SIZE,
+                                                 max_concurrency=PACKAGE_UPLOAD_CONCURRENCY))
+        except (ClientError, IOError) as e:
+            # The cached package was purged or can't be extracted
+            log("Build cache: cached package is not usable ({e}), building the module".format(e=e), self._log_file)
+            self._worker._db.build_cache.remove({'_id': build_cache_key})
+            self._remove_extracted_package(build)
+            return None
+        s3_client.put_object(Bucket=self._config['bucket_s3'], Key=key_path + PACKAGE_METADATA_SUFFIX,
+                             Body=self._get_module_metadata(git_repo, build).encode('utf-8'))
+        self._record_package(module, pkg_name)
+        return pkg_name
 
-        deployment_package_retention_config = self._config.get('deployment_package_retention', None)
-        if deployment_package_retention_config and self._app['env'] in deployment_package_retention_config:
-            deployment_package_retention = deployment_package_retention_config.get(self._app['env'], 42)
-            self._purge_s3_package(path, bucket, module, pkg_name, deployment_package_retention)
+    def _extract_cached_package(self, s3_client, cached_build, package_path):
+        """
+        Streams the cached package into package_path, kept until the end of the deploy
+        """
+        if os.path.exists(package_path):
+            gcall('chmod -R u+rwx {p}'.format(p=package_path), 'Update rights on previous intermediate clone',
+                  self._log_file)
+            gcall('rm -rf {p}'.format(p=package_path), 'Removing previous intermediate clone', self._log_file)
+        os.makedirs(package_path)
+        log("Extracting cached package in {p} for the after_all_deploy script".format(p=package_path), self._log_file)
+        extract_process = Popen(['tar', '-xpzf', '-'], stdin=PIPE, stderr=self._log_file, cwd=package_path)
+        try:
+            # Raises IOError if tar exits early
+            s3_client.download_fileobj(cached_build['bucket'], cached_build['key'], extract_process.stdin)
+        finally:
+            try:
+                extract_process.stdin.close()
+            finally:
+                extract_process.wait()
+        if extract_process.returncode != 0:
+            raise IOError("Extracting cached package {k} failed".format(k=cached_build['key']))
+
+    def _remove_extracted_package(self, build):
+        package_path = build.pop('package_path', None)
+        if package_path and os.path.exists(package_path):
+            gcall('chmod -R u+rwx {p}'.format(p=package_path), 'Update rights on intermediate clone', self._log_file)
+            gcall('rm -rf {p}'.format(p=package_path), 'Removing intermediate clone', self._log_file)
+
+    def _get_module_metadata(self, git_repo, build):
+        """
+        Returns the content of the .ghost-metadata file of the package, sourced by the deploy scripts of the instances
+        """
+        module_metadata = u"""
+#!/bin/bash
+
+GHOST_MODULE_REPO="{repo}"
+GHOST_MODULE_REV="{rev}"
+GHOST_MODULE_COMMIT="{commit}"
+GHOST_MODULE_COMMIT_MESSAGE="{commitmsg}"
+GHOST_MODULE_USER="{user}"
+
+"""
+        metavars = {
+            "repo": git_repo,
+            "rev": build['revision'],
+            "commit": build['commit'],
+            "commitmsg": build['commit_message'],
+            "user": self._job['user']
+        }
+        module_metadata = module_metadata.format(**metavars)
+        custom_env_vars = self._app.get('env_vars', None)
+        if custom_env_vars and len(custom_env_vars):
+            module_metadata = module_metadata + u''.join([u'export {key}="{val}" \n'.format(key=env_var['var_key'], val=env_var.get('var_value', '')) for env_var in custom_env_vars])
+        return module_metadata
 
+    def _write_module_metadata(self, path, git_repo, build):
+        log("Create metadata file for inclusion in target package", self._log_file)
+        with io.open(path + '/.ghost-metadata', mode='w', encoding='utf-8') as f:
+            f.write(self._get_module_metadata(git_repo, build))
+        gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=path)
+
+    def _store_build_cache(self, build_cache_key, module, pkg_name):
+        key_path = '{path}/{pkg_name}'.format(path=get_buildpack_clone_path_from_module(self._app, module),
+                                             pkg_name=pkg_name)
+        self._worker._db.build_cache.update({'_id': build_cache_key}, {
+            '_id': build_cache_key,
+            'bucket': self._config['bucket_s3'],
+            'key': key_path.lstrip('/'),
+            'app_id': self._app['_id'],
+            'module': module['name'],
+            '_created': datetime.datetime.utcnow(),
+        }, upsert=True)
+
+    def _package_module(self, module, ts, commit):
+        """
+        Streams the module package to S3 while it is being archived and compressed: nothing is written to local disk.
+        """
+        path = get_buildpack_clone_path_from_module(self._app, module)
+        pkg_name = self._get_package_name(module, ts, commit)
+        key_path = '{path}/{pkg_name}'.format(path=path, pkg_name=pkg_name)
+        bucket_name = self._config['bucket_s3']
+        s3_client = self._get_s3_client()
+
+        package_command = self._get_package_command(module)
+        log("Creating and uploading package: %s" % pkg_name, self._log_file)
+        log("CMD: {0}".format(package_command), self._log_file)
+        self._log_file.flush()
+        package_process = Popen(['bash', '-o', 'pipefail', '-c', package_command],
+                                stdout=PIPE, stderr=self._log_file, cwd=path)
+        try:
+            s3_client.upload_fileobj(package_process.stdout, bucket_name, key_path.lstrip('/'),
+                                     Config=TransferConfig(multipart_chunksize=PACKAGE_UPLOAD_PART_SIZE,
+                                                           max_concurrency=PACKAGE_UPLOAD_CONCURRENCY))
+        except:
+            package_process.kill()
+            package_process.wait()
+            raise
+        finally:
+            package_process.stdout.close()
+        if package_process.wait() != 0:
+            # The archive was truncated, do not leave an unusable package in the bucket
+            s3_client.delete_object(Bucket=bucket_name, Key=key_path.lstrip('/'))
+            raise GCallException("ERROR: Creating package: %s" % pkg_name)
+
+        self._record_package(module, pkg_name)
         return pkg_name
 
     def _get_module_revision(self, module_name):
@@ -204,23 +437,71 @@ class Deploy():
         split_comma = ', '
         module_list = split_comma.join(module_list)
         try:
-            deploy_ids = {}
-            for module in self._apps_modules:
-                deploy_id = self._execute_deploy(module, fabric_execution_strategy, safe_deployment_strategy)
-                deploy_ids[module['name']] = deploy_id
-                self._worker._db.jobs.update({ '_id': self._job['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.deploy_id': deploy_id }})
-                self._worker._db.apps.update({ '_id': self._app['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.initialized': True }})
-
+            builds = self._build_modules(self._apps_modules)
+            with span('deploy_modules', modules=module_list):
+                deploy_ids = self._execute_deploy(self._apps_modules, builds, fabric_execution_strategy,
+                                                  safe_deployment_strategy)
             self._worker.update_status("done", message=self._get_notification_message_done(deploy_ids))
         except GCallException as e:
             self._worker.update_status("failed", message=self._get_notification_message_failed(module_list, e))
 
-    def _is_commit_hash(self, revision):
+    def _get_build_concurrency(self):
+        """
+        Returns the maximum number of modules built at the same time.
+
+        >>> class worker:
+        ...   app = {}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = {}
+        >>> Deploy(worker=worker())._get_build_concurrency()
+        1
+        >>> worker._config = {'deployment_build_concurrency': 4}
+        >>> Deploy(worker=worker())._get_build_concurrency()
+        4
+        >>> worker._config = {'deployment_build_concurrency': 0}
+        >>> Deploy(worker=worker())._get_build_concurrency()
+        1
+        """
+        return max(1, int(self._config.get('deployment_build_concurrency', 1)))
+
+    def _build_modules(self, modules):
+        """
+        Builds and packages all the given modules, up to `deployment_build_concurrency` modules at the same time.
+        Returns the build informations of each module, indexed by module name.
+        """
+        def build_module(module):
+            with span('build_module', module=module['name']):
+                return self._build_module(module)
+
+        concurrency = min(self._get_build_concurrency(), len(modules))
+        if concurrency <= 1:
+            builds = [build_module(module) for module in modules]
+        else:
+            log("Building {0} modules with up to {1} concurrent builds".format(len(modules), concurrency),
+                self._log_file)
+            pool = ThreadPool(concurrency)
+            try:
+                builds = pool.map(build_module, modules, chunksize=1)
+            finally:
+                # Let the other builds terminate before reporting a failure
+                pool.close()
+                pool.join()
+
+        # Evicted once all the workspaces of the deploy were updated, build cache hits included
+        if boolify(self._config.get('deployment_persistent_workspaces', False)):
+            for module in modules:
+                record_workspace_size(get_buildpack_clone_path_from_module(self._app, module))
+            evict_workspaces(int(self._config.get('deployment_workspaces_quota_gb', 50)) * 1024 * 1024 * 1024,
+                             RQ_JOB_TIMEOUT, self._log_file)
+        return {module['name']: build for module, build in zip(modules, builds)}
+
+    def _is_commit_hash(self, revision, cwd=None):
         """
         Returns True is revision is a valid commit hash, False otherwise.
 
         ***NOTE***:
-        This test invokes git rev-parse in the current working directory and will fail
+        This test invokes git rev-parse in the given or current working directory and will fail
         if git is not installed or run outside of a git workspace.
 
         >>> class worker:
@@ -257,16 +538,17 @@ class Deploy():
         resolved_revision = ''
         try:
             # git rev-parse returns a complete hash from an abbreviated hash, if valid
-            resolved_revision = git('--no-pager', 'rev-parse', revision, _tty_out=False).strip()
+            resolved_revision = git('--no-pager', 'rev-parse', revision, _tty_out=False, _cwd=cwd).strip()
         except:
             pass
 
         # If resolved_revision begins with or equals revision, it is a commit hash
         return resolved_revision.find(revision) == 0
 
-    def _execute_deploy(self, module, fabric_execution_strategy, safe_deployment_strategy):
+    def _build_module(self, module):
         """
-        Returns the deployment id
+        Clones, builds and packages the module, then returns its build informations.
+        Never changes the current working directory so that several modules can be built concurrently.
         """
 
         now = datetime.datetime.utcnow()
@@ -275,65 +557,51 @@ class Deploy():
         git_repo = module['git_repo'].strip()
         mirror_path = get_mirror_path_from_module(module)
         clone_path = get_buildpack_clone_path_from_module(self._app, module)
-        lock_path = get_lock_path_from_repo(git_repo)
         revision = self._get_module_revision(module['name'])
 
-        try:
-            git_acquire_lock(lock_path, self._log_file)
-
-            if not os.path.exists(mirror_path):
-                gcall('git --no-pager clone --bare --mirror {r} {m}'.format(r=git_repo, m=mirror_path),
-                      'Create local git mirror for remote {r}'.format(r=git_repo),
-                      self._log_file)
-
-            # Update existing git mirror
-            os.chdir(mirror_path)
-            gcall('git --no-pager gc --auto',
-                  'Cleanup local mirror before update {r}'.format(r=git_repo),
-                  self._log_file)
-            gcall('git --no-pager fetch --all --tags --prune',
-                  'Update local git mirror from remote {r}'.format(r=git_repo),
-                  self._log_file)
-        finally:
-            git_release_lock(lock_path, self._log_file)
+        update_mirror(git_repo, mirror_path, revision, self._log_file,
+                      freshness=int(self._config.get('git_mirror_fetch_freshness', 0)))
 
         # Resolve HEAD symbolic reference to identify the default branch
-        head = git('--no-pager', 'symbolic-ref', '--short', 'HEAD', _tty_out=False).strip()
+        head = git('--no-pager', 'symbolic-ref', '--short', 'HEAD', _tty_out=False, _cwd=mirror_path).strip()
 
         # If revision is HEAD, replace it by the default branch
         if revision == 'HEAD':
             revision = head
 
+        persistent_workspaces = boolify(self._config.get('deployment_persistent_workspaces', False))
+        if persistent_workspaces:
+            # Update the workspace of the previous build of the module in place
+            update_workspace(mirror_path, clone_path, revision, self._is_commit_hash(revision, cwd=mirror_path),
+                             self._log_file)
         # If revision is a commit hash, a full intermediate clone is required before getting a shallow clone
-        if self._is_commit_hash(revision):
+        elif self._is_commit_hash(revision, cwd=mirror_path):
             # Create intermediate clone from the local git mirror, chdir into it and fetch all commits
             source_path = get_intermediate_clone_path_from_module(self._app, module)
             if os.path.exists(source_path):
                 gcall('chmod -R u+rwx {p}'.format(p=source_path), 'Update rights on previous intermediate clone', self._log_file)
                 gcall('rm -rf {p}'.format(p=source_path), 'Removing previous intermediate clone', self._log_file)
             os.makedirs(source_path)
-            os.chdir(source_path)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager init', 'Git init intermediate clone', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager remote add origin file://{m}'.format(m=mirror_path), 'Git add local mirror as origin for intermediate clone', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager fetch origin', 'Git fetch all commits from origin', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager checkout {r}'.format(r=revision), 'Git checkout revision into intermediate clone: {r}'.format(r=revision), self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=source_path)
+            gcall('git --no-pager init', 'Git init intermediate clone', self._log_file, cwd=source_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=source_path)
+            gcall('git --no-pager remote add origin file://{m}'.format(m=mirror_path), 'Git add local mirror as origin for intermediate clone', self._log_file, cwd=source_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=source_path)
+            gcall('git --no-pager fetch origin', 'Git fetch all commits from origin', self._log_file, cwd=source_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=source_path)
+            gcall('git --no-pager checkout {r}'.format(r=revision), 'Git checkout revision into intermediate clone: {r}'.format(r=revision), self._log_file, cwd=source_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=source_path)
 
             # Create shallow clone from the intermediate clone, chdir into it and retrieve submodules
             if os.path.exists(clone_path):
                 gcall('chmod -R u+rwx {p}'.format(p=clone_path), 'Update rights on previous clone', self._log_file)
                 gcall('rm -rf {p}'.format(p=clone_path), 'Removing previous clone', self._log_file)
             os.makedirs(clone_path)
-            os.chdir(clone_path)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager clone file://{s} .'.format(s=source_path), 'Git clone from intermediate clone', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager submodule update --init --recursive', 'Git update submodules', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
+            gcall('git --no-pager clone file://{s} .'.format(s=source_path), 'Git clone from intermediate clone', self._log_file, cwd=clone_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
+            gcall('git --no-pager submodule update --init --recursive', 'Git update submodules', self._log_file, cwd=clone_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
 
             # Destroy intermediate clone
             gcall('chmod -R u+rwx {p}'.format(p=source_path), 'Update rights on previous intermediate clone', self._log_file)
@@ -344,19 +612,35 @@ class Deploy():
                 gcall('chmod -R u+rwx {p}'.format(p=clone_path), 'Update rights on previous clone', self._log_file)
                 gcall('rm -rf {p}'.format(p=clone_path), 'Removing previous clone', self._log_file)
             os.makedirs(clone_path)
-            os.chdir(clone_path)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager clone --depth=10 file://{m} -b {r} .'.format(m=mirror_path, r=revision), 'Git clone from local mirror with depth limited to 10 from a specific revision: {r}'.format(r=revision), self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager submodule update --init --recursive', 'Git update submodules', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
+            gcall('git --no-pager clone --depth=10 file://{m} -b {r} .'.format(m=mirror_path, r=revision), 'Git clone from local mirror with depth limited to 10 from a specific revision: {r}'.format(r=revision), self._log_file, cwd=clone_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
+            gcall('git --no-pager submodule update --init --recursive', 'Git update submodules', self._log_file, cwd=clone_path)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
 
         # Extract commit information
-        commit = git('--no-pager', 'rev-parse', '--short', 'HEAD', _tty_out=False).strip()
-        commit_message = git('--no-pager', 'log', '--max-count=1', '--format=%s', 'HEAD', _tty_out=False).strip()
+        commit = git('--no-pager', 'rev-parse', '--short', 'HEAD', _tty_out=False, _cwd=clone_path).strip()
+        commit_message = git('--no-pager', 'log', '--max-count=1', '--format=%s', 'HEAD', _tty_out=False,
+                             _cwd=clone_path).strip()
 
         # At last, reset remote origin URL
-        gcall('git --no-pager remote set-url origin {r}'.format(r=git_repo), 'Git reset remote origin to {r}'.format(r=git_repo), self._log_file)
+        gcall('git --no-pager remote set-url origin {r}'.format(r=git_repo), 'Git reset remote origin to {r}'.format(r=git_repo), self._log_file, cwd=clone_path)
+
+        build = {
+            'ts': ts,
+            'revision': revision,
+            'commit': commit,
+            'commit_message': commit_message,
+        }
+
+        # Reuse the package of a previous build of the same commit with the same build inputs
+        build_cache_key = None
+        if boolify(self._config.get('deployment_build_cache', False)):
+            build_cache_key = self._get_build_cache_key(
+                module, git('--no-pager', 'rev-parse', 'HEAD', _tty_out=False, _cwd=clone_path).strip())
+            build['package'] = self._get_cached_package(build_cache_key, module, git_repo, build)
+            if build['package']:
+                return build
 
         # Store predeploy script in tarball
         if 'pre_deploy' in module:
@@ -364,11 +648,18 @@ class Deploy():
             predeploy_source = b64decode_utf8(module['pre_deploy'])
             with io.open(clone_path + '/predeploy', mode='w', encoding='utf-8') as f:
                 f.write(predeploy_source)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
 
-        # Execute buildpack
+        # Execute buildpack, with a dependency cache directory kept between deploys
+        module_cache_path = None
+        if boolify(self._config.get('deployment_module_cache', False)):
+            module_cache_path = prepare_module_cache(self._app, module, self._log_file)
         execute_module_script_on_ghost(self._app, module, 'build_pack', 'Buildpack', clone_path,
-                                       self._log_file, self._job, self._config)
+                                       self._log_file, self._job, self._config, module_cache_path)
+        if module_cache_path:
+            limit_module_cache_size(module_cache_path,
+                                    int(self._config.get('deployment_module_cache_max_size_gb', 5)) * 1024 * 1024 * 1024,
+                                    self._log_file)
 
         # Store postdeploy script in tarball
         if 'post_deploy' in module:
@@ -376,7 +667,7 @@ class Deploy():
             postdeploy_source = b64decode_utf8(module['post_deploy'])
             with io.open(clone_path + '/postdeploy', mode='w', encoding='utf-8') as f:
                 f.write(postdeploy_source)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
 
         # Store after_all_deploy script in tarball
         if 'after_all_deploy' in module:
@@ -384,63 +675,96 @@ class Deploy():
             afteralldeploy_source = b64decode_utf8(module['after_all_deploy'])
             with io.open(clone_path + '/after_all_deploy', mode='w', encoding='utf-8') as f:
                 f.write(afteralldeploy_source)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+            gcall('du -hs .', 'Display current build directory disk usage', self._log_file, cwd=clone_path)
 
         # Store module metadata in tarball
-        log("Create metadata file for inclusion in target package", self._log_file)
-        module_metadata = u"""
-#!/bin/bash
+        self._write_module_metadata(clone_path, git_repo, build)
 
-GHOST_MODULE_REPO="{repo}"
-GHOST_MODULE_REV="{rev}"
-GHOST_MODULE_COMMIT="{commit}"
-GHOST_MODULE_COMMIT_MESSAGE="{commitmsg}"
-GHOST_MODULE_USER="{user}"
+        # Create tar archive
+        with span('package_module', module=module['name']):
+            build['package'] = self._package_module(module, ts, commit)
+        if build_cache_key:
+            self._store_build_cache(build_cache_key, module, build['package'])
 
-"""
-        metavars = {
-            "repo": git_repo,
-            "rev": revision,
-            "commit": commit,
-            "commitmsg": commit_message,
-            "user": self._job['user']
-        }
-        module_metadata = module_metadata.format(**metavars)
-        custom_env_vars = self._app.get('env_vars', None)
-        if custom_env_vars and len(custom_env_vars):
-            module_metadata = module_metadata + u''.join([u'export {key}="{val}" \n'.format(key=env_var['var_key'], val=env_var.get('var_value', '')) for env_var in custom_env_vars])
-        with io.open(clone_path + '/.ghost-metadata', mode='w', encoding='utf-8') as f:
-            f.write(module_metadata)
-        gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+        return build
 
-        # Create tar archive
-        pkg_name = self._package_module(module, ts, commit)
+    def _execute_deploy(self, modules, builds, fabric_execution_strategy, safe_deployment_strategy):
+        """
+        Rolls out the modules packages produced by `_build_module` in a single rollout: the manifest is updated once
+        and each host deploys all the modules in one stage2 run.
+        Returns the deployment ids indexed by module name.
 
-        before_update_manifest = update_app_manifest(self._app, self._config, module, pkg_name, self._log_file)
+        When the rollout fails after every host switched the first modules, only the manifest of the other modules
+        is restored: the switched ones are recorded as deployed and run their after_all_deploy before the error is
+        raised.
+        """
+        try:
+            return self._rollout_modules(modules, builds, fabric_execution_strategy, safe_deployment_strategy)
+        finally:
+            for build in builds.values():
+                self._remove_extracted_package(build)
+
+    def _rollout_modules(self, modules, builds, fabric_execution_strategy, safe_deployment_strategy):
+        modules_packages = [(module, builds[module['name']]['package']) for module in modules]
+        before_update_manifest = update_app_manifest_modules(self._app, self._config, modules_packages,
+                                                             self._log_file)
+        deploy_error = None
         try:
             all_app_modules_list = get_app_module_name_list(self._app['modules'])
             clean_local_module_workspace(get_path_from_app_with_color(self._app), all_app_modules_list, self._log_file)
-            self._deploy_module(module, fabric_execution_strategy, safe_deployment_strategy)
+            self._deploy_modules(modules, fabric_execution_strategy, safe_deployment_strategy)
+        except PartialDeployException as e:
+            deploy_error = e
+            modules = e.deployed_modules
+            modules_packages = [(module, builds[module['name']]['package']) for module in modules]
+            deployed_names = [module['name'] for module in modules]
+            log("Deploy error occured after switching modules {0}, app manifest of the other modules will be restored "
+                "to its previous state".format(', '.join(deployed_names)), self._log_file)
+            rollback_app_manifest(self._app, self._config, {
+                'modules': before_update_manifest['modules'],
+                'packages': {name: package for name, package in before_update_manifest['packages'].items()
+                             if name not in deployed_names},
+            }, self._log_file)
         except GCallException as e:
             log("Deploy error occured, app manifest will be restored to its previous state", self._log_file)
             rollback_app_manifest(self._app, self._config, before_update_manifest, self._log_file)
             raise e
 
-        if 'after_all_deploy' in module:
-            log("After all deploy script found for '{0}'. Executing it.".format(module['name']), self._log_file)
-            execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy', clone_path,
-                                           self._log_file, self._job, self._config)
+        # Old packages are purged by the outbox consumer, once the MANIFEST references the new ones
+        push_outbox_entries(self._worker._db, self._job['_id'], self._get_purge_packages_actions(modules_packages))
 
+        deploy_ids = {}
+        for module in modules:
+            if 'after_all_deploy' in module:
+                log("After all deploy script found for '{0}'. Executing it.".format(module['name']), self._log_file)
+                # Packages reused from the build cache are extracted apart from the module workspace
+                execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy',
+                                               builds[module['name']].get('package_path') or
+                                               get_buildpack_clone_path_from_module(self._app, module),
+                                               self._log_file, self._job, self._config)
+            deploy_ids[module['name']] = self._insert_deploy_history(module, builds[module['name']])
+            self._worker._db.jobs.update({'_id': self._job['_id'], 'modules.name': module['name']},
+                                         {'$set': {'modules.$.deploy_id': deploy_ids[module['name']]}})
+            self._worker._db.apps.update({'_id': self._app['_id'], 'modules.name': module['name']},
+                                         {'$set': {'modules.$.initialized': True}})
+        if deploy_error:
+            raise deploy_error
+        return deploy_ids
+
+    def _insert_deploy_history(self, module, build):
+        """
+        Records the deployment of the module package and returns its id
+        """
         now = datetime.datetime.utcnow()
         deployment = {
             'app_id': self._app['_id'],
             'job_id': self._job['_id'],
             'module': module['name'],
-            'revision': revision,
-            'commit': commit,
-            'commit_message': commit_message,
-            'timestamp': ts,
-            'package': pkg_name,
+            'revision': build['revision'],
+            'commit': build['commit'],
+            'commit_message': build['commit_message'],
+            'timestamp': build['ts'],
+            'package': build['package'],
             'module_path': module['path'],
             '_created': now,
             '_updated': now,
@@ -1,5 +1,4 @@
 from fabric.colors import green as _green, yellow as _yellow, red as _red
-import time
 
 from settings import cloud_connections, DEFAULT_PROVIDER
 
@@ -9,6 +8,7 @@ from ghost_aws import check_autoscale_exists
 from libs.blue_green import get_blue_green_from_app
 from libs.ec2 import create_ec2_instance, destroy_ec2_instances, test_ec2_instance_status
 from libs.rolling_update import RollingUpdate
+from libs.tracing import traced_sleep
 
 COMMAND_DESCRIPTION = "Recreate all the instances, rolling update possible when using an Autoscale"
 RELATED_APP_FIELDS = []
@@ -61,7 +61,7 @@ class Recreateinstances():
                 log(_yellow(" INFO: Waiting for instances to be destroyed before re-creating them with the same network parameters."), self._log_file)
                 while not test_ec2_instance_status(self._cloud_connection, self._app['region'], [host['id'] for host in destroyed_instances_info], "terminated"):
                     log("Waiting 10s", self._log_file)
-                    time.sleep(10)
+                    traced_sleep(10)
 
                 x = 0
                 while x < destroyed_count:
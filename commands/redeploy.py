@@ -87,20 +87,20 @@ class Redeploy():
             before_update_manifest = update_app_manifest(self._app, self._config, module, package, self._log_file)
             all_app_modules_list = get_app_module_name_list(self._app['modules'])
             clean_local_module_workspace(get_path_from_app_with_color(self._app), all_app_modules_list, self._log_file)
-            # Download and extract package before launching deploy
-            clone_path = self._local_extract_package(module, package)
 
             try:
-                # Re-deploy
+                # Re-deploy: instances still having the package only switch the module back to it
                 self._deploy_module(module, fabric_execution_strategy, safe_deployment_strategy)
             except GCallException as e:
                 log("Redeploy error occured, app manifest will be restored to its previous state", self._log_file)
                 rollback_app_manifest(self._app, self._config, before_update_manifest, self._log_file)
                 raise e
 
-            # After all deploy exec
-            execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy',
-                                           clone_path, self._log_file, self._job, self._config)
+            # After all deploy exec, the package is only downloaded on Ghost when there is a script to run
+            if 'after_all_deploy' in module:
+                clone_path = self._local_extract_package(module, package)
+                execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy',
+                                               clone_path, self._log_file, self._job, self._config)
         else:
             raise GCallException("Redeploy on deployment ID: {0} failed".format(deploy_id))
 
@@ -1,4 +1,3 @@
-import time
 import os
 
 from fabric.colors import green as _green, yellow as _yellow, red as _red
@@ -7,6 +6,7 @@ from ghost_tools import get_aws_connection_data, get_app_friendly_name, GCallExc
 from ghost_tools import b64decode_utf8, get_ghost_env_variables, gcall
 from libs import load_balancing
 from libs.deploy import get_path_from_app_with_color
+from libs.tracing import traced_sleep
 from settings import cloud_connections, DEFAULT_PROVIDER
 
 from ghost_aws import check_autoscale_exists, get_autoscaling_group_and_processes_to_suspend
@@ -105,7 +105,7 @@ class Swapbluegreen(object):
         """
         wait_before_swap = int(lb_mgr.get_lbs_max_connection_draining_value(elb_names)) + 1
         log(_green('Waiting {0}s: The ELB connection draining time'.format(wait_before_swap)), self._log_file)
-        time.sleep(wait_before_swap)
+        traced_sleep(wait_before_swap)
 
     def _wait_until_instances_registered(self, lb_mgr, elb_names, timeout):
         """ Wait until each instances become online in the Load Balancer.
@@ -122,7 +122,7 @@ class Swapbluegreen(object):
             if t > timeout:
                 return False
             log(_yellow('Waiting 10s because the instance is not in service in the ELB'), self._log_file)
-            time.sleep(10)
+            traced_sleep(10)
             t += 10
         return True
 
@@ -24,13 +24,19 @@ output.debug = True
 STAGE2_PATH = '/var/lib/ghost/stage2_deploy'
 
 
+def get_stage2_command(app_modules, prefetch=False):
+    """ Returns the stage2 command deploying the modules in a single run, or only prefetching their packages """
+    return '{s} {p}{n}'.format(s=STAGE2_PATH, p='--prefetch ' if prefetch else '',
+                               n=' '.join(app_module['name'] for app_module in app_modules))
+
+
 @task
-def deploy(app_module, ssh_username, key_filename, stage2, log_file):
+def deploy(app_modules, ssh_username, key_filename, stage2, log_file, prefetch=False):
     with settings(show('debug'), warn_only=True, user=ssh_username, key_filename=key_filename):
         sudo('rm -rvf {s}'.format(s=STAGE2_PATH), stdout=log_file)
         sudo('mkdir -p "{w}" && chmod 755 "{w}"'.format(w=os.path.dirname(STAGE2_PATH)), stdout=log_file)
         put(StringIO(stage2), STAGE2_PATH, use_sudo=True, mode=0755)
-        result = sudo('{s} {n}'.format(s=STAGE2_PATH, n=app_module['name']), stdout=log_file)
+        result = sudo(get_stage2_command(app_modules, prefetch), stdout=log_file)
         return result.return_code
 
 
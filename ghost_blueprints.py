@@ -1,12 +1,18 @@
 import pkgutil
 
-from flask import jsonify
-from flask import Blueprint
+from bson.objectid import ObjectId
+from eve.auth import requires_auth
+from flask import abort, jsonify
+from flask import Blueprint, Response
 
 from ghost_tools import config
-from ghost_data import get_app
+from ghost_data import get_app, get_db_connection, get_redis_connection
+from ghost_metrics import render_metrics
+from libs.tracing import to_chrome_trace
 
 commands_blueprint = Blueprint('commands_blueprint', __name__)
+jobs_blueprint = Blueprint('jobs_blueprint', __name__)
+metrics_blueprint = Blueprint('metrics_blueprint', __name__)
 
 
 def _get_commands(app_context=None):
@@ -65,3 +71,25 @@ def list_commands_app_fields_impact(app_id=None):
     """
     app_context = get_app(app_id)
     return jsonify([(name, app_fields) for (name, description, app_fields) in _get_commands(app_context)])
+
+
+@jobs_blueprint.route('/jobs/<regex("[a-f0-9]{24}"):job_id>/trace', methods=['GET'])
+@requires_auth('home')
+def get_job_trace(job_id):
+    """
+    Returns the spans recorded during a job in the Chrome trace event format,
+    to be loaded in chrome://tracing, Perfetto or speedscope
+    """
+    job = get_db_connection().jobs.find_one({'_id': ObjectId(job_id)}, {'trace': 1})
+    if not job:
+        abort(404)
+    return jsonify(to_chrome_trace(job.get('trace') or []))
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+@requires_auth('home')
+def get_metrics():
+    """
+    Returns the queues, workers and jobs metrics in the Prometheus text format
+    """
+    return Response(render_metrics(get_redis_connection()), mimetype='text/plain; version=0.0.4')
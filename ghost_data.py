@@ -3,19 +3,55 @@
 """
 # -*- coding: utf-8 -*-
 
+import os
+import threading
+
 from pymongo import MongoClient
 from bson.objectid import ObjectId
+from redis import ConnectionPool, Redis
 
 from settings import MONGO_DBNAME, MONGO_HOST, MONGO_PORT, REDIS_HOST
 
+# Connections are pooled and shared by the whole process.
+# MongoClient is not fork-safe: a new client is created in forked processes (RQ job processes for instance).
+_connections_lock = threading.Lock()
+_mongo_client = None
+_mongo_client_pid = None
+_redis_connection_pool = None
+
 
 # DB Access
+def get_mongo_client():
+    global _mongo_client, _mongo_client_pid
+    with _connections_lock:
+        if _mongo_client is None or _mongo_client_pid != os.getpid():
+            _mongo_client = MongoClient(host=MONGO_HOST, port=MONGO_PORT, connect=False)
+            _mongo_client_pid = os.getpid()
+        return _mongo_client
+
+
 def get_db_connection():
-    return MongoClient(host=MONGO_HOST, port=MONGO_PORT)[MONGO_DBNAME]
+    return get_mongo_client()[MONGO_DBNAME]
 
 
 def close_db_connection():
-    MongoClient().close()
+    """
+    Closes the pooled connections of the process MongoClient, they are reopened on next use
+    """
+    with _connections_lock:
+        if _mongo_client is not None and _mongo_client_pid == os.getpid():
+            _mongo_client.close()
+
+
+def get_redis_connection():
+    """
+    Returns a Redis client using the connection pool of the process (the pool itself handles forks)
+    """
+    global _redis_connection_pool
+    with _connections_lock:
+        if _redis_connection_pool is None:
+            _redis_connection_pool = ConnectionPool(host=REDIS_HOST)
+    return Redis(connection_pool=_redis_connection_pool)
 
 
 # Data Access
@@ -23,6 +59,4 @@ def get_app(app_id):
     if not app_id:
         return None
     db = get_db_connection()
-    app = db.apps.find_one({'_id': ObjectId(app_id)})
-    close_db_connection()
-    return app
+    return db.apps.find_one({'_id': ObjectId(app_id)})
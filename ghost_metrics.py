@@ -0,0 +1,164 @@
+"""
+    Service metrics of queues, workers and jobs, exposed in the Prometheus text format.
+
+    Jobs run in short-lived forked processes, so counters and histograms are aggregated in Redis hashes
+    (one hash per metric, one field per label set) instead of in process memory.
+    Queue depths and worker states are read from RQ when the metrics are scraped.
+"""
+
+import logging
+
+from redis import RedisError
+from rq import Queue, Worker
+
+METRICS_KEY_PREFIX = 'ghost:metrics:'
+
+# Job durations range from seconds (executescript) to hours (buildimage)
+DURATION_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200]
+WAIT_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600]
+
+METRICS = {
+    'ghost_jobs_enqueued_total': ('counter', 'Jobs enqueued, by command', None),
+    'ghost_jobs_finished_total': ('counter', 'Jobs finished, by command and status', None),
+    'ghost_job_wait_seconds': ('histogram', 'Time jobs spent waiting in their queue, by command', WAIT_BUCKETS),
+    'ghost_job_duration_seconds': ('histogram', 'Duration of jobs, by command and status', DURATION_BUCKETS),
+    'ghost_aws_throttled_requests_total': ('counter', 'AWS API calls throttled, by service and operation', None),
+    'ghost_rq_workers_started_total': ('counter', 'RQ workers started by the RQ workers manager', None),
+    'ghost_rq_workers_deleted_total': ('counter', 'RQ workers deleted by the RQ workers manager', None),
+    'ghost_rq_workers_reconciliations_total': ('counter', 'RQ workers reconciliations, by trigger', None),
+}
+
+AWS_THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'SlowDown',
+                              'TooManyRequestsException', 'RequestThrottled']
+
+
+def format_labels(labels):
+    """
+    Returns labels in the Prometheus text format, sorted by name
+
+    >>> format_labels({'status': 'done', 'command': 'deploy'})
+    'command="deploy",status="done"'
+    >>> print(format_labels({'message': 'a "quoted" value'}))
+    message="a \\"quoted\\" value"
+    >>> format_labels(None)
+    ''
+    """
+    return ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in sorted((labels or {}).items()))
+
+
+def _get_metric_key(name):
+    return METRICS_KEY_PREFIX + name
+
+
+def inc_counter(connection, name, labels=None, value=1):
+    """ Increments a counter, never failing the caller """
+    try:
+        connection.hincrby(_get_metric_key(name), format_labels(labels), value)
+    except RedisError as e:
+        logging.warning("cannot record metric {0}: {1}".format(name, e))
+
+
+def observe_histogram(connection, name, value, labels=None):
+    """ Records an observation in a histogram, never failing the caller """
+    labels_str = format_labels(labels)
+    try:
+        pipeline = connection.pipeline(transaction=False)
+        key = _get_metric_key(name)
+        for bucket in METRICS[name][2]:
+            if value <= bucket:
+                pipeline.hincrby(key, '{0}|{1}'.format(labels_str, bucket), 1)
+        pipeline.hincrby(key, '{0}|+Inf'.format(labels_str), 1)
+        pipeline.hincrbyfloat(key, '{0}|sum'.format(labels_str), value)
+        pipeline.execute()
+    except RedisError as e:
+        logging.warning("cannot record metric {0}: {1}".format(name, e))
+
+
+def _count_boto3_throttling(response, operation, **kwargs):
+    if response and response[1].get('Error', {}).get('Code') in AWS_THROTTLING_ERROR_CODES:
+        # Imported here as the AWS connections are created while loading the settings
+        from ghost_data import get_redis_connection
+        inc_counter(get_redis_connection(), 'ghost_aws_throttled_requests_total',
+                    {'service': operation.service_model.service_name, 'operation': operation.name})
+
+
+def count_boto3_throttling(client):
+    """ Counts the throttled API calls of a boto3 client (boto2 connections are not covered) """
+    client.meta.events.register('needs-retry', _count_boto3_throttling)
+    return client
+
+
+def _format_sample(name, labels_str, value, extra_label=None):
+    if extra_label:
+        labels_str = ','.join(filter(None, [labels_str, extra_label]))
+    return '{0}{1} {2}'.format(name, '{' + labels_str + '}' if labels_str else '', value)
+
+
+def _render_histogram(name, fields):
+    """
+    >>> print('\\n'.join(_render_histogram('ghost_job_wait_seconds', {
+    ...     'command="deploy"|0.1': '1', 'command="deploy"|30': '2', 'command="deploy"|+Inf': '3',
+    ...     'command="deploy"|sum': '42.5'})))
+    ghost_job_wait_seconds_bucket{command="deploy",le="0.1"} 1
+    ghost_job_wait_seconds_bucket{command="deploy",le="0.5"} 1
+    ghost_job_wait_seconds_bucket{command="deploy",le="1"} 1
+    ghost_job_wait_seconds_bucket{command="deploy",le="5"} 1
+    ghost_job_wait_seconds_bucket{command="deploy",le="10"} 1
+    ghost_job_wait_seconds_bucket{command="deploy",le="30"} 2
+    ghost_job_wait_seconds_bucket{command="deploy",le="60"} 2
+    ghost_job_wait_seconds_bucket{command="deploy",le="300"} 2
+    ghost_job_wait_seconds_bucket{command="deploy",le="600"} 2
+    ghost_job_wait_seconds_bucket{command="deploy",le="1800"} 2
+    ghost_job_wait_seconds_bucket{command="deploy",le="3600"} 2
+    ghost_job_wait_seconds_bucket{command="deploy",le="+Inf"} 3
+    ghost_job_wait_seconds_sum{command="deploy"} 42.5
+    ghost_job_wait_seconds_count{command="deploy"} 3
+    """
+    lines = []
+    for labels_str in sorted(set(field.rsplit('|', 1)[0] for field in fields)):
+        # Buckets no observation reached are missing from the hash
+        count = 0
+        for bucket in METRICS[name][2] + ['+Inf']:
+            count = max(count, int(fields.get('{0}|{1}'.format(labels_str, bucket), 0)))
+            lines.append(_format_sample(name + '_bucket', labels_str, count, 'le="{0}"'.format(bucket)))
+        lines.append(_format_sample(name + '_sum', labels_str, fields.get('{0}|sum'.format(labels_str), 0)))
+        lines.append(_format_sample(name + '_count', labels_str, fields.get('{0}|+Inf'.format(labels_str), 0)))
+    return lines
+
+
+def render_metrics(connection):
+    """
+    Returns all the metrics in the Prometheus text exposition format
+    """
+    pipeline = connection.pipeline(transaction=False)
+    names = sorted(METRICS.keys())
+    for name in names:
+        pipeline.hgetall(_get_metric_key(name))
+    recorded_metrics = dict(zip(names, pipeline.execute()))
+
+    lines = []
+    for name in names:
+        metric_type, description, _ = METRICS[name]
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        fields = recorded_metrics[name] or {}
+        if metric_type == 'histogram':
+            lines += _render_histogram(name, fields)
+        else:
+            lines += [_format_sample(name, labels_str, value) for labels_str, value in sorted(fields.items())]
+
+    queues = Queue.all(connection=connection)
+    lines.append('# HELP ghost_rq_queue_jobs Jobs waiting in each RQ queue')
+    lines.append('# TYPE ghost_rq_queue_jobs gauge')
+    lines += [_format_sample('ghost_rq_queue_jobs', format_labels({'queue': queue.name}), queue.count)
+              for queue in sorted(queues, key=lambda q: q.name)]
+
+    workers_states = {}
+    for worker in Worker.all(connection=connection):
+        workers_states[worker.get_state()] = workers_states.get(worker.get_state(), 0) + 1
+    lines.append('# HELP ghost_rq_workers RQ workers, by state (busy workers over all workers is the utilization)')
+    lines.append('# TYPE ghost_rq_workers gauge')
+    lines += [_format_sample('ghost_rq_workers', format_labels({'state': state}), count)
+              for state, count in sorted(workers_states.items())]
+    return '\n'.join(lines) + '\n'
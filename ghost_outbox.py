@@ -0,0 +1,214 @@
+"""
+    Outbox of the side effects of finished jobs: Slack notifications, mail notifications, log upload to S3
+    and purge of the old module packages.
+
+    Jobs only record their side effects in a MongoDB collection, so that their RQ worker is released immediately.
+    A separate low priority consumer process performs them, retrying failed ones with an exponential backoff.
+    Each entry holds a single side effect (one Slack config, one mail recipient...) to be retried independently.
+    Entries reading the local log of a job are bound to the worker host which ran it, the other entries can be
+    processed by the consumer of any host.
+"""
+
+import gzip
+import io
+import logging
+import os
+import socket
+import tempfile
+import traceback
+from datetime import datetime, timedelta
+from time import sleep
+
+from boto3.s3.transfer import TransferConfig
+from pymongo import ReturnDocument
+from sh import tail
+
+from ghost_data import get_db_connection
+from ghost_tools import config, get_job_log_remote_path, get_job_log_parts_remote_prefix
+from libs.manifest import MANIFESTS_COLLECTION
+from libs.package_catalog import purge_packages, S3_DELETE_BATCH_SIZE
+from notification import Notification
+from settings import cloud_connections, DEFAULT_PROVIDER
+
+OUTBOX_COLLECTION = 'job_outbox'
+OUTBOX_MAX_ATTEMPTS = 10
+# Duration in seconds an entry is reserved for the consumer processing it, it is retried afterwards if still there
+OUTBOX_LEASE = 300
+OUTBOX_POLL_INTERVAL = 5
+MAIL_LOG_FROM_DEFAULT = 'no-reply@morea.fr'
+LOG_UPLOAD_PART_SIZE = 16 * 1024 * 1024
+LOG_UPLOAD_CONCURRENCY = 4
+
+
+def get_outbox_retry_delay(attempts):
+    """
+    Returns the delay in seconds before retrying an entry which failed `attempts` times
+
+    >>> [get_outbox_retry_delay(attempts) for attempts in range(1, 6)]
+    [30, 60, 120, 240, 480]
+    >>> get_outbox_retry_delay(10)
+    3600
+    """
+    return min(30 * 2 ** (attempts - 1), 3600)
+
+
+def push_outbox_entries(db, job_id, actions, host=None):
+    """
+    Records the side effects of a job, each action being a (name, payload) couple.
+    Entries with a host are only processed by the consumer of that host.
+    """
+    now = datetime.utcnow()
+    entries = [{
+        'job_id': job_id,
+        'action': action,
+        'payload': payload,
+        'host': host,
+        'attempts': 0,
+        'next_attempt': now,
+        '_created': now,
+    } for action, payload in actions]
+    if entries:
+        db[OUTBOX_COLLECTION].insert_many(entries)
+
+
+def send_slack_notification(payload):
+    slack_conf = dict(payload['slack_conf'], ghost_base_url=config.get('ghost_base_url'))
+    job_log = '[...]\n' + ''.join(tail('-n', '5', payload['log_path']))
+    Notification().send_slack_notification(slack_conf, payload['slack_msg'], payload['app'], payload['job'], job_log)
+
+
+def send_mail_notification(payload):
+    ses_settings = config['ses_settings']
+    notif = Notification(aws_access_key=ses_settings['aws_access_key'],
+                         aws_secret_key=ses_settings['aws_secret_key'], region=ses_settings['region'])
+    log = {
+        'original_log_path': payload['log_path'],
+        'filename': payload['log_filename'],
+    }
+    notif.send_mail(From=ses_settings.get('mail_from', MAIL_LOG_FROM_DEFAULT), To=payload['to'],
+                    subject=payload['subject'], body_text=payload['body'], body_html=payload['html_body'],
+                    attachments=[log])
+
+
+def _list_log_parts(s3_client, bucket, log_id):
+    """
+    Returns the keys of the chunks shipped while the job was running, in order
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return [part['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=get_job_log_parts_remote_prefix(log_id))
+            for part in page.get('Contents', [])]
+
+
+def _write_log_from_parts(s3_client, bucket, part_keys, log_file):
+    for part_key in part_keys:
+        part = s3_client.get_object(Bucket=bucket, Key=part_key)['Body'].read()
+        with gzip.GzipFile(fileobj=io.BytesIO(part), mode='rb') as part_file:
+            log_file.write(part_file.read())
+
+
+def push_log_to_s3(payload):
+    """
+    Uploads the complete log with a multipart upload, then deletes the chunks shipped while the job was running.
+    The log is assembled from the chunks if the local log is not available anymore.
+    """
+    cloud_connection = cloud_connections.get(payload.get('provider') or DEFAULT_PROVIDER)(None)
+    region = config.get('bucket_region', payload['region'])
+    bucket = config['bucket_s3']
+    s3_client = cloud_connection.get_connection(region, ["s3"], boto_version='boto3')
+    transfer_config = TransferConfig(multipart_chunksize=LOG_UPLOAD_PART_SIZE, max_concurrency=LOG_UPLOAD_CONCURRENCY)
+    part_keys = _list_log_parts(s3_client, bucket, payload['log_id'])
+    if os.path.exists(payload['log_path']):
+        s3_client.upload_file(payload['log_path'], bucket, get_job_log_remote_path(payload['log_id']),
+                              Config=transfer_config)
+    elif part_keys:
+        logging.warning("job log {0} not found, assembling it from {1} shipped chunks".format(
+            payload['log_path'], len(part_keys)))
+        with tempfile.TemporaryFile() as log_file:
+            _write_log_from_parts(s3_client, bucket, part_keys, log_file)
+            log_file.seek(0)
+            s3_client.upload_fileobj(log_file, bucket, get_job_log_remote_path(payload['log_id']),
+                                     Config=transfer_config)
+    else:
+        raise IOError("job log {0} not found and no chunk was shipped".format(payload['log_path']))
+
+    for batch_start in range(0, len(part_keys), S3_DELETE_BATCH_SIZE):
+        s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in part_keys[batch_start:batch_start + S3_DELETE_BATCH_SIZE]],
+            'Quiet': True})
+
+
+def purge_module_packages(payload):
+    """
+    Deletes the packages of a module beyond its retention, keeping the package in the MANIFEST and the new ones
+    """
+    db = get_db_connection()
+    manifest = db[MANIFESTS_COLLECTION].find_one({'_id': payload['manifest_key_path']})
+    if manifest is None:
+        logging.warning("Packages purge: MANIFEST {0} not found, keeping all packages of {1}".format(
+            payload['manifest_key_path'], payload['prefix']))
+        return
+    kept_packages = payload['kept_packages'] + [mod['package'] for mod in manifest['modules']
+                                                if mod['name'] == payload['module']]
+    cloud_connection = cloud_connections.get(payload.get('provider') or DEFAULT_PROVIDER)(None)
+    s3_client = cloud_connection.get_connection(config.get('bucket_region', payload['region']), ["s3"],
+                                                boto_version='boto3')
+    deleted_keys = purge_packages(db, s3_client, payload['bucket'], payload['prefix'], payload['retention'],
+                                  kept_packages)
+    logging.info("Packages purge: deleted {0} packages of {1}".format(len(deleted_keys), payload['prefix']))
+
+
+OUTBOX_ACTIONS = {
+    'slack': send_slack_notification,
+    'mail': send_mail_notification,
+    's3_log': push_log_to_s3,
+    'purge_packages': purge_module_packages,
+}
+
+
+def claim_outbox_entry(db, host):
+    """
+    Reserves the next entry to process on this host, if any
+    """
+    now = datetime.utcnow()
+    return db[OUTBOX_COLLECTION].find_one_and_update(
+        {'host': {'$in': [None, host]}, 'next_attempt': {'$lte': now}, 'attempts': {'$lt': OUTBOX_MAX_ATTEMPTS}},
+        {'$set': {'next_attempt': now + timedelta(seconds=OUTBOX_LEASE)}, '$inc': {'attempts': 1}},
+        sort=[('next_attempt', 1)], return_document=ReturnDocument.AFTER)
+
+
+def process_outbox_entry(db, entry):
+    """
+    Performs the action of an entry, deleting it on success or scheduling its next attempt on failure.
+    Entries which failed OUTBOX_MAX_ATTEMPTS times are kept in the collection with their last error.
+    """
+    try:
+        OUTBOX_ACTIONS[entry['action']](entry['payload'])
+    except Exception as e:
+        logging.error("job {0}: '{1}' failed (attempt {2}/{3}): {4}".format(
+            entry['job_id'], entry['action'], entry['attempts'], OUTBOX_MAX_ATTEMPTS, e))
+        traceback.print_exc()
+        db[OUTBOX_COLLECTION].update_one({'_id': entry['_id']}, {'$set': {
+            'next_attempt': datetime.utcnow() + timedelta(seconds=get_outbox_retry_delay(entry['attempts'])),
+            'last_error': str(e),
+        }})
+        return False
+    db[OUTBOX_COLLECTION].delete_one({'_id': entry['_id']})
+    return True
+
+
+def consume_outbox():
+    """
+    Processes outbox entries forever
+    """
+    db = get_db_connection()
+    db[OUTBOX_COLLECTION].create_index([('host', 1), ('next_attempt', 1)])
+    host = socket.gethostname()
+    while True:
+        try:
+            entry = claim_outbox_entry(db, host)
+            if entry:
+                process_outbox_entry(db, entry)
+                continue
+        except:
+            logging.exception("An exception occurred when processing the job outbox.")
+        sleep(OUTBOX_POLL_INTERVAL)
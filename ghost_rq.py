@@ -0,0 +1,199 @@
+"""
+    RQ worker pool sharing a single queue while running at most one job at a time per app (or per env).
+
+    With the `worker_pool` RQ worker strategy, all jobs are pushed to a single queue processed by a fixed
+    number of workers. Each job carries a lock key in its meta data:
+    * a worker dequeuing a job takes the lock before running it,
+    * if the lock is already held by another job, the job is parked in the pending list of the lock
+      so that jobs of the same app keep their order,
+    * when a job terminates, its worker releases the lock and pushes the first pending job back
+      at the front of the queue,
+    * a job cancelled while it is parked is removed from the pending list.
+"""
+
+import json
+import logging
+
+from redis import RedisError
+from rq import Queue, Worker
+from rq.job import Job, JobStatus
+
+from ghost_tools import config, get_app_colored_env, get_rq_name_from_app
+from settings import RQ_JOB_TIMEOUT
+
+RQ_LOCK_KEY_PREFIX = 'ghost:rq:lock:'
+RQ_PENDING_KEY_SUFFIX = ':pending'
+# Keyed locks outlive the job timeout a bit, in case the worker dies without releasing them
+RQ_LOCK_TTL_MARGIN = 300
+
+# Channel on which apps insertions, updates and deletions are notified to the RQ workers manager
+RQ_WORKERS_EVENTS_CHANNEL = 'ghost:rq:workers:events'
+BLUE_GREEN_COLORS = [None, 'blue', 'green']
+
+# A job can take the lock only if nobody holds it and no other job of the same key is waiting for it.
+# Otherwise the job is parked at the end of the pending list (unless it already is its head).
+_ACQUIRE_SCRIPT = """
+local head = redis.call('lindex', KEYS[2], 0)
+if head and head ~= ARGV[1] then
+    redis.call('rpush', KEYS[2], ARGV[1])
+    return 0
+end
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    if head then
+        redis.call('lpop', KEYS[2])
+    end
+    return 1
+end
+if not head then
+    redis.call('rpush', KEYS[2], ARGV[1])
+end
+return 0
+"""
+
+# Releases the lock if still owned by the job and returns the next pending job id
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+return redis.call('lindex', KEYS[2], 0)
+"""
+
+# Removes a job which should not run anymore from the pending list and returns the next pending job id if the lock is free
+_DISCARD_SCRIPT = """
+redis.call('lrem', KEYS[2], 0, ARGV[1])
+if redis.call('exists', KEYS[1]) == 1 then
+    return nil
+end
+return redis.call('lindex', KEYS[2], 0)
+"""
+
+
+def get_rq_lock_key_from_app(app):
+    """
+    Returns the key of the lock serializing the jobs of an app in the RQ worker pool.
+
+    By default, jobs are serialized per app:
+
+    >>> config['rq_worker_pool_lock_scope'] = None
+    >>> get_rq_lock_key_from_app({'env': 'prod', 'name': 'App1', 'role': 'webfront'})
+    'ghost:rq:lock:prod:App1:webfront'
+
+    They can also be serialized per env:
+
+    >>> config['rq_worker_pool_lock_scope'] = 'env'
+    >>> get_rq_lock_key_from_app({'env': 'prod', 'name': 'App1', 'role': 'webfront', 'blue_green': {'color': 'blue'}})
+    'ghost:rq:lock:prod-blue:*:*'
+    >>> del config['rq_worker_pool_lock_scope']
+    """
+    env = get_app_colored_env(app)
+    if config.get('rq_worker_pool_lock_scope') == 'env':
+        return '{prefix}{env}:*:*'.format(prefix=RQ_LOCK_KEY_PREFIX, env=env)
+    return '{prefix}{env}:{name}:{role}'.format(prefix=RQ_LOCK_KEY_PREFIX, env=env, name=app['name'], role=app['role'])
+
+
+def get_rq_job_meta_from_app(app):
+    """
+    Returns the RQ job meta data required by the RQ worker strategy
+
+    >>> config['rq_worker_strategy'] = 'worker_pool'
+    >>> get_rq_job_meta_from_app({'env': 'prod', 'name': 'App1', 'role': 'webfront'})
+    {'lock_key': 'ghost:rq:lock:prod:App1:webfront'}
+    >>> config['rq_worker_strategy'] = None
+    >>> get_rq_job_meta_from_app({'env': 'prod', 'name': 'App1', 'role': 'webfront'})
+    """
+    if config.get('rq_worker_strategy') == 'worker_pool':
+        return {'lock_key': get_rq_lock_key_from_app(app)}
+    return None
+
+
+def publish_app_event(connection, app):
+    """
+    Notifies the RQ workers manager that the RQ workers of an app (any color) must be reconciled.
+    A failure is not fatal: the periodic full reconciliation of the manager will catch up.
+    """
+    try:
+        connection.publish(RQ_WORKERS_EVENTS_CHANNEL,
+                           json.dumps({'env': app['env'], 'name': app['name'], 'role': app['role']}))
+    except RedisError as e:
+        logging.warning("cannot notify the RQ workers manager: {}".format(e))
+
+
+def get_rq_names_from_app_event(app_event):
+    """
+    Returns the RQ names an app event may concern, one per blue/green color
+
+    >>> config['rq_worker_strategy'] = None
+    >>> get_rq_names_from_app_event({'env': 'prod', 'name': 'App1', 'role': 'webfront'})
+    ['prod:App1:webfront', 'prod-blue:App1:webfront', 'prod-green:App1:webfront']
+    """
+    return [get_rq_name_from_app(dict(app_event, blue_green={'color': color})) for color in BLUE_GREEN_COLORS]
+
+
+def _requeue_next_pending_job(connection, queue, lock_key, next_job_id):
+    # Skip jobs cancelled or deleted while they were waiting
+    while next_job_id and not Job.exists(next_job_id, connection=connection):
+        connection.lpop(lock_key + RQ_PENDING_KEY_SUFFIX)
+        next_job_id = connection.lindex(lock_key + RQ_PENDING_KEY_SUFFIX, 0)
+    if next_job_id:
+        queue.push_job_id(next_job_id, at_front=True)
+
+
+def requeue_stalled_pending_jobs(connection, queue):
+    """
+    Requeues the first pending job of every lock which is no longer held.
+    This happens if a worker died while running a job, leaving the pending jobs of its app waiting forever.
+    """
+    for pending_key in connection.scan_iter(match='{}*{}'.format(RQ_LOCK_KEY_PREFIX, RQ_PENDING_KEY_SUFFIX)):
+        lock_key = pending_key[:-len(RQ_PENDING_KEY_SUFFIX)]
+        next_job_id = connection.lindex(pending_key, 0)
+        if next_job_id and not connection.exists(lock_key) and next_job_id not in queue.job_ids:
+            logging.warning("requeuing stalled job {0} waiting for {1}".format(next_job_id, lock_key))
+            _requeue_next_pending_job(connection, queue, lock_key, next_job_id)
+
+
+def cancel_rq_job(connection, job_id):
+    """
+    Cancels a RQ job. A job parked in the pending list of its lock is removed from it, otherwise it would be
+    requeued once the lock is released.
+    """
+    job = Job.fetch(job_id, connection=connection)
+    job.cancel()
+    lock_key = job.meta.get('lock_key')
+    if not lock_key:
+        return
+    keys = [lock_key, lock_key + RQ_PENDING_KEY_SUFFIX]
+    next_job_id = connection.eval(_DISCARD_SCRIPT, len(keys), *(keys + [job.id]))
+    # The cancelled job may have been the one requeued when the lock was released
+    queue = Queue(name=job.origin, connection=connection)
+    if next_job_id and next_job_id not in queue.job_ids:
+        _requeue_next_pending_job(connection, queue, lock_key, next_job_id)
+
+
+class KeyedLockWorker(Worker):
+    """
+    RQ worker running a job only once it holds the lock of its key (its app or its env).
+    """
+
+    def execute_job(self, job, queue):
+        lock_key = job.meta.get('lock_key')
+        if not lock_key:
+            return Worker.execute_job(self, job, queue)
+
+        keys = [lock_key, lock_key + RQ_PENDING_KEY_SUFFIX]
+
+        # A job might have been requeued twice by a worker and `requeue_stalled_pending_jobs`, run it once
+        if job.get_status() != JobStatus.QUEUED:
+            next_job_id = self.connection.eval(_DISCARD_SCRIPT, len(keys), *(keys + [job.id]))
+            _requeue_next_pending_job(self.connection, queue, lock_key, next_job_id)
+            return
+
+        lock_ttl = (job.timeout or RQ_JOB_TIMEOUT) + RQ_LOCK_TTL_MARGIN
+        if not self.connection.eval(_ACQUIRE_SCRIPT, len(keys), *(keys + [job.id, lock_ttl])):
+            self.log.info('{0}: {1} is waiting for {2}'.format(queue.name, job.id, lock_key))
+            return
+
+        try:
+            return Worker.execute_job(self, job, queue)
+        finally:
+            next_job_id = self.connection.eval(_RELEASE_SCRIPT, len(keys), *(keys + [job.id]))
+            _requeue_next_pending_job(self.connection, queue, lock_key, next_job_id)
@@ -11,6 +11,7 @@ from datetime import datetime, timedelta
 from jinja2 import Environment, FileSystemLoader
 
 from ghost_log import log
+from libs.tracing import span
 
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -129,11 +130,12 @@ class GCallException(Exception):
         return repr(self.value)
 
 
-def gcall(args, cmd_description, log_fd, dry_run=False, env=None):
+def gcall(args, cmd_description, log_fd, dry_run=False, env=None, cwd=None):
     log(cmd_description, log_fd)
     log("CMD: {0}".format(args), log_fd)
     if not dry_run:
-        ret = call(args, stdout=log_fd, stderr=log_fd, shell=True, env=env)
+        with span('gcall', description=cmd_description):
+            ret = call(args, stdout=log_fd, stderr=log_fd, shell=True, env=env, cwd=cwd)
         if (ret != 0):
             raise GCallException("ERROR: %s" % cmd_description)
 
@@ -146,6 +148,10 @@ def get_app_colored_env(app):
         return app['env']
 
 
+# Name of the single queue shared by all apps with the `worker_pool` RQ worker strategy
+RQ_WORKER_POOL_QUEUE_NAME = 'pool:*:*'
+
+
 def get_rq_name_from_app(app):
     """
     Returns an RQ name for a given ghost app.
@@ -171,8 +177,16 @@ def get_rq_name_from_app(app):
     >>> config['rq_worker_strategy'] = 'one_worker_for_all'
     >>> get_rq_name_from_app({'env': 'prod', 'name': 'App1', 'role': 'webfront'})
     'default:*:*'
+
+    The last strategy is to share a single queue between a fixed pool of workers:
+
+    >>> config['rq_worker_strategy'] = 'worker_pool'
+    >>> get_rq_name_from_app({'env': 'prod', 'name': 'App1', 'role': 'webfront'})
+    'pool:*:*'
     """
     rq_worker_strategy = config.get('rq_worker_strategy', 'one_worker_per_app')
+    if rq_worker_strategy == 'worker_pool':
+        return RQ_WORKER_POOL_QUEUE_NAME
     env = get_app_colored_env(app)
     name = app['name']
     role = app['role']
@@ -534,6 +548,26 @@ def get_job_log_remote_path(worker_job_id):
     return "{log_dir}/{job_id}.txt".format(log_dir="log/job/", job_id=worker_job_id)
 
 
+def get_job_log_parts_remote_prefix(worker_job_id):
+    """
+    Returns the S3 prefix of the compressed chunks shipped while a job runs
+
+    >>> get_job_log_parts_remote_prefix('e4e8d7ad-ed1b-4f4e-a0f9-1c3c0c4a5a1e')
+    'log/job/e4e8d7ad-ed1b-4f4e-a0f9-1c3c0c4a5a1e.parts/'
+    """
+    return "log/job/{job_id}.parts/".format(job_id=worker_job_id)
+
+
+def get_job_log_part_remote_path(worker_job_id, sequence):
+    """
+    Returns the S3 path of a compressed chunk of a job log, in order when listed
+
+    >>> get_job_log_part_remote_path('e4e8d7ad-ed1b-4f4e-a0f9-1c3c0c4a5a1e', 12)
+    'log/job/e4e8d7ad-ed1b-4f4e-a0f9-1c3c0c4a5a1e.parts/000012.gz'
+    """
+    return "{prefix}{sequence:06d}.gz".format(prefix=get_job_log_parts_remote_prefix(worker_job_id), sequence=sequence)
+
+
 def get_provisioners_config(last_config=None):
     """
     >>> get_provisioners_config(last_config={'dummy': 'dummy'}).keys()
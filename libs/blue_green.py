@@ -1,9 +1,9 @@
 """Library pertaining to blue/green commands."""
 # -*- coding: utf-8 -*-
 
-import sys
 from ghost_log import log
 from ghost_tools import config
+from libs.manifest import get_manifest
 from settings import cloud_connections, DEFAULT_PROVIDER
 
 BLUE_GREEN_COMMANDS = ['preparebluegreen', 'swapbluegreen', 'purgebluegreen']
@@ -100,14 +100,11 @@ def check_app_manifest(app, config, log_file, app_path):
     cloud_connection = cloud_connections.get(app.get('provider', DEFAULT_PROVIDER))(log_file)
     conn = cloud_connection.get_connection(config.get('bucket_region', app['region']), ["s3"])
     bucket = conn.get_bucket(config['bucket_s3'])
-    key = bucket.get_key(key_path)
-    if not key:
+    manifest = get_manifest(bucket, key_path)
+    if not manifest:
         log("ERROR: MANIFEST [{0}] not found.' ".format(key_path), log_file)
         return False
-    manifest = key.get_contents_as_string()
-    if sys.version > '3':
-        manifest = manifest.decode('utf-8')
-    deployed_modules = manifest.strip().split('\n')
+    deployed_modules = manifest['modules']
 
     nb_deployed_modules = len(deployed_modules)
     nb_app_modules = len(app['modules'])
@@ -116,12 +113,11 @@ def check_app_manifest(app, config, log_file, app_path):
             "of deployed modules according to the MANIFEST.' ".format(app['_id']), log_file)
         return False
 
-    for idx, up_module in enumerate(deployed_modules):
-        mod = up_module.strip().split(':')
+    for idx, mod in enumerate(deployed_modules):
         # Deployed and app modules should be same
-        if not mod[0] == app['modules'][idx]['name']:
+        if not mod['name'] == app['modules'][idx]['name']:
             log("ERROR: Deployed module name ({0}) doesn't match "
-                "the configured module name ({1}) ".format(mod[0], app['modules'][idx]['name']), log_file)
+                "the configured module name ({1}) ".format(mod['name'], app['modules'][idx]['name']), log_file)
             return False
 
     return True
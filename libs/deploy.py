@@ -6,22 +6,40 @@
 import io
 import os.path
 from copy import copy
-import sys
 import os
 import tempfile
+from sh import du
 from libs.image_builder_lxd import LXDImageBuilder
 from libs.lxd import lxd_is_available
 from fabric.api import execute as fab_execute
-from fabfile import deploy, executescript
-from ghost_tools import config
+from fabfile import deploy, executescript, get_stage2_command, STAGE2_PATH
+from ghost_tools import config, get_app_colored_env
 from ghost_tools import render_stage2, get_app_module_name_list
 from ghost_tools import b64decode_utf8, get_ghost_env_variables
 from ghost_log import log
 from ghost_tools import GCallException, gcall
 from settings import cloud_connections, DEFAULT_PROVIDER
+from .manifest import get_manifest, publish_manifest, update_manifest
+from .ssh import get_ssh_executor
+from .tracing import span
 
 
-def execute_module_script_on_ghost(app, module, script_name, script_friendly_name, clone_path, log_file, job, config):
+# Version of the module cache content, see `prepare_module_cache`
+MODULE_CACHE_VERSION_FILE = '.ghost-cache-version'
+
+# stage2 exits with this code plus the number of modules switched, when it fails after switching some of them
+STAGE2_DEPLOYED_MODULES_EXIT_CODE = 100
+
+
+class PartialDeployException(GCallException):
+    """ Raised by `launch_deploy` when every host switched the first `deployed_modules` before the failure """
+    def __init__(self, value, deployed_modules):
+        GCallException.__init__(self, value)
+        self.deployed_modules = deployed_modules
+
+
+def execute_module_script_on_ghost(app, module, script_name, script_friendly_name, clone_path, log_file, job, config,
+                                   module_cache_path=None):
     """ Executes the given script on the Ghost instance
 
         :param app: Ghost application
@@ -32,6 +50,7 @@ def execute_module_script_on_ghost(app, module, script_name, script_friendly_nam
         :param log_file: string: Log file path
         :param job: Ghost job
         :param config: Ghost config
+        :param module_cache_path: string: persistent dependency cache directory given to the script, if any
     """
     # Execute script if available
     if script_name in module:
@@ -47,16 +66,19 @@ def execute_module_script_on_ghost(app, module, script_name, script_friendly_nam
 
         script_env = os.environ.copy()
         script_env.update(get_ghost_env_variables(app, module))
+        if module_cache_path:
+            script_env['GHOST_MODULE_CACHE_DIR'] = module_cache_path
 
         if app['build_infos'].get('container_image') and lxd_is_available():
             source_module = get_buildpack_clone_path_from_module(app, module)
             container = LXDImageBuilder(app, job, None, log_file, config)
-            if not container.deploy(script_path, module, source_module):
+            if not container.deploy(script_path, module, source_module, module_cache_path):
                 raise GCallException("ERROR: %s execution on container failed" % script_name)
         else:
-            gcall('bash %s' % script_path, '%s: Execute' % script_friendly_name, log_file, env=script_env)
-        
-        gcall('du -hs .', 'Display current build directory disk usage', log_file)
+            gcall('bash %s' % script_path, '%s: Execute' % script_friendly_name, log_file, env=script_env,
+                  cwd=clone_path)
+
+        gcall('du -hs .', 'Display current build directory disk usage', log_file, cwd=clone_path)
         gcall('rm -vf %s' % script_path, '%s: Done, cleaning temporary file' % script_friendly_name, log_file)
 
 
@@ -112,6 +134,57 @@ def get_intermediate_clone_path_from_module(app, module):
     return '{}/.tmp{}'.format(clone_path[:6], clone_path[6:])
 
 
+def get_module_cache_path_from_module(app, module):
+    """
+    Returns the dependency cache directory of a module. Each color of a blue/green app has its own cache,
+    so that the builds of both colors, which may run concurrently, never empty the cache used by the other one.
+
+    >>> app = {'name': 'AppName', 'env': 'prod', 'role': 'webfront', 'blue_green': {'color': 'blue'}}
+    >>> module = {'name': 'mod1', 'git_repo': 'git@bitbucket.org:morea/ghost.git'}
+    >>> get_module_cache_path_from_module(app, module)
+    '/ghost/.cache/AppName/prod-blue/webfront/mod1'
+    >>> get_module_cache_path_from_module({'name': 'AppName', 'env': 'prod', 'role': 'webfront'}, module)
+    '/ghost/.cache/AppName/prod/webfront/mod1'
+    """
+    return "/ghost/.cache/{name}/{env}/{role}/{module}".format(name=app['name'], env=get_app_colored_env(app),
+                                                               role=app['role'], module=module['name'])
+
+
+def prepare_module_cache(app, module, log_file):
+    """
+    Returns the persistent dependency cache directory of the module, created if missing.
+    The cache is emptied when the `cache_version` of the module changed since it was filled.
+    """
+    cache_path = get_module_cache_path_from_module(app, module)
+    version_path = os.path.join(cache_path, MODULE_CACHE_VERSION_FILE)
+    cache_version = module.get('cache_version', '')
+    if os.path.exists(cache_path):
+        with open(version_path, 'a+') as version_file:
+            version_file.seek(0)
+            previous_cache_version = version_file.read()
+        if previous_cache_version != cache_version:
+            log("Module cache version changed ('{p}' to '{c}'), emptying it".format(p=previous_cache_version,
+                                                                                    c=cache_version), log_file)
+            gcall('rm -rf "{p}"'.format(p=cache_path), 'Removing module cache', log_file)
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+        with open(version_path, 'w') as version_file:
+            version_file.write(cache_version)
+    log("Module cache directory: {p}".format(p=cache_path), log_file)
+    return cache_path
+
+
+def limit_module_cache_size(cache_path, max_size, log_file):
+    """
+    Empties the dependency cache directory of a module when its size in bytes exceeds max_size
+    """
+    size = int(du('-sk', cache_path, _tty_out=False).split()[0]) * 1024
+    if size > max_size:
+        log("Module cache uses {s}MB, over the limit of {m}MB, emptying it".format(
+            s=size / 1024 / 1024, m=max_size / 1024 / 1024), log_file)
+        gcall('rm -rf "{p}"'.format(p=cache_path), 'Removing module cache', log_file)
+
+
 def _get_app_manifest_from_s3(app, config, log_file):
     key_path = get_path_from_app_with_color(app) + '/MANIFEST'
     cloud_connection = cloud_connections.get(app.get('provider', DEFAULT_PROVIDER))(log_file)
@@ -122,6 +195,14 @@ def _get_app_manifest_from_s3(app, config, log_file):
     return key, key_path, bucket
 
 
+def _get_legacy_app_manifest_key_path(app):
+    """
+    >>> _get_legacy_app_manifest_key_path({'name': 'AppName', 'env': 'prod', 'role': 'webfront'})
+    'ghost/AppName/prod/webfront/MANIFEST'
+    """
+    return (get_path_from_app(app) + '/MANIFEST')[1:]
+
+
 def touch_app_manifest(app, config, log_file):
     """
     Creates an empty app MANIFEST if it does not already exist
@@ -129,6 +210,9 @@ def touch_app_manifest(app, config, log_file):
     key, key_path, bucket = _get_app_manifest_from_s3(app, config, log_file)
 
     if key is None:
+        if get_manifest(bucket, key_path, _get_legacy_app_manifest_key_path(app)):
+            publish_manifest(bucket, key_path, log_file)
+            return
         log("No MANIFEST existed for this app, created an empty one at {} to allow instance bootstrapping".format(
             key_path), log_file)
         key = bucket.new_key(key_path)
@@ -138,13 +222,22 @@ def touch_app_manifest(app, config, log_file):
 
 def rollback_app_manifest(app, config, old_manifest, log_file):
     """
-    Restores app manifest data to its previous state
+    Restores the modules updated by `update_app_manifest_modules` to their previous state,
+    unless they were updated again by another job meanwhile
     """
     key, key_path, bucket = _get_app_manifest_from_s3(app, config, log_file)
+    previous_modules = {mod['name']: mod for mod in old_manifest['modules']}
 
-    if old_manifest:
-        key.set_contents_from_string(old_manifest)
-    key.close()
+    def rollback(modules):
+        restored_modules = []
+        for mod in modules:
+            if old_manifest['packages'].get(mod['name']) != mod['package']:
+                restored_modules.append(mod)
+            elif mod['name'] in previous_modules:
+                restored_modules.append(previous_modules[mod['name']])
+        return restored_modules
+
+    update_manifest(bucket, key_path, rollback, log_file, _get_legacy_app_manifest_key_path(app))
 
 
 def update_app_manifest(app, config, module, package, log_file):
@@ -152,53 +245,30 @@ def update_app_manifest(app, config, module, package, log_file):
     Update the app manifest into S3
     and Returns the manifest before update (used in case of rollback)
     """
-    key, key_path, bucket = _get_app_manifest_from_s3(app, config, log_file)
+    return update_app_manifest_modules(app, config, [(module, package)], log_file)
 
-    modules = []
-    module_exist = False
+
+def update_app_manifest_modules(app, config, modules_packages, log_file):
+    """
+    Update the packages of several modules in the app manifest at once
+    and Returns the manifest before update (used in case of rollback)
+
+        :param modules_packages: list: (module, package name) tuples
+    """
+    key, key_path, bucket = _get_app_manifest_from_s3(app, config, log_file)
     all_app_modules_list = get_app_module_name_list(app['modules'])
-    data = ""
-    old_manifest = None
-    if not key:  # if the 'colored' MANIFEST doesn't' exist, maybe the legacy one exists and we should clone it
-        legacy_key_path = get_path_from_app(app) + '/MANIFEST'
-        legacy_key = bucket.get_key(legacy_key_path[1:])
-        if legacy_key:
-            key = legacy_key.copy(bucket, key_path)
-    if key:
-        old_manifest = key.get_contents_as_string()
-        if sys.version > '3':
-            old_manifest = old_manifest.decode('utf-8')
-        for line in old_manifest.split('\n'):
-            if line:
-                mod = {}
-                tmp = line.split(':')
-                mod['name'] = tmp[0]
-                if mod['name'] == module['name']:
-                    mod['package'] = package
-                    mod['path'] = module['path']
-                    module_exist = True
-                else:
-                    mod['package'] = tmp[1]
-                    mod['path'] = tmp[2]
-                # Only keep modules that have not been removed from the app
-                if mod['name'] in all_app_modules_list:
-                    mod['index'] = all_app_modules_list.index(mod['name'])
-                    modules.append(mod)
-    if not key:
-        key = bucket.new_key(key_path)
-    if not module_exist:
-        modules.append({
-            'name': module['name'],
-            'package': package,
-            'path': module['path'],
-            'index': all_app_modules_list.index(module['name'])
-        })
-    for mod in sorted(modules, key=lambda mod: mod['index']):
-        data = data + mod['name'] + ':' + mod['package'] + ':' + mod['path'] + '\n'
+    updated_modules = {module['name']: module for module, package in modules_packages}
 
-    key.set_contents_from_string(data)
-    key.close()
-    return old_manifest
+    def update(modules):
+        # Only keep modules that have not been removed from the app
+        modules = [mod for mod in modules if mod['name'] in all_app_modules_list and mod['name'] not in updated_modules]
+        modules += [{'name': module['name'], 'package': package, 'path': module['path']}
+                    for module, package in modules_packages]
+        return sorted(modules, key=lambda mod: all_app_modules_list.index(mod['name']))
+
+    old_modules, new_modules = update_manifest(bucket, key_path, update, log_file,
+                                               _get_legacy_app_manifest_key_path(app))
+    return {'modules': old_modules, 'packages': {module['name']: package for module, package in modules_packages}}
 
 
 def get_key_path(config, region, account, key_name, log_file):
@@ -353,7 +423,7 @@ def get_key_path(config, region, account, key_name, log_file):
     return key_path
 
 
-def _get_fabric_params(app, fabric_execution_strategy, task, log_file):
+def _get_remote_execution_params(app, fabric_execution_strategy, log_file):
     app_region = app['region']
     app_assumed_account_id = app.get('assumed_account_id', '')
 
@@ -368,6 +438,13 @@ def _get_fabric_params(app, fabric_execution_strategy, task, log_file):
     if fabric_execution_strategy not in ['serial', 'parallel']:
         fabric_execution_strategy = config.get('fabric_execution_strategy', 'serial')
 
+    return app_ssh_username, key_filename, fabric_execution_strategy
+
+
+def _get_fabric_params(app, fabric_execution_strategy, task, log_file):
+    app_ssh_username, key_filename, fabric_execution_strategy = _get_remote_execution_params(
+        app, fabric_execution_strategy, log_file)
+
     if fabric_execution_strategy == 'parallel':
         setattr(task, 'serial', False)
         setattr(task, 'parallel', True)
@@ -387,28 +464,121 @@ def _handle_fabric_errors(result, message):
         raise GCallException("{0} on: {1}".format(message, ", ".join(hosts_error)))
 
 
-def launch_deploy(app, module, hosts_list, fabric_execution_strategy, log_file):
+def _get_deployed_modules_count(result, modules_count):
+    """
+    Returns the number of modules switched by stage2 on every host, the modules being deployed in order.
+
+    >>> _get_deployed_modules_count({'10.0.0.1': 0, '10.0.0.2': 0}, 3)
+    3
+    >>> _get_deployed_modules_count({'10.0.0.1': 0, '10.0.0.2': 102}, 3)
+    2
+    >>> _get_deployed_modules_count({'10.0.0.1': 101, '10.0.0.2': 102}, 3)
+    1
+    >>> _get_deployed_modules_count({'10.0.0.1': 0, '10.0.0.2': 244}, 3)
+    0
+    >>> _get_deployed_modules_count({'10.0.0.1': 101, '10.0.0.2': None}, 3)
+    0
+    """
+    counts = []
+    for ret_code in result.values():
+        if ret_code == 0:
+            counts.append(modules_count)
+        elif ret_code is not None and 0 < ret_code - STAGE2_DEPLOYED_MODULES_EXIT_CODE < modules_count:
+            counts.append(ret_code - STAGE2_DEPLOYED_MODULES_EXIT_CODE)
+        else:
+            counts.append(0)
+    return min(counts) if counts else 0
+
+
+def _use_ssh_executor():
+    """
+    Returns True if remote commands must be run by the pooled SSH executor instead of fabric tasks.
+
+    >>> config['remote_executor'] = 'ssh_pool'
+    >>> _use_ssh_executor()
+    True
+    >>> config['remote_executor'] = 'fabric'
+    >>> _use_ssh_executor()
+    False
+    >>> del config['remote_executor']
+    >>> _use_ssh_executor()
+    False
+    """
+    return config.get('remote_executor', 'fabric') == 'ssh_pool'
+
+
+def _ssh_execute(task, hosts_list, fabric_execution_strategy, log_file, task_args):
+    # The serial strategy still processes hosts one by one, but reuses the job's SSH connections
+    concurrency = 1 if fabric_execution_strategy == 'serial' else None
+    return get_ssh_executor().execute(task, hosts_list, log_file, task_args, concurrency=concurrency)
+
+
+def _ssh_deploy(executor, host, app_modules, ssh_username, key_filename, stage2, log_file, prefetch=False):
+    """ SSH executor counterpart of the `deploy` fabric task """
+    executor.run(host, ssh_username, key_filename, 'rm -rvf {s}'.format(s=STAGE2_PATH), log_file)
+    executor.run(host, ssh_username, key_filename,
+                 'mkdir -p "{w}" && chmod 755 "{w}"'.format(w=os.path.dirname(STAGE2_PATH)), log_file)
+    executor.put(host, ssh_username, key_filename, stage2, STAGE2_PATH, 0755, log_file)
+    return executor.run(host, ssh_username, key_filename, get_stage2_command(app_modules, prefetch), log_file)
+
+
+def _ssh_executescript(executor, host, ssh_username, key_filename, context_path, sudoer_user, jobid, hot_script,
+                       log_file, ghost_env):
+    """ SSH executor counterpart of the `executescript` fabric task """
+    working_dir = '/ghost/{j}'.format(j=jobid)
+    executor.run(host, ssh_username, key_filename, 'mkdir -p "{w}" && chmod 755 "{w}"'.format(w=working_dir), log_file)
+    executor.put(host, ssh_username, key_filename, hot_script, '{w}/ghost-execute-script'.format(w=working_dir), 0755,
+                 log_file)
+    return executor.run(host, ssh_username, key_filename,
+                        'cd "{c}" && {w}/ghost-execute-script'.format(c=context_path, w=working_dir), log_file,
+                        sudo_user=sudoer_user, env=ghost_env)
+
+
+def launch_deploy(app, modules, hosts_list, fabric_execution_strategy, log_file, prefetch=False):
     """ Launch fabric tasks on remote hosts.
 
         :param  app:          dict: Ghost object which describe the application parameters.
-        :param  module:       dict: Ghost object which describe the module parameters.
+        :param  modules:      list: Ghost objects which describe the modules parameters, all deployed by a single
+                              stage2 run on each host.
         :param  hosts_list:   list: Instances private IP.
         :param  fabric_execution_strategy  string: Deployment strategy(serial or parallel).
         :param  log_file:     object for logging.
+        :param  prefetch:     boolean: only download, extract and predeploy the package, without switching the module.
     """
-    # Clone the deploy task function to avoid modifying the original shared instance
-    task = copy(deploy)
-
-    task, app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(app, fabric_execution_strategy,
-                                                                                         task, log_file)
-
     bucket_region = config.get('bucket_region', app['region'])
     stage2 = render_stage2(config, bucket_region)
+    modules_names = ','.join(module['name'] for module in modules)
+
+    if _use_ssh_executor():
+        app_ssh_username, key_filename, fabric_execution_strategy = _get_remote_execution_params(
+            app, fabric_execution_strategy, log_file)
+        log("{} current instances in {}: {}".format('Prefetching on' if prefetch else 'Updating',
+                                                    fabric_execution_strategy, hosts_list), log_file)
+        with span('remote_execution', task='prefetch' if prefetch else 'deploy', executor='ssh_pool',
+                  module=modules_names, hosts=len(hosts_list), strategy=fabric_execution_strategy):
+            result = _ssh_execute(_ssh_deploy, hosts_list, fabric_execution_strategy, log_file,
+                                  (modules, app_ssh_username, key_filename, stage2, log_file, prefetch))
+    else:
+        # Clone the deploy task function to avoid modifying the original shared instance
+        task = copy(deploy)
+
+        task, app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(
+            app, fabric_execution_strategy, task, log_file)
 
-    log("Updating current instances in {}: {}".format(fabric_execution_strategy, hosts_list), log_file)
-    result = fab_execute(task, module, app_ssh_username, key_filename, stage2, log_file, hosts=hosts_list)
+        log("{} current instances in {}: {}".format('Prefetching on' if prefetch else 'Updating',
+                                                    fabric_execution_strategy, hosts_list), log_file)
+        with span('remote_execution', task='prefetch' if prefetch else 'deploy', executor='fabric',
+                  module=modules_names, hosts=len(hosts_list), strategy=fabric_execution_strategy):
+            result = fab_execute(task, modules, app_ssh_username, key_filename, stage2, log_file, prefetch,
+                                 hosts=hosts_list)
 
-    _handle_fabric_errors(result, "Deploy error")
+    try:
+        _handle_fabric_errors(result, "Prefetch error" if prefetch else "Deploy error")
+    except GCallException as e:
+        deployed_modules_count = 0 if prefetch else _get_deployed_modules_count(result, len(modules))
+        if not deployed_modules_count:
+            raise
+        raise PartialDeployException(e.value, modules[:deployed_modules_count])
 
 
 def launch_executescript(app, script, context_path, sudoer_user, jobid, hosts_list, fabric_execution_strategy, log_file,
@@ -425,14 +595,26 @@ def launch_executescript(app, script, context_path, sudoer_user, jobid, hosts_li
         :param  log_file:     object for logging.
         :param  ghost_env:    dict: all Ghost env variables
     """
-    # Clone the executescript task function to avoid modifying the original shared instance
-    task = copy(executescript)
+    if _use_ssh_executor():
+        app_ssh_username, key_filename, fabric_execution_strategy = _get_remote_execution_params(
+            app, fabric_execution_strategy, log_file)
+        log("Updating current instances in {}: {}".format(fabric_execution_strategy, hosts_list), log_file)
+        with span('remote_execution', task='executescript', executor='ssh_pool', hosts=len(hosts_list),
+                  strategy=fabric_execution_strategy):
+            result = _ssh_execute(_ssh_executescript, hosts_list, fabric_execution_strategy, log_file,
+                                  (app_ssh_username, key_filename, context_path, sudoer_user, jobid, script, log_file,
+                                   ghost_env))
+    else:
+        # Clone the executescript task function to avoid modifying the original shared instance
+        task = copy(executescript)
 
-    task, app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(app, fabric_execution_strategy,
-                                                                                         task, log_file)
+        task, app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(
+            app, fabric_execution_strategy, task, log_file)
 
-    log("Updating current instances in {}: {}".format(fabric_execution_strategy, hosts_list), log_file)
-    result = fab_execute(task, app_ssh_username, key_filename, context_path, sudoer_user, jobid, script, log_file,
-                         ghost_env, hosts=hosts_list)
+        log("Updating current instances in {}: {}".format(fabric_execution_strategy, hosts_list), log_file)
+        with span('remote_execution', task='executescript', executor='fabric', hosts=len(hosts_list),
+                  strategy=fabric_execution_strategy):
+            result = fab_execute(task, app_ssh_username, key_filename, context_path, sudoer_user, jobid, script,
+                                 log_file, ghost_env, hosts=hosts_list)
 
     _handle_fabric_errors(result, "Script execution error")
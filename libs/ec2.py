@@ -4,7 +4,6 @@
 """
 
 import os
-import time
 from fabric.colors import green as _green, yellow as _yellow, red as _red
 from jinja2 import Environment, FileSystemLoader
 
@@ -12,6 +11,50 @@ from ghost_log import log
 from ghost_tools import GCallException
 
 from .blue_green import get_blue_green_from_app
+from .tracing import traced_sleep
+
+# Maximum number of instance ids accepted by a single DescribeAutoScalingInstances call
+AUTOSCALING_INSTANCES_BATCH_SIZE = 50
+
+
+def _chunks(items, size):
+    """ Yield successive `size` long slices of the `items` list.
+
+        >>> list(_chunks(['i-1', 'i-2', 'i-3'], 2))
+        [['i-1', 'i-2'], ['i-3']]
+        >>> list(_chunks([], 2))
+        []
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_autoscaling_instances_lifecycle_states(conn_as, instance_ids):
+    """ Return the AutoScaling lifecycle state of the given instances, resolved in batched API calls.
+
+        :param  conn_as: boto3 autoscaling connection
+        :param  instance_ids  list: EC2 instance ids
+        :return dict(ex: {'i-xxx': 'InService', ...}), instances not belonging to an AutoScaling Group are omitted
+
+        >>> from mock import MagicMock
+        >>> conn_as = MagicMock()
+        >>> conn_as.describe_auto_scaling_instances.return_value = {'AutoScalingInstances': [{'InstanceId': 'i-1', 'LifecycleState': 'InService'}]}
+        >>> get_autoscaling_instances_lifecycle_states(conn_as, ['i-1', 'i-2'])
+        {'i-1': 'InService'}
+        >>> get_autoscaling_instances_lifecycle_states(conn_as, [])
+        {}
+        >>> conn_as.describe_auto_scaling_instances.call_count
+        1
+    """
+    states = {}
+    for instance_ids_batch in _chunks(instance_ids, AUTOSCALING_INSTANCES_BATCH_SIZE):
+        autoscale_instances = conn_as.describe_auto_scaling_instances(
+            InstanceIds=instance_ids_batch,
+            MaxRecords=AUTOSCALING_INSTANCES_BATCH_SIZE
+        )['AutoScalingInstances']
+        for autoscale_instance in autoscale_instances:
+            states[autoscale_instance['InstanceId']] = autoscale_instance['LifecycleState']
+    return states
 
 
 def find_ec2_pending_instances(cloud_connection, ghost_app, ghost_env, ghost_role, region, as_group, ghost_color=None):
@@ -39,10 +82,12 @@ def find_ec2_pending_instances(cloud_connection, ghost_app, ghost_env, ghost_rol
             AutoScalingGroupNames=[as_group],
             MaxRecords=1
         )['AutoScalingGroups'][0]['Instances']
-    for autoscale_instance in autoscale_instances:
-        # Instances in autoscale "Pending" state may not have their tags set yet
-        if not autoscale_instance['InstanceId'] in pending_instances_ids and autoscale_instance['LifecycleState'] in ['Pending', 'Pending:Wait', 'Pending:Proceed']:
-            pending_instances.append(conn.get_only_instances(instance_ids=[autoscale_instance['InstanceId']])[0])
+    # Instances in autoscale "Pending" state may not have their tags set yet
+    untagged_pending_instances_ids = [autoscale_instance['InstanceId'] for autoscale_instance in autoscale_instances
+                                      if not autoscale_instance['InstanceId'] in pending_instances_ids and
+                                      autoscale_instance['LifecycleState'] in ['Pending', 'Pending:Wait', 'Pending:Proceed']]
+    if untagged_pending_instances_ids:
+        pending_instances.extend(conn.get_only_instances(instance_ids=untagged_pending_instances_ids))
     hosts = []
     for instance in pending_instances:
         hosts.append({'id': instance.id, 'private_ip_address': instance.private_ip_address})
@@ -81,11 +126,11 @@ def find_ec2_instances(cloud_connection, ghost_app, ghost_env, ghost_role, regio
         instance_filters["instance-state-name"] = ec2_state_filter
 
     found_instances = conn.get_only_instances(filters=instance_filters)
+    lifecycle_states = get_autoscaling_instances_lifecycle_states(conn_as, [instance.id for instance in found_instances])
     hosts = []
     for instance in found_instances:
         # Instances in autoscale "Terminating:*" states are still "running" but no longer in the Load Balancer
-        autoscale_instances = conn_as.describe_auto_scaling_instances(InstanceIds=[instance.id])['AutoScalingInstances']
-        if not autoscale_instances or not autoscale_instances[0]['LifecycleState'] in ['Terminating', 'Terminating:Wait', 'Terminating:Proceed']:
+        if not lifecycle_states.get(instance.id) in ['Terminating', 'Terminating:Wait', 'Terminating:Proceed']:
             hosts.append({'id': instance.id, 'private_ip_address': instance.private_ip_address, 'subnet_id': instance.subnet_id})
     return hosts
 
@@ -280,7 +325,7 @@ def create_ec2_instance(cloud_connection, app, app_color, config, private_ip_add
             # Checking if instance is ready before tagging
             while not instance.state == u'running':
                 log('Instance not running, waiting 10s before tagging.', log_file)
-                time.sleep(10)
+                traced_sleep(10)
                 instance.update()
 
             # Tagging
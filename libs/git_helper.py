@@ -4,45 +4,121 @@
     Library to have common git operations
 """
 
+import errno
+import fcntl
+import json
 import os
+import socket
 import time
+from datetime import datetime
 from ghost_log import log
+from libs.tracing import traced
 from sh import git
 
+# File descriptors of the locks held by the current process, by lock path
+_held_locks = {}
 
+
+def get_lock_holder(lock_path):
+    """
+    Returns the process which holds, or held until it died, the lock of a git repository: its pid, host and
+    the timestamp it acquired the lock at. None if the lock is free.
+
+    >>> import tempfile
+    >>> get_lock_holder(tempfile.mktemp()) is None
+    True
+    """
+    try:
+        with open(lock_path) as lock_file:
+            holder = lock_file.read()
+    except IOError:
+        return None
+    return json.loads(holder) if holder else None
+
+
+def _format_lock_holder(holder):
+    if not holder:
+        return 'another process'
+    return 'process {pid} on {host} since {since}'.format(
+        pid=holder['pid'], host=holder['host'],
+        since=datetime.utcfromtimestamp(holder['since']).strftime('%Y/%m/%d %H:%M:%S GMT'))
+
+
+@traced('git_acquire_lock')
 def git_acquire_lock(lock_path, log_file=None):
     """
-    >>> import os
-    >>> lock_test = '/tmp/lock-test'
+    Blocks until the exclusive lock of a git repository is acquired.
+
+    The lock is a kernel lock (flock) on the lock file: a waiter is woken up as soon as the lock is released,
+    and the kernel releases it if its holder dies. The holder writes its identity in the lock file.
+
+    >>> import tempfile
+    >>> lock_test = tempfile.mktemp()
     >>> git_acquire_lock(lock_test)
-    >>> os.path.exists(lock_test)
+    >>> get_lock_holder(lock_test)['pid'] == os.getpid()
+    True
+    >>> git_release_lock(lock_test)
+    >>> get_lock_holder(lock_test) is None
     True
-    >>> os.rmdir(lock_test)
     """
-    # If the lock directory exists, wait until it disappears before trying to update the mirror
-    while os.path.exists(lock_path):
-        if log_file:
-            log('The git mirror is locked by another process, waiting 5s...', log_file)
-        # time.sleep(secs) https://docs.python.org/2/library/time.html#time.sleep
-        time.sleep(5)
+    if os.path.isdir(lock_path):
+        # Lock directory of the former mkdir based locking, left by a crashed job
+        os.rmdir(lock_path)
+    try:
+        os.makedirs(os.path.dirname(lock_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    # Processes spawned while holding the lock must not keep it after the death of the holder
+    fcntl.fcntl(lock_fd, fcntl.F_SETFD, fcntl.fcntl(lock_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            if log_file:
+                log('The git mirror is locked by {h}, waiting...'.format(
+                    h=_format_lock_holder(get_lock_holder(lock_path))), log_file)
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    except:
+        os.close(lock_fd)
+        raise
+
+    previous_holder = get_lock_holder(lock_path)
+    if previous_holder and log_file:
+        log('Stale git mirror lock released by the kernel: {h} died while holding it'.format(
+            h=_format_lock_holder(previous_holder)), log_file)
+    os.ftruncate(lock_fd, 0)
+    os.write(lock_fd, json.dumps({'pid': os.getpid(), 'host': socket.gethostname(), 'since': time.time()}))
+    _held_locks[lock_path] = lock_fd
     if log_file:
-        log('Locking git mirror local directory with %s' % lock_path, log_file)
-    os.makedirs(lock_path)
+        log('Locking git mirror with %s' % lock_path, log_file)
 
 
 def git_release_lock(lock_path, log_file=None):
     """
+    Releases the lock of a git repository acquired by `git_acquire_lock`, waking up the next waiter
+
     >>> import tempfile
-    >>> temp_dir = tempfile.mkdtemp()
-    >>> git_release_lock(temp_dir)
-    >>> os.path.exists(temp_dir)
-    False
+    >>> lock_test = tempfile.mktemp()
+    >>> git_acquire_lock(lock_test)
+    >>> git_release_lock(lock_test)
+    >>> git_acquire_lock(lock_test)
+    >>> git_release_lock(lock_test)
     """
     if log_file:
         log('Removing git mirror lock (%s)' % lock_path, log_file)
-    os.rmdir(lock_path)
+    lock_fd = _held_locks.pop(lock_path)
+    # The lock file is kept: deleting it would let a waiter and a newcomer lock two different files
+    os.ftruncate(lock_fd, 0)
+    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    os.close(lock_fd)
 
 
+@traced('git_remap_submodule')
 def git_remap_submodule(git_local_repo, submodule_repo, submodule_mirror, log_file):
     """
     Edits the '.gitmodules' file in order to replace the remote git by a local bare mirror
@@ -56,6 +132,7 @@ def git_remap_submodule(git_local_repo, submodule_repo, submodule_mirror, log_fi
         submodule_config.write(filedata)
 
 
+@traced('git_ls_remote_branches_tags')
 def git_ls_remote_branches_tags(git_repo, log_file=None):
     """
     This function trigger the `ls-remote` git command on the remote git repo
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Local git mirrors of the modules repositories, shared by all the jobs of a worker host.
+
+    Deploys only fetch a mirror when the requested revision is not a commit already present in it
+    and the mirror was not fetched recently. Mirror upkeep (fetch, gc, commit-graph) is performed
+    in background by the RQ workers manager, out of the critical path of the deploys.
+"""
+
+import logging
+import os
+import time
+
+from sh import git, ErrorReturnCode
+
+from ghost_log import log
+from ghost_tools import config, gcall, get_lock_path_from_repo
+from libs.git_helper import git_acquire_lock, git_release_lock
+from libs.tracing import traced
+
+MIRRORS_ROOT = '/ghost/.mirrors'
+MIRROR_FETCH_MARKER = 'ghost-last-fetch'
+MIRROR_MAINTENANCE_INTERVAL = 600
+
+
+def _mark_mirror_fetched(mirror_path):
+    with open(os.path.join(mirror_path, MIRROR_FETCH_MARKER), 'a'):
+        os.utime(os.path.join(mirror_path, MIRROR_FETCH_MARKER), None)
+
+
+def get_mirror_last_fetch_age(mirror_path):
+    """
+    Returns the number of seconds since the last fetch of the mirror, None if unknown
+
+    >>> import tempfile
+    >>> mirror_path = tempfile.mkdtemp()
+    >>> get_mirror_last_fetch_age(mirror_path) is None
+    True
+    >>> _mark_mirror_fetched(mirror_path)
+    >>> get_mirror_last_fetch_age(mirror_path) < 5
+    True
+    """
+    try:
+        return time.time() - os.path.getmtime(os.path.join(mirror_path, MIRROR_FETCH_MARKER))
+    except OSError:
+        return None
+
+
+def is_commit_in_mirror(mirror_path, revision):
+    """
+    Returns True if revision is a commit hash, complete or abbreviated, already present in the mirror.
+    Branches and tags are never considered present as they may have moved on the remote.
+
+    >>> current_git_hash = git('--no-pager', 'rev-parse', 'HEAD', _tty_out=False).strip()
+    >>> is_commit_in_mirror('.', current_git_hash[:12])
+    True
+    >>> is_commit_in_mirror('.', 'HEAD')
+    False
+    >>> is_commit_in_mirror('.', 'f' * 40)
+    False
+    """
+    try:
+        resolved_revision = git('--no-pager', 'rev-parse', '--verify', '--quiet', '{0}^{{commit}}'.format(revision),
+                                _tty_out=False, _cwd=mirror_path).strip()
+    except ErrorReturnCode:
+        return False
+    return resolved_revision.startswith(revision)
+
+
+@traced('update_mirror')
+def update_mirror(git_repo, mirror_path, revision, log_file, freshness=0):
+    """
+    Makes sure the local mirror can serve the revision: creates the mirror if missing, then fetches it
+    unless the revision is a commit already present or the mirror was fetched less than `freshness` seconds ago
+    """
+    def is_mirror_usable():
+        if not os.path.exists(mirror_path):
+            return False
+        if is_commit_in_mirror(mirror_path, revision):
+            log('Commit {c} already present in local git mirror, skipping fetch'.format(c=revision), log_file)
+            return True
+        last_fetch_age = get_mirror_last_fetch_age(mirror_path)
+        if last_fetch_age is not None and last_fetch_age < freshness:
+            log('Local git mirror fetched {s}s ago, skipping fetch'.format(s=int(last_fetch_age)), log_file)
+            return True
+        return False
+
+    if is_mirror_usable():
+        return
+
+    lock_path = get_lock_path_from_repo(git_repo)
+    try:
+        git_acquire_lock(lock_path, log_file)
+
+        # Another job may have updated the mirror while this one was waiting for the lock
+        if is_mirror_usable():
+            return
+
+        if not os.path.exists(mirror_path):
+            gcall('git --no-pager clone --bare --mirror {r} {m}'.format(r=git_repo, m=mirror_path),
+                  'Create local git mirror for remote {r}'.format(r=git_repo),
+                  log_file)
+        else:
+            # Garbage collection is left to the mirror maintenance
+            gcall('git --no-pager -c gc.auto=0 fetch --all --tags --prune',
+                  'Update local git mirror from remote {r}'.format(r=git_repo),
+                  log_file, cwd=mirror_path)
+        _mark_mirror_fetched(mirror_path)
+    finally:
+        git_release_lock(lock_path, log_file)
+
+
+def find_mirrors(mirrors_root=MIRRORS_ROOT):
+    """
+    Returns the paths of the bare git mirrors found under mirrors_root, whatever the depth of their remote name
+
+    >>> import tempfile
+    >>> mirrors_root = tempfile.mkdtemp()
+    >>> for repo in ['git@bitbucket.org:morea/ghost.git', 'https://github.com/morea/spaces.git']:
+    ...     _ = git('init', '--bare', '-q', os.path.join(mirrors_root, repo))
+    >>> os.makedirs(os.path.join(mirrors_root, '.locks', 'git@bitbucket.org:morea', 'ghost.git'))
+    >>> [os.path.relpath(path, mirrors_root) for path in find_mirrors(mirrors_root)]
+    ['git@bitbucket.org:morea/ghost.git', 'https:/github.com/morea/spaces.git']
+    """
+    mirrors = []
+    for path, dirs, files in os.walk(mirrors_root):
+        if path == mirrors_root and '.locks' in dirs:
+            dirs.remove('.locks')
+        if 'HEAD' in files and 'objects' in dirs and 'refs' in dirs:
+            mirrors.append(path)
+            del dirs[:]
+    return sorted(mirrors)
+
+
+def maintain_mirror(mirror_path, lock_path):
+    """
+    Fetches the mirror then optimizes its storage, holding the mirror lock
+    """
+    git_acquire_lock(lock_path)
+    try:
+        git('--no-pager', '-c', 'gc.auto=0', 'fetch', '--all', '--tags', '--prune', _tty_out=False, _cwd=mirror_path)
+        _mark_mirror_fetched(mirror_path)
+        git('--no-pager', 'gc', '--auto', _tty_out=False, _cwd=mirror_path)
+        try:
+            # Speeds up the history walks of the clones, requires git >= 2.18
+            git('--no-pager', 'commit-graph', 'write', '--reachable', _tty_out=False, _cwd=mirror_path)
+        except ErrorReturnCode:
+            pass
+    finally:
+        git_release_lock(lock_path)
+
+
+def maintain_mirrors_forever():
+    """
+    Maintains all the local mirrors every `git_mirror_maintenance_interval` seconds
+    """
+    while True:
+        for mirror_path in find_mirrors():
+            try:
+                maintain_mirror(mirror_path, get_lock_path_from_repo(os.path.relpath(mirror_path, MIRRORS_ROOT)))
+                logging.info("maintained git mirror {0}".format(mirror_path))
+            except Exception as e:
+                logging.error("cannot maintain git mirror {0}: {1}".format(mirror_path, e))
+        time.sleep(int(config.get('git_mirror_maintenance_interval', MIRROR_MAINTENANCE_INTERVAL)))
@@ -6,6 +6,9 @@
     The process is:
         * Check that every instances in the Load Balancer(Haproxy or ELB or ALB) are in service and are enough to perform the safe deployment.
         * Split the instances list according the deployment type choosen(1by1-1/3-25%-50%).
+        * If the prefetch option is enabled, download, extract and predeploy the module package on every instance
+          while they are still in service, so that only the module switch and the postdeploy remain to be done
+          out of the Load Balancer.
         * Before begin to deploy on the instances group, remove them from their Load Balancer(Haproxy or ELB)
         * Wait a moment(depends on the connection draining value for the ELB and/or the custom value defines in Ghost)
         * Launch the standard deployment process
@@ -20,7 +23,6 @@
 
 """
 
-import time
 import haproxy
 
 from ghost_tools import GCallException
@@ -31,8 +33,9 @@ from ghost_aws import get_autoscaling_group_and_processes_to_suspend
 from ghost_aws import suspend_autoscaling_group_processes, resume_autoscaling_group_processes
 
 from .blue_green import get_blue_green_from_app
-from .deploy import launch_deploy, launch_executescript
+from .deploy import launch_deploy, launch_executescript, PartialDeployException
 from .ec2 import find_ec2_pending_instances, find_ec2_running_instances
+from .tracing import traced_sleep
 
 
 class HostDeploymentManager:
@@ -41,7 +44,8 @@ class HostDeploymentManager:
     def __init__(self, cloud_connection, app, module, log_file, safe_infos, fabric_exec_strategy, deployment_type=None,
                  execute_script_params=None):
         """
-            :param  module:               dict: Ghost object wich describe the module parameters.
+            :param  module:               dict: Ghost object wich describe the module parameters,
+                                          or list: Ghost objects of all the modules to deploy in a single rollout.
             :param  app:                  dict: Ghost object which describe the application parameters.
             :param  log_file:             object for logging
             :param  safe_infos:           dict: The safe deployment parameters.
@@ -52,6 +56,7 @@ class HostDeploymentManager:
         self._cloud_connection = cloud_connection
         self._app = app
         self._module = module
+        self._modules = module if isinstance(module, list) else [module]
         self._hosts_list = None
         self._log_file = log_file
         self._fabric_exec_strategy = fabric_exec_strategy
@@ -85,20 +90,20 @@ class HostDeploymentManager:
                 self._safe_infos['wait_before_deploy'])
             log('Waiting {0}s: The connection draining time plus the custom value set for wait_before_deploy'.format(
                 wait_before_deploy), self._log_file)
-            time.sleep(wait_before_deploy)
+            traced_sleep(wait_before_deploy)
 
             host_list = [host['private_ip_address'] for host in instances_list]
             self.trigger_launch(host_list)
 
             log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
                 self._log_file)
-            time.sleep(int(self._safe_infos['wait_after_deploy']))
+            traced_sleep(int(self._safe_infos['wait_after_deploy']))
             lb_mgr.register_instances_from_lbs(elb_instances.keys(), [host['id'] for host in instances_list],
                                                self._log_file)
             while len([i for i in lb_mgr.get_instances_status_from_autoscale(self._as_name, self._log_file).values() if
                        'outofservice' in i.values()]):
                 log('Waiting 10s because the instance is not in service in the ELB', self._log_file)
-                time.sleep(10)
+                traced_sleep(10)
             log('Instances: {0} have been deployed and are registered in their ELB'.format(
                 str([host['private_ip_address'] for host in instances_list])), self._log_file)
             return True
@@ -130,21 +135,21 @@ class HostDeploymentManager:
                 self._safe_infos['wait_before_deploy'])
             log('Waiting {0}s: The deregistation delay time plus the custom value set for wait_before_deploy'.format(
                 wait_before_deploy), self._log_file)
-            time.sleep(wait_before_deploy)
+            traced_sleep(wait_before_deploy)
 
             host_list = [host['private_ip_address'] for host in instances_list]
             self.trigger_launch(host_list)
 
             log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
                 self._log_file)
-            time.sleep(int(self._safe_infos['wait_after_deploy']))
+            traced_sleep(int(self._safe_infos['wait_after_deploy']))
             alb_mgr.register_instances_from_lbs(alb_targets.keys(),
                                                 [host['id'] for host in instances_list],
                                                 self._log_file)
             while len([i for i in alb_mgr.get_instances_status_from_autoscale(self._as_name, self._log_file).values() if
                        'unhealthy' in i.values()]):
                 log('Waiting 10s because the instance is unhealthy in the ALB', self._log_file)
-                time.sleep(10)
+                traced_sleep(10)
             log('Instances: {0} have been deployed and are registered in their ALB'.format(
                 str([host['private_ip_address'] for host in instances_list])), self._log_file)
             return True
@@ -185,20 +190,20 @@ class HostDeploymentManager:
                     'Cannot disable some instances: {0} in {1}. Deployment aborted'.format(instances_list, lb_infos))
             log('Waiting {0}s: The value set for wait_before_deploy'.format(self._safe_infos['wait_before_deploy']),
                 self._log_file)
-            time.sleep(int(self._safe_infos['wait_before_deploy']))
+            traced_sleep(int(self._safe_infos['wait_before_deploy']))
 
             host_list = [host['private_ip_address'] for host in instances_list]
             self.trigger_launch(host_list)
 
             log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
                 self._log_file)
-            time.sleep(int(self._safe_infos['wait_after_deploy']))
+            traced_sleep(int(self._safe_infos['wait_after_deploy']))
             if not hapi.change_instance_state('enableserver', self._safe_infos['ha_backend'],
                                               [host['private_ip_address'] for host in instances_list]):
                 raise GCallException(
                     'Cannot enabled some instances: {0} in {1}. Deployment aborted'.format(instances_list, lb_infos))
             # Add a sleep to let the time to pass the health check process
-            time.sleep(5)
+            traced_sleep(5)
             if not self.haproxy_configuration_validation(hapi, ha_urls, self._safe_infos['ha_backend']):
                 raise GCallException('Error in the post safe deployment process because there are differences in the Haproxy \
                                     configuration files between the instances: {0}. Instances: {1} have been deployed but not well enabled'.format(
@@ -223,7 +228,11 @@ class HostDeploymentManager:
                                  host_list, self._fabric_exec_strategy, self._log_file,
                                  self._execute_script_params['env_vars'])
         else:
-            launch_deploy(self._app, self._module, host_list, self._fabric_exec_strategy, self._log_file)
+            launch_deploy(self._app, self._modules, host_list, self._fabric_exec_strategy, self._log_file)
+
+    def trigger_prefetch(self, host_list):
+        """ Prepares the modules packages on the instances, without switching the modules to them """
+        launch_deploy(self._app, self._modules, host_list, self._fabric_exec_strategy, self._log_file, prefetch=True)
 
     def safe_manager(self, safe_strategy):
         """  Global manager for the safe deployment process.
@@ -231,13 +240,20 @@ class HostDeploymentManager:
             :param  safe_strategy: string: The type of safe deployment strategy(1by1-1/3-25%-50%)
             :return True if operation succeed otherwise an Exception will be raised.
         """
-        for host_group in split_hosts_list(self._hosts_list, safe_strategy):
-            if self._safe_infos['load_balancer_type'] == 'elb':
-                self.elb_safe_deployment(host_group)
-            elif self._safe_infos['load_balancer_type'] == 'alb':
-                self.alb_safe_deployment(host_group)
-            else:
-                self.haproxy_safe_deployment(host_group)
+        host_groups = split_hosts_list(self._hosts_list, safe_strategy)
+        for index, host_group in enumerate(host_groups):
+            try:
+                if self._safe_infos['load_balancer_type'] == 'elb':
+                    self.elb_safe_deployment(host_group)
+                elif self._safe_infos['load_balancer_type'] == 'alb':
+                    self.alb_safe_deployment(host_group)
+                else:
+                    self.haproxy_safe_deployment(host_group)
+            except PartialDeployException as e:
+                if index < len(host_groups) - 1:
+                    # The next groups of hosts have not switched any module
+                    raise GCallException(e.value)
+                raise
         return True
 
     def deployment(self, safe_deployment_strategy):
@@ -269,13 +285,15 @@ class HostDeploymentManager:
                 log(
                     "INFO: waiting 10s for {} instance(s) to become running before proceeding with deployment: {}".format(
                         len(pending_instances), pending_instances), self._log_file)
-                time.sleep(10)
+                traced_sleep(10)
             running_instances = find_ec2_running_instances(self._cloud_connection, app_name, app_env, app_role,
                                                            app_region, ghost_color=app_color)
             if running_instances:
                 if safe_deployment_strategy and self._safe_infos:
                     self._as_name = as_group
                     self._hosts_list = running_instances
+                    if self._safe_infos.get('prefetch') and self._deployment_type != 'executescript':
+                        self.trigger_prefetch([host['private_ip_address'] for host in running_instances])
                     return self.safe_manager(safe_deployment_strategy)
                 else:
                     self._hosts_list = [host['private_ip_address'] for host in running_instances]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
 import time
 
@@ -11,6 +12,7 @@ from ghost_tools import gcall, GCallException, get_provisioners_config, get_loca
 from .image_builder import ImageBuilder
 from .provisioner import PROVISIONER_LOCAL_TREE
 from .provisioner_ansible import ANSIBLE_COMMAND, ANSIBLE_LOG_LEVEL_MAP
+from .tracing import traced_sleep
 
 
 class LXDImageBuilder(ImageBuilder):
@@ -25,6 +27,7 @@ class LXDImageBuilder(ImageBuilder):
         self._client = LXDClient()
 
         self._source_hooks_path = ''
+        self._module_cache_path = None
         self._container_name = self._ami_name.replace('.', '-')
         self._container_config = self._config.get('container', {
             'endpoint': self._config.get('endpoint', 'https://lxd.ghost.morea.fr:8443'),
@@ -98,6 +101,9 @@ class LXDImageBuilder(ImageBuilder):
 
         elif self._job['command'] == u"deploy":
             devices['module'] = {'path': module['path'], 'source': source_module, 'type': 'disk'}
+            if self._module_cache_path:
+                devices['module_cache'] = {'path': self._module_cache_path, 'source': self._module_cache_path,
+                                           'type': 'disk'}
 
         else:
             raise Exception("Incompatible command given to LXD Builder")
@@ -113,7 +119,7 @@ class LXDImageBuilder(ImageBuilder):
         self.container = self._client.containers.create(self._create_containers_config(), wait=True)
         log("Created container, starting it", self._log_file)
         self.container.start(wait=True)
-        time.sleep(wait)
+        traced_sleep(wait)
         return self.container
 
     def _delete_containers_profile(self):
@@ -196,10 +202,15 @@ class LXDImageBuilder(ImageBuilder):
         script = os.path.basename(script_path)
         self.container.execute(["sed", "2icd " + module['path'], "-i",
                                 "{module_path}/{script}".format(module_path=module['path'], script=script)])
+        environment = {'GHOST_MODULE_CACHE_DIR': self._module_cache_path} if self._module_cache_path else {}
         buildpack = self.container.execute(["sh", "{module_path}/{script}".format(module_path=module['path'],
-                                                                                  script=script)])
+                                                                                  script=script)],
+                                           environment=environment)
         self._container_log(buildpack)
         self.container.execute(["chown", "-R", "1001:1002", "{module_path}".format(module_path=module['path'])])
+        if self._module_cache_path:
+            # Written by root in the privileged container, the cache must be emptied from the host afterwards
+            self.container.execute(["chown", "-R", "1001:1002", self._module_cache_path])
         self._container_execution_error(buildpack, "buildpack")
 
     @staticmethod
@@ -222,7 +233,11 @@ class LXDImageBuilder(ImageBuilder):
     def set_source_hooks(self, source_hooks_path):
         self._source_hooks_path = source_hooks_path
 
-    def deploy(self, script_path, module, source_module):
+    def deploy(self, script_path, module, source_module, module_cache_path=None):
+        # Modules of the same app may be built concurrently, each one needs its own container
+        self._container_name = '{}-{}'.format(self._container_name, re.sub('[^a-zA-Z0-9-]', '-', module['name']))
+        # Mounted at the same path in the container
+        self._module_cache_path = module_cache_path
         self._create_container(module, source_module)
         self._execute_buildpack(script_path, module)
         self.container.stop(wait=True)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Buffered log file of a job, periodically flushed to disk and shipped to S3 as compressed chunks while the job runs.
+
+    Log lines are kept in memory and written by blocks instead of a system call per line. A background thread flushes
+    them every second, so that the local log can still be followed live, and ships the new part of the log every
+    `ship_interval` seconds, so that it survives the loss of the worker host.
+"""
+
+import gzip
+import io
+import logging
+import os
+import threading
+import time
+
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 1
+
+
+def compress_log_chunk(data):
+    """
+    Returns the gzip compressed data of a log chunk. Chunks can be concatenated into a valid gzip file.
+
+    >>> import zlib
+    >>> zlib.decompress(compress_log_chunk('line 1\\nline 2\\n'), 16 + zlib.MAX_WBITS)
+    'line 1\\nline 2\\n'
+    """
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+        gzip_file.write(data)
+    return compressed.getvalue()
+
+
+class JobLogFile(object):
+    """ File-like object writing a job log, buffered and shipped by chunks """
+
+    encoding = None
+    softspace = 0
+
+    def __init__(self, path, ship_chunk=None, ship_interval=0, buffer_size=LOG_BUFFER_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL):
+        """
+            :param path: string: local path of the log, opened for append
+            :param ship_chunk: function: called with the chunk sequence number and its compressed data
+            :param ship_interval: int: interval in seconds between two shipped chunks, 0 to disable shipping
+        """
+        self.name = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._pid = os.getpid()
+        self._buffer = []
+        self._buffer_size = 0
+        self._max_buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._ship_lock = threading.Lock()
+        self._ship_chunk = ship_chunk if ship_interval else None
+        self._ship_interval = ship_interval
+        self._shipped_offset = os.fstat(self._fd).st_size
+        self._shipped_chunks = 0
+        self._last_ship = time.time()
+        self._flush_interval = flush_interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='job-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def closed(self):
+        return self._fd is None
+
+    def _write_through(self, data):
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if os.getpid() != self._pid:
+            # Forked child (fabric parallel tasks...): the parent writes the inherited buffer, write through
+            self._write_through(data)
+            return
+        with self._lock:
+            self._buffer.append(data)
+            self._buffer_size += len(data)
+            if self._buffer_size >= self._max_buffer_size:
+                self._flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _flush(self):
+        if self._buffer:
+            data, self._buffer, self._buffer_size = ''.join(self._buffer), [], 0
+            self._write_through(data)
+
+    def flush(self):
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            self._flush()
+
+    def fileno(self):
+        # The file descriptor is given to subprocesses, their output must follow what has already been logged
+        self.flush()
+        return self._fd
+
+    def isatty(self):
+        return False
+
+    def ship(self):
+        """ Ships the part of the log written since the last shipped chunk """
+        with self._ship_lock:
+            self._last_ship = time.time()
+            if not self._ship_chunk:
+                return
+            self.flush()
+            with open(self.name, 'rb') as log_file:
+                log_file.seek(self._shipped_offset)
+                data = log_file.read()
+            if not data:
+                return
+            try:
+                self._ship_chunk(self._shipped_chunks, compress_log_chunk(data))
+            except Exception as e:
+                # The chunk will be shipped again with the next one
+                logging.warning("cannot ship log chunk of {0}: {1}".format(self.name, e))
+                return
+            self._shipped_offset += len(data)
+            self._shipped_chunks += 1
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
+            if self._ship_chunk and time.time() - self._last_ship >= self._ship_interval:
+                self.ship()
+
+    def close(self):
+        """ Flushes and ships the remaining log, then closes the file """
+        if self.closed or os.getpid() != self._pid:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        self.ship()
+        os.close(self._fd)
+        self._fd = None
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Versioned app MANIFESTs.
+
+    The source of truth of a MANIFEST is a MongoDB document holding its parsed modules and a version number.
+    Updates are compare-and-swap operations on that version, retried when another job updated the MANIFEST meanwhile,
+    so that modules and apps can be deployed concurrently without losing updates.
+    The `name:package:path` text MANIFEST read by the instances is mirrored to S3 after each update.
+"""
+
+import datetime
+import sys
+
+from pymongo.errors import DuplicateKeyError
+
+from ghost_data import get_db_connection
+from ghost_log import log
+from ghost_tools import GCallException
+
+MANIFESTS_COLLECTION = 'app_manifests'
+MANIFEST_UPDATE_MAX_ATTEMPTS = 10
+
+
+def parse_manifest(data):
+    """
+    Returns the modules of a text MANIFEST
+
+    >>> parse_manifest('mod1:mod1_1500000000.tar.gz:/var/www\\nmod2:mod2_1500000000.tar.gz:/var/lib/mod2\\n')
+    [{'path': '/var/www', 'name': 'mod1', 'package': 'mod1_1500000000.tar.gz'}, \
+{'path': '/var/lib/mod2', 'name': 'mod2', 'package': 'mod2_1500000000.tar.gz'}]
+    >>> parse_manifest('')
+    []
+    """
+    if sys.version > '3' and isinstance(data, bytes):
+        data = data.decode('utf-8')
+    modules = []
+    for line in data.split('\n'):
+        if line.strip():
+            name, package, path = line.strip().split(':', 2)
+            modules.append({'name': name, 'package': package, 'path': path})
+    return modules
+
+
+def format_manifest(modules):
+    """
+    Returns the text MANIFEST of the modules, read by the stage2 script of the instances
+
+    >>> print(format_manifest([{'name': 'mod1', 'package': 'mod1_1500000000.tar.gz', 'path': '/var/www'}]))
+    mod1:mod1_1500000000.tar.gz:/var/www
+    <BLANKLINE>
+    """
+    return ''.join('{0}:{1}:{2}\n'.format(mod['name'], mod['package'], mod['path']) for mod in modules)
+
+
+def get_manifest(bucket, key_path, legacy_key_path=None):
+    """
+    Returns the MANIFEST document ({'_id': key_path, 'version': int, 'modules': list}), imported from the S3 MANIFEST
+    (or the legacy one) on first access. Returns None if the MANIFEST exists nowhere.
+    """
+    collection = get_db_connection()[MANIFESTS_COLLECTION]
+    manifest = collection.find_one({'_id': key_path})
+    if manifest is None:
+        for path in filter(None, [key_path, legacy_key_path]):
+            key = bucket.get_key(path)
+            if key:
+                try:
+                    collection.insert_one({'_id': key_path, 'version': 0,
+                                           'modules': parse_manifest(key.get_contents_as_string()),
+                                           '_updated': datetime.datetime.utcnow()})
+                except DuplicateKeyError:
+                    pass
+                manifest = collection.find_one({'_id': key_path})
+                break
+    return manifest
+
+
+def publish_manifest(bucket, key_path, log_file):
+    """
+    Mirrors the MANIFEST document to S3. The latest version is written again if the MANIFEST was updated meanwhile,
+    so that a slower job never leaves an outdated MANIFEST on S3.
+    """
+    collection = get_db_connection()[MANIFESTS_COLLECTION]
+    manifest = collection.find_one({'_id': key_path})
+    while manifest is not None:
+        key = bucket.new_key(key_path)
+        key.set_contents_from_string(format_manifest(manifest['modules']))
+        key.close()
+        latest = collection.find_one({'_id': key_path}, {'version': 1})
+        if latest['version'] == manifest['version']:
+            log("MANIFEST {k} version {v} published".format(k=key_path, v=manifest['version']), log_file)
+            return
+        manifest = collection.find_one({'_id': key_path})
+
+
+def update_manifest(bucket, key_path, update, log_file, legacy_key_path=None):
+    """
+    Updates the MANIFEST with a compare-and-swap on its version then mirrors it to S3.
+
+        :param update: function returning the new modules from a copy of the current ones,
+                       called again if the MANIFEST was concurrently updated
+        :return: the modules before and after the update
+    """
+    collection = get_db_connection()[MANIFESTS_COLLECTION]
+    for attempt in range(MANIFEST_UPDATE_MAX_ATTEMPTS):
+        manifest = get_manifest(bucket, key_path, legacy_key_path)
+        previous_modules = manifest['modules'] if manifest else []
+        modules = update([dict(mod) for mod in previous_modules])
+        now = datetime.datetime.utcnow()
+        if manifest is None:
+            try:
+                collection.insert_one({'_id': key_path, 'version': 1, 'modules': modules, '_updated': now})
+                updated = True
+            except DuplicateKeyError:
+                updated = False
+        else:
+            updated = collection.update_one({'_id': key_path, 'version': manifest['version']},
+                                            {'$set': {'modules': modules, '_updated': now},
+                                             '$inc': {'version': 1}}).matched_count == 1
+        if updated:
+            publish_manifest(bucket, key_path, log_file)
+            return previous_modules, modules
+        log("MANIFEST {k} was updated by another job meanwhile, retrying".format(k=key_path), log_file)
+    raise GCallException("Cannot update MANIFEST {k}: too many concurrent updates".format(k=key_path))
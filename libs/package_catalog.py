@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Catalog of the module packages uploaded to S3, recorded in MongoDB when they are uploaded.
+
+    The retention of the packages is driven by the catalog instead of listing the bucket, and old packages
+    are deleted with batched multi-object deletes by the job outbox consumer, out of the deploys.
+"""
+
+import datetime
+
+PACKAGES_COLLECTION = 'packages'
+# Modules whose packages uploaded before the catalog existed were imported in it
+PACKAGES_IMPORTS_COLLECTION = 'packages_imports'
+# Maximum number of keys of a S3 DeleteObjects request
+S3_DELETE_BATCH_SIZE = 1000
+# Suffix of the metadata shipped beside a package reused from the build cache, applied by the instances
+PACKAGE_METADATA_SUFFIX = '.ghost-metadata'
+
+
+def get_package_timestamp(pkg_name):
+    """
+    Returns the build timestamp of a package from its name, None if the name doesn't have one
+
+    >>> get_package_timestamp('1500000000_mod1_abcdef1')
+    1500000000
+    >>> get_package_timestamp('MANIFEST') is None
+    True
+    """
+    try:
+        return int(pkg_name.split('_', 1)[0])
+    except ValueError:
+        return None
+
+
+def record_package(db, bucket, prefix, pkg_name, app_id, module_name):
+    """
+    Records a package uploaded in s3://bucket/prefix/pkg_name
+    """
+    key = '{p}/{n}'.format(p=prefix, n=pkg_name)
+    db[PACKAGES_COLLECTION].update_one({'bucket': bucket, 'key': key}, {'$set': {
+        'bucket': bucket,
+        'key': key,
+        'prefix': prefix,
+        'package': pkg_name,
+        'ts': get_package_timestamp(pkg_name),
+        'app_id': app_id,
+        'module': module_name,
+        '_created': datetime.datetime.utcnow(),
+    }}, upsert=True)
+
+
+def import_packages(db, s3_client, bucket, prefix):
+    """
+    Records the packages uploaded in s3://bucket/prefix/ before the catalog existed, once per module
+    """
+    if db[PACKAGES_IMPORTS_COLLECTION].find_one({'_id': '{b}/{p}'.format(b=bucket, p=prefix)}):
+        return
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix + '/', Delimiter='/'):
+        for obj in page.get('Contents', []):
+            pkg_name = obj['Key'].rsplit('/', 1)[-1]
+            if get_package_timestamp(pkg_name) is not None and not pkg_name.endswith(PACKAGE_METADATA_SUFFIX):
+                record_package(db, bucket, prefix, pkg_name, None, None)
+    db[PACKAGES_IMPORTS_COLLECTION].insert_one({'_id': '{b}/{p}'.format(b=bucket, p=prefix),
+                                                '_created': datetime.datetime.utcnow()})
+
+
+def find_packages_to_purge(db, bucket, prefix, retention, kept_packages):
+    """
+    Returns the packages of s3://bucket/prefix/ beyond the `retention` most recent ones, never returning kept_packages
+    """
+    packages = db[PACKAGES_COLLECTION].find({'bucket': bucket, 'prefix': prefix, 'package': {'$nin': kept_packages}},
+                                            {'key': 1, 'package': 1}).sort([('ts', -1), ('package', -1)])
+    return list(packages.skip(retention))
+
+
+def purge_packages(db, s3_client, bucket, prefix, retention, kept_packages):
+    """
+    Deletes the packages beyond the retention, along with their metadata if any, with batched multi-object deletes,
+    then removes them from the catalog. Returns the keys deleted.
+    """
+    db[PACKAGES_COLLECTION].create_index([('bucket', 1), ('prefix', 1), ('ts', -1)])
+    import_packages(db, s3_client, bucket, prefix)
+    keys = [package['key'] for package in find_packages_to_purge(db, bucket, prefix, retention, kept_packages)]
+    deleted_keys = []
+    # Each package takes two keys of a request
+    batch_size = S3_DELETE_BATCH_SIZE // 2
+    for batch_start in range(0, len(keys), batch_size):
+        batch = keys[batch_start:batch_start + batch_size]
+        response = s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key + suffix} for key in batch for suffix in ['', PACKAGE_METADATA_SUFFIX]],
+            'Quiet': True})
+        # Quiet mode only reports the failed deletions, they are retried by the next purge
+        failed_keys = set(error['Key'] for error in response.get('Errors', []))
+        deleted_keys += [key for key in batch if key not in failed_keys]
+    if deleted_keys:
+        db[PACKAGES_COLLECTION].delete_many({'bucket': bucket, 'key': {'$in': deleted_keys}})
+    return deleted_keys
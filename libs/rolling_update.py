@@ -4,7 +4,6 @@
     The Rolling update library aims to create a sweet way to destroy EC2 instances and let the AutoScale renew them smoothly.
 """
 
-import time
 from fabric.colors import green as _green, yellow as _yellow, red as _red
 
 from ghost_tools import GCallException, log, split_hosts_list
@@ -14,6 +13,7 @@ from libs import load_balancing
 from .blue_green import get_blue_green_from_app
 from .ec2 import find_ec2_running_instances, destroy_specific_ec2_instances
 from .autoscaling import get_autoscaling_group_object, update_auto_scaling_group_attributes, check_autoscale_instances_lifecycle_state
+from .tracing import traced_sleep
 
 class RollingUpdate():
     """ Class which will manage the safe destroy process """
@@ -77,21 +77,21 @@ class RollingUpdate():
                 lb_mgr.deregister_instances_from_lbs(elb_instances.keys(), [host['id'] for host in instances_list], self.log_file)
                 wait_con_draining = int(lb_mgr.get_lbs_max_connection_draining_value(elb_instances.keys()))
                 log('Waiting {0}s: The connection draining time'.format(wait_con_draining), self.log_file)
-                time.sleep(wait_con_draining)
+                traced_sleep(wait_con_draining)
 
                 asg_updated_infos = get_autoscaling_group_object(as_conn, self.as_name)
                 while len(asg_updated_infos['Instances']) < asg_updated_infos['DesiredCapacity']:
                     log('Waiting 30s because the instance(s) are not provisioned in the AutoScale', self.log_file)
-                    time.sleep(30)
+                    traced_sleep(30)
                     asg_updated_infos = get_autoscaling_group_object(as_conn, self.as_name)
                 while not check_autoscale_instances_lifecycle_state(asg_updated_infos['Instances']):
                     log('Waiting 30s because the instance(s) are not in InService state in the AutoScale', self.log_file)
-                    time.sleep(30)
+                    traced_sleep(30)
                     asg_updated_infos = get_autoscaling_group_object(as_conn, self.as_name)
 
                 while len([i for i in lb_mgr.get_instances_status_from_autoscale(self.as_name, self.log_file).values() if 'outofservice' in i.values()]):
                     log('Waiting 10s because the instance(s) are not in service in the ELB', self.log_file)
-                    time.sleep(10)
+                    traced_sleep(10)
 
                 suspend_autoscaling_group_processes(as_conn, self.as_name, ['Launch', 'Terminate'], self.log_file)
                 log(_green('Restore initial AutoScale attributes and destroy old instances for this group (%s)' % str([host['id'] for host in instances_list])), self.log_file)
@@ -102,7 +102,7 @@ class RollingUpdate():
                 asg_updated_infos = get_autoscaling_group_object(as_conn, self.as_name)
                 while len(asg_updated_infos['Instances']) > asg_updated_infos['DesiredCapacity']:
                     log('Waiting 20s because the old instance(s) are not removed from the AutoScale', self.log_file)
-                    time.sleep(20)
+                    traced_sleep(20)
                     asg_updated_infos = get_autoscaling_group_object(as_conn, self.as_name)
 
                 update_auto_scaling_group_attributes(as_conn, self.as_name, asg_infos['MinSize'], asg_infos['MaxSize'], asg_infos['DesiredCapacity'], original_termination_policies)
@@ -127,5 +127,5 @@ class RollingUpdate():
             else:
                 raise GCallException('Load balancer type not supported for Rolling update option')
             log('Waiting 10s before going on next instance group', self.log_file)
-            time.sleep(10)
+            traced_sleep(10)
         return True
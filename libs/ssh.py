@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to run commands on remote hosts through SSH connections kept open for the whole job.
+
+    Connections are opened on first use and reused by every module, every safe deployment group
+    and every command of the current job, then closed at the end of the job.
+    Hosts are processed by a bounded pool of threads instead of one forked process per host.
+"""
+
+import os
+import pipes
+import socket
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import paramiko
+
+from ghost_log import log
+from ghost_tools import config
+from .tracing import span
+
+SSH_CONNECTION_ATTEMPTS = 10
+SSH_CONNECTION_TIMEOUT = 30
+SSH_DEFAULT_CONCURRENCY = 10
+
+
+def get_sudo_command(command, sudo_user=None, env=None):
+    """
+    Returns the shell command running `command` through sudo in a login shell, like fabric's `sudo`.
+
+    >>> get_sudo_command('ls /ghost')
+    "sudo -S -H -- /bin/bash -l -c 'ls /ghost'"
+    >>> get_sudo_command('ls /ghost', sudo_user='1001')
+    "sudo -S -H -u 1001 -- /bin/bash -l -c 'ls /ghost'"
+
+    Environment variables values are passed as is, whatever the characters they contain:
+
+    >>> print(get_sudo_command('ls "$GHOST_APP"', env={'GHOST_APP': 'my app'}))
+    sudo -S -H -- /bin/bash -l -c 'export GHOST_APP='"'"'my app'"'"' && ls "$GHOST_APP"'
+    >>> print(get_sudo_command('echo "$PRICE"', env={'PRICE': '$HOME `id` "10"'}))
+    sudo -S -H -- /bin/bash -l -c 'export PRICE='"'"'$HOME `id` "10"'"'"' && echo "$PRICE"'
+    >>> 'Orl\\xc3\\xa9ans' in get_sudo_command(u'echo "$CITY"', env={'CITY': u'Orl\\xe9ans'})
+    True
+    """
+    if env:
+        exports = ' '.join('{0}={1}'.format(key, pipes.quote(_to_shell_str(value)))
+                           for key, value in sorted(env.items()))
+        command = 'export {0} && {1}'.format(exports, _to_shell_str(command))
+    sudo_user_option = '-u {0} '.format(pipes.quote(_to_shell_str(sudo_user))) if sudo_user else ''
+    return 'sudo -S -H {0}-- /bin/bash -l -c {1}'.format(sudo_user_option, pipes.quote(_to_shell_str(command)))
+
+
+def _to_shell_str(value):
+    """
+    Returns the value as a UTF-8 encoded string, the encoding of the remote shells
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class SSHExecutor:
+    """ Runs commands on remote hosts using pooled SSH connections """
+
+    def __init__(self, concurrency=None):
+        """
+            :param concurrency: int: maximum number of hosts processed at the same time
+        """
+        self._concurrency = concurrency or config.get('remote_executor_concurrency', SSH_DEFAULT_CONCURRENCY)
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._ssh_config = None
+        if config.get('use_ssh_config', False):
+            ssh_config_path = os.path.expanduser('~/.ssh/config')
+            if os.path.isfile(ssh_config_path):
+                self._ssh_config = paramiko.SSHConfig()
+                with open(ssh_config_path) as ssh_config_file:
+                    self._ssh_config.parse(ssh_config_file)
+
+    def _connect(self, host, username, key_filename):
+        connect_params = {
+            'hostname': host,
+            'username': username,
+            'key_filename': key_filename or None,
+            'timeout': SSH_CONNECTION_TIMEOUT,
+            'banner_timeout': SSH_CONNECTION_TIMEOUT,
+            'allow_agent': True,
+            'look_for_keys': not key_filename,
+        }
+        if self._ssh_config:
+            host_config = self._ssh_config.lookup(host)
+            connect_params['hostname'] = host_config.get('hostname', host)
+            if 'port' in host_config:
+                connect_params['port'] = int(host_config['port'])
+            if 'proxycommand' in host_config:
+                connect_params['sock'] = paramiko.ProxyCommand(host_config['proxycommand'])
+
+        client = paramiko.SSHClient()
+        # Instances are short-lived and their host keys are unknown, like fabric's `disable_known_hosts`
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        for attempt in range(1, SSH_CONNECTION_ATTEMPTS + 1):
+            try:
+                client.connect(**connect_params)
+                return client
+            except (socket.error, paramiko.SSHException):
+                if attempt == SSH_CONNECTION_ATTEMPTS:
+                    raise
+                time.sleep(1)
+
+    def get_client(self, host, username, key_filename):
+        """ Returns an open SSH connection to the host, reusing the existing one if still alive """
+        client_key = (host, username, key_filename)
+        with self._lock:
+            client = self._clients.get(client_key)
+        transport = client.get_transport() if client else None
+        if not transport or not transport.is_active():
+            if client:
+                client.close()
+            client = self._connect(host, username, key_filename)
+            with self._lock:
+                self._clients[client_key] = client
+        return client
+
+    def run(self, host, username, key_filename, command, log_file, sudo_user=None, env=None):
+        """
+        Runs the command as root (or `sudo_user`) on the host and streams its output in the log file.
+        Returns the command exit code.
+        """
+        sudo_command = get_sudo_command(command, sudo_user, env)
+        log("[{0}] sudo: {1}".format(host, command), log_file)
+        with span('ssh', host=host):
+            return self._run(host, username, key_filename, sudo_command, log_file)
+
+    def _run(self, host, username, key_filename, sudo_command, log_file):
+        channel = self.get_client(host, username, key_filename).get_transport().open_session()
+        try:
+            # A pseudo terminal is required by sudo on some distributions and merges stderr into stdout
+            channel.get_pty()
+            channel.exec_command(sudo_command)
+            pending = ''
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                lines = (pending + data).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    log("[{0}] out: {1}".format(host, line.rstrip('\r')), log_file)
+            if pending:
+                log("[{0}] out: {1}".format(host, pending.rstrip('\r')), log_file)
+            return channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    def put(self, host, username, key_filename, contents, remote_path, mode, log_file):
+        """
+        Uploads `contents` to `remote_path` on the host as root with the given mode.
+        Returns the exit code of the final move.
+        """
+        log("[{0}] put: <string> -> {1}".format(host, remote_path), log_file)
+        tmp_path = '/tmp/ghost-{0}'.format(uuid.uuid4().hex)
+        sftp = self.get_client(host, username, key_filename).open_sftp()
+        try:
+            with sftp.open(tmp_path, 'w') as remote_file:
+                remote_file.write(contents)
+        finally:
+            sftp.close()
+        return self.run(host, username, key_filename, 'chmod {m:o} "{t}" && chown root: "{t}" && mv -f "{t}" "{p}"'.format(
+            m=mode, t=tmp_path, p=remote_path), log_file)
+
+    def execute(self, task, hosts, log_file, task_args=(), concurrency=None):
+        """
+        Runs `task(executor, host, *task_args)` on every host, at most `concurrency` hosts at the same time.
+        Returns the task result per host, None being returned for hosts where the task raised an error.
+        """
+        def _run_task(host):
+            try:
+                return host, task(self, host, *task_args)
+            except Exception as e:
+                log("[{0}] Error: {1}".format(host, e), log_file)
+                return host, None
+
+        if not hosts:
+            return {}
+        pool = ThreadPool(min(concurrency or self._concurrency, len(hosts)))
+        try:
+            return dict(pool.map(_run_task, hosts, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        """ Closes all the pooled connections """
+        with self._lock:
+            clients, self._clients = self._clients.values(), {}
+        for client in clients:
+            client.close()
+
+
+_executor = None
+_executor_pid = None
+
+
+def get_ssh_executor():
+    """ Returns the SSH executor shared by the whole job (the current process) """
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = SSHExecutor()
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def close_ssh_executor():
+    """ Closes the connections of the job SSH executor, if any """
+    global _executor
+    if _executor is not None and _executor_pid == os.getpid():
+        _executor.close()
+    _executor = None
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Span tracing of jobs: phases, subprocesses, git commands, AWS API calls, remote executions and wait loops.
+
+    Spans are recorded in memory by the job process then stored with the job document (`trace` field),
+    each span referencing its parent, and can be exported in the Chrome trace event format
+    (chrome://tracing, Perfetto, speedscope...).
+"""
+
+import itertools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Keeps the job document far from the MongoDB document size limit
+MAX_SPANS = 20000
+
+
+class Tracer(object):
+    """ Records the spans of the current job """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._pid = os.getpid()
+        self.spans = []
+        self.dropped_spans = 0
+        self.root_span_id = None
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start_span(self, name, attributes=None, leaf=False):
+        """ Starts a span, child of the current one. Leaf spans can't have children and may never be ended. """
+        stack = self._get_stack()
+        span = {
+            'id': next(self._ids),
+            # Spans of other threads (build pools, SSH executor) are attached to the root span
+            'parent_id': stack[-1]['id'] if stack else self.root_span_id,
+            'name': name,
+            'start': time.time(),
+            'duration': None,
+            'thread': threading.current_thread().name,
+            'attributes': attributes or {},
+        }
+        if not leaf:
+            stack.append(span)
+        return span
+
+    def end_span(self, span, error=None):
+        span['duration'] = time.time() - span['start']
+        if error is not None:
+            span['error'] = error
+        stack = self._get_stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        with self._lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped_spans += 1
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """ Returns the tracer of the current process, forked processes getting a new one """
+    global _tracer
+    if _tracer._pid != os.getpid():
+        _tracer = Tracer()
+    return _tracer
+
+
+def start_tracing():
+    """ Resets the tracer for a new job """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Records the execution of the enclosed block as a span
+
+    >>> tracer = start_tracing()
+    >>> with span('deploy', module='mod1'):
+    ...     with span('gcall', description='Buildpack: Execute'):
+    ...         pass
+    >>> [(s['name'], s['parent_id'], s['attributes']) for s in tracer.spans]
+    [('gcall', 1, {'description': 'Buildpack: Execute'}), ('deploy', None, {'module': 'mod1'})]
+    """
+    tracer = get_tracer()
+    current_span = tracer.start_span(name, attributes)
+    try:
+        yield current_span
+    except BaseException as e:
+        tracer.end_span(current_span, error='{0}: {1}'.format(type(e).__name__, e))
+        raise
+    tracer.end_span(current_span)
+
+
+def traced(name):
+    """ Decorator recording each call of the decorated function as a span """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_sleep(seconds):
+    """ Sleeps like `time.sleep`, recording the wait as a span named after the calling function """
+    caller = sys._getframe(1)
+    with span('sleep', seconds=seconds, caller='{0}:{1}'.format(caller.f_code.co_name, caller.f_lineno)):
+        time.sleep(seconds)
+
+
+def get_trace():
+    """
+    Returns the spans recorded for the current job, in start order
+
+    >>> tracer = start_tracing()
+    >>> with span('job'):
+    ...     with span('phase'):
+    ...         pass
+    >>> [s['name'] for s in get_trace()]
+    ['job', 'phase']
+    """
+    return sorted(get_tracer().spans, key=lambda s: (s['start'], s['id']))
+
+
+def to_chrome_trace(spans):
+    """
+    Returns the spans in the Chrome trace event format, with microsecond timestamps
+
+    >>> events = to_chrome_trace([{'id': 1, 'parent_id': None, 'name': 'job', 'start': 10.0, 'duration': 2.5,
+    ...                            'thread': 'MainThread', 'attributes': {'command': 'deploy'}}])['traceEvents']
+    >>> sorted(events[0].items())
+    [('args', {'command': 'deploy'}), ('cat', 'ghost'), ('dur', 2500000), ('name', 'job'), ('ph', 'X'), ('pid', 1), ('tid', 'MainThread'), ('ts', 10000000)]
+    """
+    events = []
+    for s in spans:
+        args = dict(s.get('attributes') or {})
+        if s.get('error'):
+            args['error'] = s['error']
+        events.append({
+            'name': s['name'],
+            'cat': 'ghost',
+            'ph': 'X',
+            'ts': int(round(s['start'] * 1000000)),
+            'dur': int(round((s['duration'] or 0) * 1000000)),
+            'pid': 1,
+            'tid': s.get('thread'),
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _trace_boto3_call_start(context, model, **kwargs):
+    # Failed calls never reach `after-call`, their span is just not recorded
+    context['ghost_span'] = get_tracer().start_span('aws', {
+        'service': model.service_model.service_name, 'operation': model.name}, leaf=True)
+
+
+def _trace_boto3_call_end(context, http_response, parsed, model, **kwargs):
+    current_span = context.pop('ghost_span', None)
+    if current_span:
+        current_span['attributes']['status'] = getattr(http_response, 'status_code', None)
+        get_tracer().end_span(current_span)
+
+
+def trace_boto3_client(client):
+    """ Records a span for each API call of a boto3 client """
+    client.meta.events.register('before-call', _trace_boto3_call_start)
+    client.meta.events.register('after-call', _trace_boto3_call_end)
+    return client
+
+
+def trace_boto2_connection(connection, service):
+    """ Records a span for each API request of a boto2 connection """
+    make_request = connection.make_request
+
+    @wraps(make_request)
+    def traced_make_request(*args, **kwargs):
+        with span('aws', service=service, operation=str(args[0]) if args else kwargs.get('action', kwargs.get('method'))):
+            return make_request(*args, **kwargs)
+    connection.make_request = traced_make_request
+    return connection
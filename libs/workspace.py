@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Persistent module workspaces: the git checkout of a module is kept between deploys and updated in place
+    from the local git mirror, instead of being removed and cloned again.
+
+    Workspaces are cleaned deterministically (`git clean -ffdx`) before each build, and the least recently used ones
+    are removed when their total size exceeds a quota. The size of each workspace is recorded after its builds,
+    so that checking the quota does not measure every workspace.
+"""
+
+import os
+import time
+
+from sh import git, du, ErrorReturnCode
+
+from ghost_log import log
+from ghost_tools import GCallException, gcall
+from libs.tracing import traced
+
+WORKSPACES_ROOT = '/ghost'
+# Last use (modification time) and size of a workspace, kept in its git metadata so that it is never packaged
+# with the module
+WORKSPACE_LAST_USE_MARKER = '.git/ghost-last-use'
+# Workspaces are located at <root>/<app>/<env>/<role>[/<color>]/<module>
+WORKSPACES_MAX_DEPTH = 5
+
+
+def _touch_workspace(workspace_path):
+    with open(os.path.join(workspace_path, WORKSPACE_LAST_USE_MARKER), 'a'):
+        os.utime(os.path.join(workspace_path, WORKSPACE_LAST_USE_MARKER), None)
+
+
+def _remove_workspace(workspace_path, log_file):
+    gcall('chmod -R u+rwx {p}'.format(p=workspace_path), 'Update rights on previous workspace', log_file)
+    gcall('rm -rf {p}'.format(p=workspace_path), 'Removing previous workspace', log_file)
+
+
+def _get_checkout_args(workspace_path, revision, is_commit_hash):
+    """
+    Returns the `git checkout` arguments for the revision: branches are checked out as local branches,
+    like a `git clone -b` does, commits and tags as a detached HEAD
+    """
+    if not is_commit_hash:
+        try:
+            git('--no-pager', 'rev-parse', '--verify', '--quiet', 'refs/remotes/origin/{r}'.format(r=revision),
+                _tty_out=False, _cwd=workspace_path)
+            return '-B {r} origin/{r}'.format(r=revision)
+        except ErrorReturnCode:
+            pass
+    return '--detach {r}'.format(r=revision)
+
+
+def _update_workspace(mirror_path, workspace_path, revision, is_commit_hash, log_file):
+    if not os.path.exists(os.path.join(workspace_path, '.git')):
+        if os.path.exists(workspace_path):
+            _remove_workspace(workspace_path, log_file)
+        os.makedirs(workspace_path)
+        gcall('git --no-pager clone --no-checkout file://{m} .'.format(m=mirror_path),
+              'Git clone from local mirror into persistent workspace', log_file, cwd=workspace_path)
+    else:
+        # The origin of the previous build was reset to the remote repository
+        gcall('git --no-pager remote set-url origin file://{m}'.format(m=mirror_path),
+              'Git set local mirror as origin of persistent workspace', log_file, cwd=workspace_path)
+        gcall("git --no-pager -c gc.auto=0 fetch --prune origin '+refs/heads/*:refs/remotes/origin/*' "
+              "'+refs/tags/*:refs/tags/*'",
+              'Git fetch new commits from local mirror into persistent workspace', log_file, cwd=workspace_path)
+
+    gcall('git --no-pager checkout -f {a}'.format(a=_get_checkout_args(workspace_path, revision, is_commit_hash)),
+          'Git checkout revision into persistent workspace: {r}'.format(r=revision), log_file, cwd=workspace_path)
+    gcall('git --no-pager clean -ffdx', 'Git clean persistent workspace', log_file, cwd=workspace_path)
+    gcall('git --no-pager submodule sync --recursive', 'Git sync submodules', log_file, cwd=workspace_path)
+    gcall('git --no-pager submodule update --init --recursive --force', 'Git update submodules', log_file,
+          cwd=workspace_path)
+    gcall('git --no-pager submodule foreach --recursive git clean -ffdx', 'Git clean submodules', log_file,
+          cwd=workspace_path)
+
+
+@traced('update_workspace')
+def update_workspace(mirror_path, workspace_path, revision, is_commit_hash, log_file):
+    """
+    Updates the persistent workspace of a module to the revision, creating it from the local mirror if missing.
+    A workspace which can't be updated in place is cloned again.
+    """
+    try:
+        _update_workspace(mirror_path, workspace_path, revision, is_commit_hash, log_file)
+    except GCallException as e:
+        log('Persistent workspace {p} cannot be updated ({e}), cloning it again'.format(p=workspace_path, e=e),
+            log_file)
+        _remove_workspace(workspace_path, log_file)
+        _update_workspace(mirror_path, workspace_path, revision, is_commit_hash, log_file)
+    _touch_workspace(workspace_path)
+
+
+def find_workspaces(workspaces_root=WORKSPACES_ROOT):
+    """
+    Returns the persistent workspaces found under workspaces_root with their last use timestamp,
+    least recently used first
+
+    >>> import tempfile
+    >>> workspaces_root = tempfile.mkdtemp()
+    >>> for path in ['App1/prod/webfront/mod1', 'App1/prod/webfront/blue/mod1', '.tmp/App1/prod/webfront/mod1']:
+    ...     os.makedirs(os.path.join(workspaces_root, path, '.git'))
+    ...     _touch_workspace(os.path.join(workspaces_root, path))
+    >>> os.makedirs(os.path.join(workspaces_root, 'App1/prod/webfront/mod2/.git'))
+    >>> os.utime(os.path.join(workspaces_root, 'App1/prod/webfront/mod1', WORKSPACE_LAST_USE_MARKER), (0, 0))
+    >>> [os.path.relpath(path, workspaces_root) for path, last_use in find_workspaces(workspaces_root)]
+    ['App1/prod/webfront/mod1', 'App1/prod/webfront/blue/mod1']
+    """
+    workspaces = []
+    for path, dirs, files in os.walk(workspaces_root):
+        # Skip the mirrors, the intermediate clones and the git metadata of the workspaces
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if os.path.relpath(path, workspaces_root).count(os.sep) >= WORKSPACES_MAX_DEPTH - 1:
+            del dirs[:]
+        marker = os.path.join(path, WORKSPACE_LAST_USE_MARKER)
+        if os.path.exists(marker):
+            workspaces.append((path, os.path.getmtime(marker)))
+            del dirs[:]
+    return sorted(workspaces, key=lambda workspace: workspace[1])
+
+
+def _get_size(path):
+    return int(du('-sk', path, _tty_out=False).split()[0]) * 1024
+
+
+def _write_workspace_size(workspace_path, size):
+    marker = os.path.join(workspace_path, WORKSPACE_LAST_USE_MARKER)
+    last_use = os.path.getmtime(marker)
+    with open(marker, 'w') as f:
+        f.write(str(size))
+    os.utime(marker, (last_use, last_use))
+
+
+def record_workspace_size(workspace_path):
+    """
+    Records the current size of the workspace along with its last use, once its build is over
+    """
+    _write_workspace_size(workspace_path, _get_size(workspace_path))
+
+
+def get_workspace_size(workspace_path):
+    """
+    Returns the recorded size of the workspace, measured only if it was never recorded
+
+    >>> import tempfile
+    >>> workspace_path = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(workspace_path, '.git'))
+    >>> _touch_workspace(workspace_path)
+    >>> _write_workspace_size(workspace_path, 2048)
+    >>> _touch_workspace(workspace_path)
+    >>> get_workspace_size(workspace_path)
+    2048
+    """
+    with open(os.path.join(workspace_path, WORKSPACE_LAST_USE_MARKER)) as f:
+        size = f.read().strip()
+    if size.isdigit():
+        return int(size)
+    size = _get_size(workspace_path)
+    _write_workspace_size(workspace_path, size)
+    return size
+
+
+def evict_workspaces(quota, min_idle, log_file, workspaces_root=WORKSPACES_ROOT):
+    """
+    Removes the least recently used persistent workspaces until their total size is under the quota (in bytes).
+    Workspaces used less than `min_idle` seconds ago may belong to a running job and are kept.
+    """
+    workspaces = [(path, last_use, get_workspace_size(path)) for path, last_use in find_workspaces(workspaces_root)]
+    total_size = sum(size for path, last_use, size in workspaces)
+    for path, last_use, size in workspaces:
+        if total_size <= quota:
+            break
+        if time.time() - last_use < min_idle:
+            continue
+        log('Persistent workspaces use {t}MB, over the quota of {q}MB: evicting {p}'.format(
+            t=total_size / 1024 / 1024, q=quota / 1024 / 1024, p=path), log_file)
+        _remove_workspace(path, log_file)
+        total_size -= size
@@ -150,6 +150,7 @@ apps_schema = {
                 'pre_deploy': {'type': 'string'},
                 'post_deploy': {'type': 'string'},
                 'after_all_deploy': {'type': 'string'},
+                'cache_version': {'type': 'string'},
                 'path': {'type': 'string',
                          'regex': '^(/[a-zA-Z0-9\.\-\_]+)+$',
                          'required': True},
@@ -187,6 +188,7 @@ apps_schema = {
             'load_balancer_type' : {'type': 'string'},
             'wait_after_deploy' : {'type': 'integer', 'min': 0},
             'wait_before_deploy' : {'type': 'integer', 'min': 0},
+            'prefetch': {'type': 'boolean', 'required': False},
             'app_tag_value': {'type': 'string', 'required': False},
             'ha_backend': {'type': 'string', 'required': False},
             'api_port': {'type': 'integer', 'required': False}
@@ -10,8 +10,7 @@ from auth import BCryptAuth
 from bson.objectid import ObjectId
 import json
 
-from redis import Redis
-from rq import Queue, cancel_job
+from rq import Queue
 import rq_dashboard
 
 from settings import __dict__ as eve_settings, REDIS_HOST, RQ_JOB_TIMEOUT
@@ -20,8 +19,11 @@ from models.apps import apps
 from models.jobs import jobs, CANCELLABLE_JOB_STATUSES, DELETABLE_JOB_STATUSES
 from models.deployments import deployments
 
+from ghost_data import get_redis_connection
+from ghost_metrics import inc_counter
+from ghost_rq import cancel_rq_job, get_rq_job_meta_from_app, publish_app_event
 from ghost_tools import get_rq_name_from_app, boolify
-from ghost_blueprints import commands_blueprint
+from ghost_blueprints import commands_blueprint, jobs_blueprint, metrics_blueprint
 from ghost_api import ghost_api_bluegreen_is_enabled, ghost_api_enable_green_app
 from ghost_api import ghost_api_delete_alter_ego_app, ghost_api_clean_bluegreen_app
 from ghost_api import initialize_app_modules, check_and_set_app_fields_state
@@ -44,6 +46,11 @@ def get_deployments_db():
     return ghost.data.driver.db[deployments['datasource']['source']]
 
 
+# Index used to find the last deployment of each app module
+DEPLOYMENTS_LAST_DEPLOYMENT_INDEX = [('app_id', 1), ('module', 1), ('timestamp', -1)]
+_deployments_index_created = False
+
+
 def pre_update_app(updates, original):
     """
     eve pre-update event hook to reset modified modules' 'initialized' field.
@@ -154,6 +161,12 @@ def post_update_app(updates, original):
         print e
         abort(500)
 
+    # The RQ workers of both the original and the updated apps may have to be created or deleted
+    publish_app_event(ghost.ghost_redis_connection, original)
+    updated = dict(original, **updates)
+    if get_rq_name_from_app(updated) != get_rq_name_from_app(original):
+        publish_app_event(ghost.ghost_redis_connection, updated)
+
 
 def pre_replace_app(item, original):
     # TODO: implement (or not?) application replacement
@@ -168,6 +181,7 @@ def pre_delete_app(item):
 def post_delete_app(item):
     if not ghost_api_delete_alter_ego_app(get_apps_db(), item):
         abort(422, description="Cannot delete the associated blue-green application")
+    publish_app_event(ghost.ghost_redis_connection, item)
 
 
 def pre_insert_app(items):
@@ -208,21 +222,40 @@ def post_insert_app(items):
     if ghost_api_bluegreen_is_enabled(app):
         if not ghost_api_enable_green_app(get_apps_db(), app, request.authorization.username):
             abort(422, "Problem occured creating/enabling the green app")
+    publish_app_event(ghost.ghost_redis_connection, app)
 
 
-def _post_fetched_app(app, embed_last_deployment=False):
+def _get_last_deployments(apps, embed_last_deployment=False):
+    """
+    Returns the last deployment (or its id) of every module of the given apps, indexed by (app_id, module name).
+    Each module is resolved with a point lookup on the last deployment index, which only reads its latest deployment
+    whatever the size of the deployments history.
+    """
+    global _deployments_index_created
+    if not _deployments_index_created:
+        get_deployments_db().create_index(DEPLOYMENTS_LAST_DEPLOYMENT_INDEX, name='last_deployment')
+        _deployments_index_created = True
+
+    last_deployments = {}
+    for app in apps:
+        for module in app.get('modules', []):
+            deployment = next(get_deployments_db().find({'app_id': app['_id'], 'module': module['name']},
+                                                        projection=None if embed_last_deployment else ['_id'],
+                                                        sort=DEPLOYMENTS_LAST_DEPLOYMENT_INDEX, limit=1), None)
+            if deployment:
+                last_deployments[(app['_id'], module['name'])] = (deployment if embed_last_deployment
+                                                                  else deployment['_id'])
+    return last_deployments
+
+
+def _post_fetched_app(app, embed_last_deployment=False, last_deployments=None):
     # Retrieve each module's last deployment
+    if last_deployments is None:
+        last_deployments = _get_last_deployments([app], embed_last_deployment)
     for module in app.get('modules', []):
-        query = {
-            '$and': [
-                {'app_id': app['_id']},
-                {'module': module['name']}
-            ]
-        }
-        sort = [('timestamp', -1)]
-        deployment = get_deployments_db().find_one(query, sort=sort)
+        deployment = last_deployments.get((app['_id'], module['name']))
         if deployment:
-            module['last_deployment'] = deployment if embed_last_deployment else deployment['_id']
+            module['last_deployment'] = deployment
 
 
 def post_fetched_apps(response):
@@ -230,8 +263,9 @@ def post_fetched_apps(response):
     embedded = json.loads(request.args.get('embedded', '{}'))
     embed_last_deployment = boolify(embedded.get('modules.last_deployment', False))
 
+    last_deployments = _get_last_deployments(response['_items'], embed_last_deployment)
     for app in response['_items']:
-        _post_fetched_app(app, embed_last_deployment)
+        _post_fetched_app(app, embed_last_deployment, last_deployments)
 
 
 def post_fetched_app(response):
@@ -268,6 +302,16 @@ def pre_insert_job(items):
     job['message'] = 'Initializing job'
 
 
+def get_rq_queue(rq_name):
+    """
+    Returns the RQ queue with the given name, queues are created once and share the API Redis connection pool
+    """
+    if rq_name not in _rq_queues:
+        _rq_queues[rq_name] = Queue(name=rq_name, connection=ghost.ghost_redis_connection,
+                                    default_timeout=RQ_JOB_TIMEOUT)
+    return _rq_queues[rq_name]
+
+
 def post_insert_job(items):
     job = items[0]
     job_id = str(job.get('_id'))
@@ -276,9 +320,10 @@ def post_insert_job(items):
     app = get_apps_db().find_one({'_id': ObjectId(app_id)})
 
     # Place job in app's queue
-    rq_job = Queue(name=get_rq_name_from_app(app), connection=ghost.ghost_redis_connection,
-                   default_timeout=RQ_JOB_TIMEOUT).enqueue(Command().execute, job_id, job_id=job_id)
+    rq_job = get_rq_queue(get_rq_name_from_app(app)).enqueue(Command().execute, job_id, job_id=job_id,
+                                                             meta=get_rq_job_meta_from_app(app))
     assert rq_job.id == job_id
+    inc_counter(ghost.ghost_redis_connection, 'ghost_jobs_enqueued_total', {'command': job['command']})
 
 
 def pre_delete_job(item):
@@ -293,7 +338,7 @@ def pre_delete_job_enqueueings():
 
     if job and job['status'] in CANCELLABLE_JOB_STATUSES:
         # Cancel the job from RQ
-        cancel_job(job_id, connection=ghost.ghost_redis_connection)
+        cancel_rq_job(ghost.ghost_redis_connection, job_id)
         get_jobs_db().update({'_id': ObjectId(job_id)},
                              {'$set': {'status': 'cancelled', 'message': 'Job cancelled', '_updated': datetime.now()}})
         return
@@ -328,10 +373,13 @@ ghost.on_inserted_jobs += post_insert_job
 ghost.on_delete_item_jobs += pre_delete_job
 ghost.on_delete_resource_job_enqueueings += pre_delete_job_enqueueings
 
-ghost.ghost_redis_connection = Redis(host=REDIS_HOST)
+ghost.ghost_redis_connection = get_redis_connection()
+_rq_queues = {}
 
 # Register non-mongodb resources as plain Flask blueprints (they won't appear in /docs)
 ghost.register_blueprint(commands_blueprint)
+ghost.register_blueprint(jobs_blueprint)
+ghost.register_blueprint(metrics_blueprint)
 ghost.register_blueprint(lxd_blueprint)
 
 if __name__ == '__main__':
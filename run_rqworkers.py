@@ -1,25 +1,44 @@
 from multiprocessing import Process, active_children
 from setproctitle import setproctitle
-from time import sleep
+from time import sleep, time
+import json
+import os
 import signal
 import sys
 import traceback
 
-from redis import Redis
 from rq import Queue, Worker
 
-from pymongo import MongoClient
-
 import logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
 
-from settings import MONGO_DBNAME, MONGO_HOST, MONGO_PORT, REDIS_HOST, RQ_JOB_TIMEOUT
+from settings import RQ_JOB_TIMEOUT
 
+from command import preload_commands
+from ghost_data import get_db_connection, get_redis_connection
+from ghost_metrics import inc_counter
+from ghost_outbox import consume_outbox
+from libs.git_mirror import maintain_mirrors_forever, MIRROR_MAINTENANCE_INTERVAL
+from ghost_rq import KeyedLockWorker, requeue_stalled_pending_jobs
+from ghost_rq import RQ_WORKERS_EVENTS_CHANNEL, get_rq_names_from_app_event
 from ghost_tools import config, get_rq_name_from_app, get_app_from_rq_name, get_app_colored_env
+from ghost_tools import RQ_WORKER_POOL_QUEUE_NAME
+
+# Apps fields required to compute the RQ worker name of an app
+APPS_RQ_WORKER_PROJECTION = {'env': 1, 'name': 1, 'role': 1, 'blue_green.color': 1}
+# Apps events trigger the RQ workers reconciliation, a full reconciliation is only a safety net
+RQ_WORKERS_FULL_SCAN_INTERVAL = 600
+# Pause after a failed reconciliation, so that a persistent failure does not hammer MongoDB and Redis
+RQ_WORKERS_FAILURE_BACKOFF = 60
+# The job outbox consumer and the git mirrors maintenance must not slow down the jobs
+BACKGROUND_PROCESS_NICENESS = 10
 
-def create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection):
-    ghost_rq_queues[rqworker_name] = Queue(name=rqworker_name, connection=ghost_redis_connection, default_timeout=RQ_JOB_TIMEOUT)
-    worker = Worker(name=rqworker_name, queues=[ghost_rq_queues[rqworker_name]], connection=ghost_redis_connection)
+def create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection,
+                               queue_name=None, worker_class=Worker):
+    queue_name = queue_name or rqworker_name
+    if queue_name not in ghost_rq_queues:
+        ghost_rq_queues[queue_name] = Queue(name=queue_name, connection=ghost_redis_connection, default_timeout=RQ_JOB_TIMEOUT)
+    worker = worker_class(name=rqworker_name, queues=[ghost_rq_queues[queue_name]], connection=ghost_redis_connection)
 
     def start_worker(worker, rqworker_name):
         setproctitle('rqworker-{}'.format(rqworker_name))
@@ -28,8 +47,56 @@ def create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers,
     # Fork a dedicated RQ worker process
     ghost_rq_workers[rqworker_name] = Process(target=start_worker, args=[worker, rqworker_name])
     ghost_rq_workers[rqworker_name].start()
+    inc_counter(ghost_redis_connection, 'ghost_rq_workers_started_total')
     logging.info('Started rqworker {0}'.format(rqworker_name))
 
+def restart_dead_rq_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection,
+                           queue_name=None, worker_class=Worker):
+    logging.warning("restarting a dead rqworker: {}".format(rqworker_name))
+    del ghost_rq_workers[rqworker_name]
+    # A killed worker could not register its death, its new process could not register with the same name
+    stale_rqworker = Worker.find_by_key(Worker.redis_worker_namespace_prefix + rqworker_name,
+                                        connection=ghost_redis_connection)
+    if stale_rqworker:
+        stale_rqworker.register_death()
+    create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection,
+                               queue_name=queue_name, worker_class=worker_class)
+
+def restart_dead_rq_workers(ghost_rq_queues, ghost_rq_workers, ghost_redis_connection):
+    """
+    Restarts the RQ workers of the apps whose child process died
+    """
+    for rqworker_name, rqworker in ghost_rq_workers.items():
+        if not rqworker.is_alive():
+            restart_dead_rq_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
+
+def manage_background_process(ghost_processes, name, target):
+    """
+    Starts a niced background process, or restarts it if it died
+    """
+    process = ghost_processes.get(name)
+    if process and process.is_alive():
+        return
+    if process:
+        logging.warning("restarting a dead background process: {}".format(name))
+
+    def start_background_process():
+        setproctitle('ghost-{}'.format(name))
+        os.nice(BACKGROUND_PROCESS_NICENESS)
+        target()
+
+    ghost_processes[name] = Process(target=start_background_process)
+    ghost_processes[name].start()
+    logging.info('Started background process {0}'.format(name))
+
+def manage_background_processes(ghost_processes):
+    """
+    Keeps the job outbox consumer and the git mirrors maintenance running
+    """
+    manage_background_process(ghost_processes, 'outbox', consume_outbox)
+    if int(config.get('git_mirror_maintenance_interval', MIRROR_MAINTENANCE_INTERVAL)):
+        manage_background_process(ghost_processes, 'mirrors', maintain_mirrors_forever)
+
 def delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers):
     queue = ghost_rq_queues[rqworker_name]
     queue.empty()
@@ -40,18 +107,132 @@ def delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers)
     # Terminate the RQ worker with a TERM signal to perform a warm shutdown
     ghost_rq_workers[rqworker_name].terminate()
     del ghost_rq_workers[rqworker_name]
+    inc_counter(queue.connection, 'ghost_rq_workers_deleted_total')
     logging.info('Killed rqworker {0}'.format(rqworker_name))
 
+def manage_rq_worker_pool(ghost_rq_queues, ghost_rq_workers, ghost_redis_connection):
+    """
+    Keeps `rq_worker_pool_size` workers processing the single queue shared by all apps,
+    restarting the workers which died
+    """
+    for index in range(1, int(config.get('rq_worker_pool_size', 4)) + 1):
+        rqworker_name = 'pool-{}'.format(index)
+        rqworker = ghost_rq_workers.get(rqworker_name)
+        if rqworker and not rqworker.is_alive():
+            restart_dead_rq_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection,
+                                   queue_name=RQ_WORKER_POOL_QUEUE_NAME, worker_class=KeyedLockWorker)
+        elif not rqworker:
+            create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection,
+                                       queue_name=RQ_WORKER_POOL_QUEUE_NAME, worker_class=KeyedLockWorker)
+
+    requeue_stalled_pending_jobs(ghost_redis_connection, ghost_rq_queues[RQ_WORKER_POOL_QUEUE_NAME])
+
+
+def check_rq_workers(ghost_rq_workers, ghost_redis_connection):
+    """
+    Verifies that the active workers from Redis' point of view match the child processes
+    """
+    active_rqworkers = Worker.all(connection=ghost_redis_connection)
+
+    # Verify that active workers match child processes
+    for rqworker in active_rqworkers:
+        rqworker_name = rqworker.name
+        logging.debug("found an active rqworker: {}".format(rqworker_name))
+        if not ghost_rq_workers.has_key(rqworker_name):
+            raise Exception("an active worker does not match a child process: {}".format(rqworker_name))
+
+    # Verify that child processes match active workers
+    for rqworker_name, rqworker in ghost_rq_workers.items():
+        logging.debug("found a child process: {}".format(rqworker_name))
+        if not ghost_rq_workers.has_key(rqworker_name):
+            raise Exception("a child process does not match an active rqworker: {}".format(rqworker_name))
+        if not rqworker.is_alive():
+            raise Exception("a child process is not alive: {}".format(rqworker_name))
+
+
+def refresh_rq_workers(apps_db, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection):
+    """
+    Full reconciliation of the RQ workers with all the existing apps, a safety net for missed app events
+    """
+    restart_dead_rq_workers(ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
+    check_rq_workers(ghost_rq_workers, ghost_redis_connection)
+    inc_counter(ghost_redis_connection, 'ghost_rq_workers_reconciliations_total', {'trigger': 'full_scan'})
+
+    # Get existing apps from MongoDB, only the fields identifying their RQ worker
+    apps = [app for app in apps_db.find({}, APPS_RQ_WORKER_PROJECTION)]
+
+    # Check that each app has an active worker
+    for app in apps:
+        rqworker_name = get_rq_name_from_app(app)
+        if not ghost_rq_workers.has_key(rqworker_name):
+            create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
+
+    # Check that each worker corresponds to an existing app
+    for rqworker_name, rqworker in ghost_rq_workers.items():
+        found = False
+        rqworker_app = get_app_from_rq_name(rqworker_name)
+
+        if rqworker_app['env'] != '*' and rqworker_app['role'] != '*':
+            for app in apps:
+                env = get_app_colored_env(app)
+                if env == rqworker_app['env'] and app['name'] == rqworker_app['name'] and app['role'] == rqworker_app['role']:
+                    found = True
+            if not found:
+                delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers)
+
+
+def reconcile_app_rq_workers(app_event, apps_db, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection):
+    """
+    Creates or deletes the RQ workers of the app (any color) notified by an app event
+    """
+    inc_counter(ghost_redis_connection, 'ghost_rq_workers_reconciliations_total', {'trigger': 'event'})
+    apps = apps_db.find({'env': app_event['env'], 'name': app_event['name'], 'role': app_event['role']},
+                        APPS_RQ_WORKER_PROJECTION)
+    rqworker_names = set(get_rq_name_from_app(app) for app in apps)
+
+    for rqworker_name in rqworker_names:
+        if not ghost_rq_workers.has_key(rqworker_name):
+            create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
+
+    # Workers shared by several apps are only deleted by the full reconciliation
+    for rqworker_name in get_rq_names_from_app_event(app_event):
+        rqworker_app = get_app_from_rq_name(rqworker_name)
+        if rqworker_app['env'] != '*' and rqworker_app['role'] != '*' and \
+                rqworker_name not in rqworker_names and ghost_rq_workers.has_key(rqworker_name):
+            delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers)
+
+
+def manage_rq_worker_pool_forever(ghost_rq_queues, ghost_rq_workers, ghost_redis_connection, ghost_processes):
+    while True:
+        try:
+            manage_background_processes(ghost_processes)
+            logging.info("refreshing workers")
+            manage_rq_worker_pool(ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
+        except:
+            logging.error("an exception occurred: {}".format(sys.exc_value))
+            traceback.print_exc()
+        finally:
+            # Invoke active_children() in order to avoid zombie processes
+            active_children()
+
+        # Short pause
+        sleep(60)
+
+
 def manage_rq_workers():
-    ghost_redis_connection = Redis(host=REDIS_HOST)
+    ghost_redis_connection = get_redis_connection()
     ghost_rq_queues = {}
     ghost_rq_workers = {}
+    ghost_processes = {}
 
     # Register signal handler to terminate workers properly even when process is managed by supervisord
     def signal_handler(signal, frame):
         logging.info("received signal {}, terminating...".format(signal))
 
         sleep(1)
+        for process in ghost_processes.values():
+            if process.is_alive():
+                process.terminate()
         for rqworker_name, rqworker in ghost_rq_workers.items():
             process = rqworker
             if process.is_alive():
@@ -65,63 +246,53 @@ def manage_rq_workers():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGQUIT, signal_handler)
 
-    apps_db = MongoClient(host=MONGO_HOST, port=MONGO_PORT)[MONGO_DBNAME]['apps']
-
-    # Manage RQ workers for existing apps, terminating RQ workers with no
-    while True:
-        try:
-            logging.info("refreshing workers")
+    # Warm runner: workers and their job work horses inherit the loaded config and command modules
+    if config.get('rq_worker_warm_runner', False):
+        logging.info("preloaded commands: {}".format(', '.join(preload_commands())))
 
-            # Get active workers from Redis' point of view
-            active_rqworkers = Worker.all(connection=ghost_redis_connection)
+    if config.get('rq_worker_strategy') == 'worker_pool':
+        return manage_rq_worker_pool_forever(ghost_rq_queues, ghost_rq_workers, ghost_redis_connection,
+                                             ghost_processes)
 
-            # Verify that active workers match child processes
-            for rqworker in active_rqworkers:
-                rqworker_name = rqworker.name
-                logging.debug("found an active rqworker: {}".format(rqworker_name))
-                if not ghost_rq_workers.has_key(rqworker_name):
-                    raise Exception("an active worker does not match a child process: {}".format(rqworker_name))
+    apps_db = get_db_connection()['apps']
+    full_scan_interval = int(config.get('rq_workers_full_scan_interval', RQ_WORKERS_FULL_SCAN_INTERVAL))
+    pubsub = None
+    last_full_scan = None
 
-            # Verify that child processes match active workers
-            for rqworker_name, rqworker in ghost_rq_workers.items():
-                logging.debug("found a child process: {}".format(rqworker_name))
-                if not ghost_rq_workers.has_key(rqworker_name):
-                    raise Exception("a child process does not match an active rqworker: {}".format(rqworker_name))
-                if not rqworker.is_alive():
-                    raise Exception("a child process is not alive: {}".format(rqworker_name))
+    # Manage RQ workers for existing apps when they are notified, terminating RQ workers with no app
+    while True:
+        try:
+            manage_background_processes(ghost_processes)
 
-            # Get existing apps from MongoDB
-            apps = [app for app in apps_db.find()]
+            # Subscribe before the full reconciliation so that no app event is missed
+            if pubsub is None:
+                pubsub = ghost_redis_connection.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(RQ_WORKERS_EVENTS_CHANNEL)
 
-            # Check that each app has an active worker
-            for app in apps:
-                rqworker_name = get_rq_name_from_app(app)
-                if not ghost_rq_workers.has_key(rqworker_name):
-                    create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
-
-            # Check that each worker corresponds to an existing app
-            for rqworker_name, rqworker in ghost_rq_workers.items():
-                found = False
-                rqworker_app = get_app_from_rq_name(rqworker_name)
-
-                if rqworker_app['env'] != '*' and rqworker_app['role'] != '*':
-                    for app in apps:
-                        env = get_app_colored_env(app)
-                        if env == rqworker_app['env'] and app['name'] == rqworker_app['name'] and app['role'] == rqworker_app['role']:
-                            found = True
-                    if not found:
-                        delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers)
+            if last_full_scan is None or time() - last_full_scan >= full_scan_interval:
+                logging.info("refreshing workers")
+                last_full_scan = time()
+                refresh_rq_workers(apps_db, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
 
+            message = pubsub.get_message(timeout=1)
+            while message:
+                app_event = json.loads(message['data'])
+                logging.info("reconciling workers of app: {env}:{name}:{role}".format(**app_event))
+                reconcile_app_rq_workers(app_event, apps_db, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection)
+                message = pubsub.get_message()
         except:
             logging.error("an exception occurred: {}".format(sys.exc_value))
             traceback.print_exc()
+            # App events may have been lost, subscribe again and run a full reconciliation
+            if pubsub is not None:
+                pubsub.close()
+            pubsub = None
+            last_full_scan = None
+            sleep(RQ_WORKERS_FAILURE_BACKOFF)
         finally:
             # Invoke active_children() in order to avoid zombie processes
             active_children()
 
-        # Short pause 
-        sleep(60)
-
 
 if __name__ == '__main__':
     manage_rq_workers()
@@ -18,16 +18,27 @@ modules = [
   "ghost_api",
   "ghost_aws",
   "ghost_blueprints",
+  "ghost_metrics",
+  "ghost_outbox",
+  "ghost_rq",
   "ghost_tools",
   "libs.blue_green",
   "libs.deploy",
+  "libs.ec2",
   "libs.git_helper",
+  "libs.git_mirror",
   "libs.host_deployment_manager",
   "libs.image_builder",
   "libs.image_builder_aws",
+  "libs.job_log",
+  "libs.manifest",
+  "libs.package_catalog",
   "libs.provisioner",
   "libs.provisioner_salt",
   "libs.provisioner_ansible",
+  "libs.ssh",
+  "libs.tracing",
+  "libs.workspace",
   "run",
   "run_rqworkers",
 ]
@@ -0,0 +1,48 @@
+import bcrypt
+from mock import mock
+
+import auth
+from auth import BCryptAuth
+
+PASSWORD_HASH = bcrypt.hashpw('secret', bcrypt.gensalt(4))
+
+
+def _write_accounts_file(tmpdir):
+    accounts_file = tmpdir.join('accounts.yml')
+    accounts_file.write("user: '{}'\n".format(PASSWORD_HASH))
+    return accounts_file
+
+
+@mock.patch.dict(BCryptAuth._accounts)
+def test_check_auth_caches_verified_credentials(tmpdir):
+    with mock.patch('auth.ACCOUNTS_FILE', new=str(_write_accounts_file(tmpdir))):
+        bcrypt_auth = BCryptAuth()
+        with mock.patch('auth.bcrypt.hashpw', wraps=bcrypt.hashpw) as hashpw:
+            assert bcrypt_auth.check_auth('user', 'secret', None, None, 'GET')
+            assert bcrypt_auth.check_auth('user', 'secret', None, None, 'GET')
+            assert hashpw.call_count == 1
+
+            # Failed attempts always pay the full bcrypt cost
+            assert not bcrypt_auth.check_auth('user', 'wrong', None, None, 'GET')
+            assert not bcrypt_auth.check_auth('user', 'wrong', None, None, 'GET')
+            assert hashpw.call_count == 3
+            assert not bcrypt_auth.check_auth('unknown', 'secret', None, None, 'GET')
+
+            # Expired credentials are verified again
+            with mock.patch('auth.time.time', return_value=auth.time.time() + auth.VERIFIED_CREDENTIALS_CACHE_TTL + 1):
+                assert bcrypt_auth.check_auth('user', 'secret', None, None, 'GET')
+            assert hashpw.call_count == 4
+
+
+@mock.patch.dict(BCryptAuth._accounts)
+def test_check_auth_cache_is_invalidated_on_accounts_change(tmpdir):
+    accounts_file = _write_accounts_file(tmpdir)
+    with mock.patch('auth.ACCOUNTS_FILE', new=str(accounts_file)):
+        bcrypt_auth = BCryptAuth()
+        assert bcrypt_auth.check_auth('user', 'secret', None, None, 'GET')
+
+        accounts_file.write("user: '{}'\n".format(bcrypt.hashpw('new-secret', bcrypt.gensalt(4))))
+        accounts_file.setmtime(accounts_file.mtime() + 10)
+
+        assert not bcrypt_auth.check_auth('user', 'secret', None, None, 'GET')
+        assert bcrypt_auth.check_auth('user', 'new-secret', None, None, 'GET')
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from mock import MagicMock, patch
+
+import aws_connection
+from aws_connection import AWSConnection
+from tests.helpers import LOG_FILE
+
+
+def _reset_caches():
+    aws_connection._credentials_cache.clear()
+    aws_connection._connections_cache.clear()
+    aws_connection._thread_caches.__dict__.clear()
+
+
+def _get_sts_credentials(access_key, expiration):
+    assumed_role_object = MagicMock()
+    assumed_role_object.credentials.access_key = access_key
+    assumed_role_object.credentials.secret_key = 'secret-{}'.format(access_key)
+    assumed_role_object.credentials.session_token = 'token-{}'.format(access_key)
+    assumed_role_object.credentials.expiration = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expiration))
+    return assumed_role_object
+
+
+@patch('aws_connection.boto3')
+def test_get_connection_is_cached(boto3):
+    _reset_caches()
+    boto3.client.side_effect = lambda *args, **kwargs: MagicMock()
+
+    conn1 = AWSConnection(LOG_FILE).get_connection('eu-west-1', ['autoscaling'], boto_version='boto3')
+    conn2 = AWSConnection(LOG_FILE).get_connection('eu-west-1', ['autoscaling'], boto_version='boto3')
+    conn3 = AWSConnection(LOG_FILE).get_connection('eu-west-3', ['autoscaling'], boto_version='boto3')
+
+    assert conn1 is conn2
+    assert conn1 is not conn3
+    assert boto3.client.call_count == 2
+
+
+@patch('aws_connection.boto3')
+@patch('aws_connection.boto.sts')
+def test_assumed_role_credentials_are_cached_until_expiration(sts, boto3):
+    _reset_caches()
+    boto3.client.side_effect = lambda *args, **kwargs: MagicMock()
+    sts_connection = sts.connect_to_region.return_value
+    sts_connection.assume_role.side_effect = [
+        _get_sts_credentials('key1', time.time() + 3600),
+        _get_sts_credentials('key2', time.time() + 3600),
+    ]
+    connection_data = {'assumed_account_id': '123456789012', 'assumed_role_name': 'ghost',
+                       'assumed_region_name': 'eu-west-1'}
+
+    conn1 = AWSConnection(LOG_FILE, **connection_data).get_connection('eu-west-1', ['ec2'], boto_version='boto3')
+    conn2 = AWSConnection(LOG_FILE, **connection_data).get_connection('eu-west-1', ['ec2'], boto_version='boto3')
+    assert conn1 is conn2
+    assert sts_connection.assume_role.call_count == 1
+    assert AWSConnection(LOG_FILE, **connection_data).get_credentials() == {
+        'aws_access_key': 'key1', 'aws_secret_key': 'secret-key1', 'token': 'token-key1'}
+
+    # Credentials about to expire are renewed, and so are the connections using them
+    cache_key = ('arn:aws:iam::123456789012:role/ghost', 'eu-west-1')
+    aws_connection._credentials_cache[cache_key]['expiration'] = time.time() + 60
+    conn3 = AWSConnection(LOG_FILE, **connection_data).get_connection('eu-west-1', ['ec2'], boto_version='boto3')
+    assert conn3 is not conn1
+    assert sts_connection.assume_role.call_count == 2
+    boto3.client.assert_called_with('ec2', region_name='eu-west-1', aws_access_key_id='key2',
+                                    aws_secret_access_key='secret-key2', aws_session_token='token-key2')
+
+
+@patch('aws_connection.trace_boto2_connection', new=lambda connection, service: connection)
+@patch('aws_connection.boto.ec2')
+def test_boto2_connections_are_cached_per_thread(ec2):
+    _reset_caches()
+    ec2.connect_to_region.side_effect = lambda *args, **kwargs: MagicMock()
+    connections = []
+
+    def get_connections():
+        connections.append(AWSConnection(LOG_FILE).get_connection('eu-west-1', ['ec2']))
+        connections.append(AWSConnection(LOG_FILE).get_connection('eu-west-1', ['ec2']))
+
+    get_connections()
+    thread = threading.Thread(target=get_connections)
+    thread.start()
+    thread.join()
+
+    assert connections[0] is connections[1]
+    assert connections[2] is connections[3]
+    assert connections[0] is not connections[2]
+    assert ec2.connect_to_region.call_count == 2
+    assert aws_connection._connections_cache == {}
+
+
+@patch('aws_connection.boto3')
+def test_connections_are_created_outside_of_the_cache_lock(boto3):
+    _reset_caches()
+    created = threading.Event()
+    release = threading.Event()
+
+    def create_client(service, **kwargs):
+        if service == 'ec2':
+            created.set()
+            release.wait(5)
+        return MagicMock()
+    boto3.client.side_effect = create_client
+
+    thread = threading.Thread(target=AWSConnection(LOG_FILE).get_connection, args=('eu-west-1', ['ec2'], 'boto3'))
+    thread.start()
+    created.wait(5)
+    try:
+        # The creation of the ec2 client in progress does not block other connections
+        assert AWSConnection(LOG_FILE).get_connection('eu-west-1', ['autoscaling'], boto_version='boto3')
+        assert thread.is_alive()
+    finally:
+        release.set()
+        thread.join()
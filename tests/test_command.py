@@ -0,0 +1,53 @@
+import pickle
+import sys
+
+from mock import mock
+
+import command
+from command import Command, preload_commands, get_command_module
+
+
+@mock.patch('command._command_modules', new={})
+def test_preload_commands():
+    try:
+        command_names = preload_commands()
+
+        assert 'deploy' in command_names and 'executescript' in command_names
+        assert sorted(command._command_modules.keys()) == sorted(command_names)
+        assert get_command_module('deploy') is sys.modules['commands.deploy']
+
+        # Each job gets its own copy of the preloaded config
+        cmd = _execute_enqueued_command()
+        cmd._config['bucket_s3'] = 'altered-bucket'
+        assert _execute_enqueued_command()._config == command._preloaded_config
+        assert command._preloaded_config.get('bucket_s3') != 'altered-bucket'
+    finally:
+        command._preloaded_config = None
+
+
+class _JobStarted(Exception):
+    pass
+
+
+@mock.patch('command.start_tracing', side_effect=_JobStarted)
+def _execute_enqueued_command(start_tracing):
+    """
+    Runs a Command enqueued by the API up to the start of the job, as a job work horse does
+    """
+    cmd = pickle.loads(pickle.dumps(Command()))
+    try:
+        cmd.execute('5a0c1c1a1a1a1a1a1a1a1a1a')
+        assert False, 'Job not started'
+    except _JobStarted:
+        pass
+    return cmd
+
+
+@mock.patch('command.load_config', return_value={'bucket_s3': 'bucket'})
+def test_command_loads_config_in_work_horse(load_config):
+    # The API does not read the config to enqueue a job
+    assert Command()._config is None
+    load_config.assert_not_called()
+
+    assert _execute_enqueued_command()._config == {'bucket_s3': 'bucket'}
+    load_config.assert_called_once_with()
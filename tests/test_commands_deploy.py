@@ -0,0 +1,293 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from mock import mock, MagicMock
+
+from commands.deploy import Deploy
+from ghost_tools import GCallException
+from libs.deploy import PartialDeployException
+from tests.helpers import get_test_application, mocked_logger, LOG_FILE
+
+
+def _get_worker(config):
+    worker = MagicMock()
+    worker.app = get_test_application(_id='app-id')
+    worker.log_file = LOG_FILE
+    worker._config = config
+    return worker
+
+
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_build_modules_concurrently():
+    modules = [{'name': 'mod{}'.format(i)} for i in range(5)]
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def build_module(module):
+        with lock:
+            running.append(module['name'])
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(module['name'])
+        return {'package': 'pkg_{}'.format(module['name'])}
+
+    cmd = Deploy(_get_worker({'deployment_build_concurrency': 3}))
+    cmd._build_module = build_module
+    builds = cmd._build_modules(modules)
+
+    assert builds == {module['name']: {'package': 'pkg_{}'.format(module['name'])} for module in modules}
+    assert max(max_running) == 3
+
+
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_build_modules_failure_waits_for_other_builds():
+    modules = [{'name': 'mod1'}, {'name': 'mod2'}]
+    built = []
+
+    def build_module(module):
+        if module['name'] == 'mod1':
+            raise GCallException('ERROR: Buildpack: Execute')
+        time.sleep(0.05)
+        built.append(module['name'])
+
+    cmd = Deploy(_get_worker({'deployment_build_concurrency': 2}))
+    cmd._build_module = build_module
+    try:
+        cmd._build_modules(modules)
+        assert False, 'GCallException not raised'
+    except GCallException:
+        pass
+
+    assert built == ['mod2']
+
+
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.get_buildpack_clone_path_from_module')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_package_module_streams_package_to_s3(get_buildpack_clone_path_from_module, cloud_connections):
+    workspace = tempfile.mkdtemp()
+    module_path = os.path.join(workspace, 'mod1')
+    os.makedirs(module_path)
+    with open(os.path.join(module_path, 'index.html'), 'w') as f:
+        f.write('<html></html>')
+    get_buildpack_clone_path_from_module.return_value = module_path
+
+    uploaded = {}
+
+    def upload_fileobj(fileobj, bucket, key, Config=None):
+        uploaded[(bucket, key)] = fileobj.read()
+    s3_client = MagicMock()
+    s3_client.upload_fileobj.side_effect = upload_fileobj
+    cloud_connections.get.return_value.return_value.get_connection.return_value = s3_client
+
+    worker = _get_worker({'bucket_s3': 'my-bucket'})
+    worker.log_file = tempfile.TemporaryFile()
+    try:
+        pkg_name = Deploy(worker)._package_module({'name': 'mod1'}, 1500000000, 'abcdef1')
+        # No local package file is written next to the module workspace
+        assert os.listdir(workspace) == ['mod1']
+    finally:
+        worker.log_file.close()
+        shutil.rmtree(workspace)
+
+    assert pkg_name == '1500000000_mod1_abcdef1'
+    package = tarfile.open(fileobj=io.BytesIO(uploaded[('my-bucket', module_path.lstrip('/') + '/' + pkg_name)]),
+                           mode='r:gz')
+    assert './index.html' in package.getnames()
+    s3_client.delete_object.assert_not_called()
+
+
+def _get_cached_package_worker():
+    worker = _get_worker({'bucket_s3': 'my-bucket'})
+    worker.job = {'_id': 'job-id', 'user': 'jdoe'}
+    worker.log_file = tempfile.TemporaryFile()
+    worker._db.build_cache.find_one.return_value = {'_id': 'cache-key', 'bucket': 'my-bucket',
+                                                    'key': 'ghost/test-app/prod/webfront/blue/mod1/1500000000_mod1_abcdef1'}
+    return worker
+
+
+CACHED_BUILD = {'ts': 1600000000, 'revision': 'master', 'commit': 'abcdef1', 'commit_message': 'Fix'}
+
+
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_get_cached_package(cloud_connections):
+    s3_client = cloud_connections.get.return_value.return_value.get_connection.return_value
+    worker = _get_cached_package_worker()
+    cmd = Deploy(worker)
+    build = dict(CACHED_BUILD)
+
+    try:
+        assert cmd._get_cached_package('cache-key', {'name': 'mod1'}, 'git@github.com:org/mod1.git',
+                                       build) == '1600000000_mod1_abcdef1'
+    finally:
+        worker.log_file.close()
+
+    # The package is copied within S3, not downloaded
+    s3_client.download_fileobj.assert_not_called()
+    source, bucket, key = s3_client.copy.call_args[0]
+    assert source == {'Bucket': 'my-bucket', 'Key': 'ghost/test-app/prod/webfront/blue/mod1/1500000000_mod1_abcdef1'}
+    assert (bucket, key.split('/')[-1]) == ('my-bucket', '1600000000_mod1_abcdef1')
+    # The metadata of this build are shipped beside it
+    metadata = s3_client.put_object.call_args[1]
+    assert metadata['Key'] == key + '.ghost-metadata'
+    assert 'GHOST_MODULE_USER="jdoe"' in metadata['Body']
+    assert 'package_path' not in build
+
+
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.get_intermediate_clone_path_from_module')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_get_cached_package_extracts_package_for_after_all_deploy(get_intermediate_clone_path_from_module,
+                                                                  cloud_connections):
+    workspace = tempfile.mkdtemp()
+    get_intermediate_clone_path_from_module.return_value = os.path.join(workspace, 'mod1')
+
+    cached_package = io.BytesIO()
+    with tarfile.open(fileobj=cached_package, mode='w:gz') as package:
+        for name, content in [('vendor/lib.php', b'<?php'), ('.ghost-metadata', b'GHOST_MODULE_USER="other"')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            package.addfile(info, io.BytesIO(content))
+
+    def download_fileobj(bucket, key, fileobj):
+        fileobj.write(cached_package.getvalue())
+    s3_client = cloud_connections.get.return_value.return_value.get_connection.return_value
+    s3_client.download_fileobj.side_effect = download_fileobj
+    worker = _get_cached_package_worker()
+    cmd = Deploy(worker)
+    module = {'name': 'mod1', 'after_all_deploy': 'ZWNobw=='}
+    build = dict(CACHED_BUILD)
+
+    try:
+        assert cmd._get_cached_package('cache-key', module, 'git@github.com:org/mod1.git',
+                                       build) == '1600000000_mod1_abcdef1'
+        # after_all_deploy runs in the built module
+        assert build['package_path'] == os.path.join(workspace, 'mod1')
+        assert os.path.exists(os.path.join(build['package_path'], 'vendor', 'lib.php'))
+        with io.open(os.path.join(build['package_path'], '.ghost-metadata'), encoding='utf-8') as f:
+            assert 'GHOST_MODULE_USER="jdoe"' in f.read()
+        assert s3_client.copy.call_count == 1
+
+        cmd._remove_extracted_package(build)
+        assert not os.path.exists(os.path.join(workspace, 'mod1'))
+    finally:
+        worker.log_file.close()
+        shutil.rmtree(workspace)
+
+
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.get_intermediate_clone_path_from_module')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_get_cached_package_falls_back_to_build(get_intermediate_clone_path_from_module, cloud_connections):
+    workspace = tempfile.mkdtemp()
+    get_intermediate_clone_path_from_module.return_value = os.path.join(workspace, 'mod1')
+    s3_client = cloud_connections.get.return_value.return_value.get_connection.return_value
+    worker = _get_cached_package_worker()
+    cmd = Deploy(worker)
+    module = {'name': 'mod1', 'after_all_deploy': 'ZWNobw=='}
+
+    try:
+        # The cached package was purged from the bucket
+        s3_client.download_fileobj.side_effect = ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}},
+                                                             'GetObject')
+        assert cmd._get_cached_package('cache-key', module, 'git@github.com:org/mod1.git', dict(CACHED_BUILD)) is None
+
+        # The cached package is corrupted: tar exits and writing to it fails
+        def download_fileobj(bucket, key, fileobj):
+            for _ in range(1024):
+                fileobj.write(b'not a tar.gz' * 1024)
+                fileobj.flush()
+        s3_client.download_fileobj.side_effect = download_fileobj
+        build = dict(CACHED_BUILD)
+        assert cmd._get_cached_package('cache-key', module, 'git@github.com:org/mod1.git', build) is None
+        assert 'package_path' not in build
+        assert not os.path.exists(os.path.join(workspace, 'mod1'))
+    finally:
+        worker.log_file.close()
+        shutil.rmtree(workspace)
+
+    assert worker._db.build_cache.remove.call_args_list == [mock.call({'_id': 'cache-key'})] * 2
+    s3_client.copy.assert_not_called()
+
+
+@mock.patch('commands.deploy.evict_workspaces')
+@mock.patch('commands.deploy.record_workspace_size')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_build_modules_evicts_workspaces_after_cached_builds(record_workspace_size, evict_workspaces):
+    cmd = Deploy(_get_worker({'deployment_persistent_workspaces': True, 'deployment_workspaces_quota_gb': 1}))
+    cmd._build_module = lambda module: {'package': 'cached_pkg_{}'.format(module['name'])}
+
+    assert cmd._build_modules([{'name': 'mod1'}]) == {'mod1': {'package': 'cached_pkg_mod1'}}
+    assert record_workspace_size.call_count == 1
+    evict_workspaces.assert_called_once_with(1024 * 1024 * 1024, mock.ANY, LOG_FILE)
+
+
+@mock.patch('commands.deploy.HostDeploymentManager')
+@mock.patch('commands.deploy.clean_local_module_workspace')
+@mock.patch('commands.deploy.update_app_manifest_modules')
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_execute_deploy_rolls_out_all_modules_at_once(cloud_connections, update_app_manifest_modules,
+                                                      clean_local_module_workspace, host_deployment_manager):
+    worker = _get_worker({})
+    worker.job = {'_id': 'job-id'}
+    worker._db.deploy_histories.insert.side_effect = ['id1', 'id2']
+    cmd = Deploy(worker)
+    modules = [{'name': 'mod1', 'path': '/var/www/mod1'}, {'name': 'mod2', 'path': '/var/www/mod2'}]
+    builds = {module['name']: {'package': '1500000000_{0}_abcdef1'.format(module['name']), 'revision': 'master',
+                               'commit': 'abcdef1', 'commit_message': 'Fix', 'ts': 1500000000}
+              for module in modules}
+
+    assert cmd._execute_deploy(modules, builds, 'serial', None) == {'mod1': 'id1', 'mod2': 'id2'}
+
+    update_app_manifest_modules.assert_called_once_with(
+        worker.app, {}, [(modules[0], '1500000000_mod1_abcdef1'), (modules[1], '1500000000_mod2_abcdef1')], LOG_FILE)
+    assert host_deployment_manager.call_count == 1
+    assert host_deployment_manager.call_args[0][2] == modules
+    host_deployment_manager.return_value.deployment.assert_called_once_with(None)
+
+
+@mock.patch('commands.deploy.rollback_app_manifest')
+@mock.patch('commands.deploy.HostDeploymentManager')
+@mock.patch('commands.deploy.clean_local_module_workspace')
+@mock.patch('commands.deploy.update_app_manifest_modules')
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_execute_deploy_keeps_modules_switched_before_the_failure(cloud_connections, update_app_manifest_modules,
+                                                                  clean_local_module_workspace,
+                                                                  host_deployment_manager, rollback_app_manifest):
+    worker = _get_worker({})
+    worker.job = {'_id': 'job-id'}
+    worker._db.deploy_histories.insert.side_effect = ['id1']
+    cmd = Deploy(worker)
+    modules = [{'name': 'mod1', 'path': '/var/www/mod1'}, {'name': 'mod2', 'path': '/var/www/mod2'}]
+    builds = {module['name']: {'package': '1500000000_{0}_abcdef1'.format(module['name']), 'revision': 'master',
+                               'commit': 'abcdef1', 'commit_message': 'Fix', 'ts': 1500000000}
+              for module in modules}
+    old_modules = [{'name': 'mod1', 'package': 'mod1_1.tar.gz', 'path': '/var/www/mod1'}]
+    update_app_manifest_modules.return_value = {'modules': old_modules, 'packages': {
+        'mod1': '1500000000_mod1_abcdef1', 'mod2': '1500000000_mod2_abcdef1'}}
+    host_deployment_manager.return_value.deployment.side_effect = PartialDeployException('Deploy error on: 10.0.0.1',
+                                                                                         modules[:1])
+
+    try:
+        cmd._execute_deploy(modules, builds, 'serial', None)
+        assert False, 'PartialDeployException not raised'
+    except PartialDeployException:
+        pass
+
+    rollback_app_manifest.assert_called_once_with(worker.app, {}, {
+        'modules': old_modules, 'packages': {'mod2': '1500000000_mod2_abcdef1'}}, LOG_FILE)
+    assert worker._db.deploy_histories.insert.call_count == 1
+    assert worker._db.deploy_histories.insert.call_args[0][0]['module'] == 'mod1'
+    worker._db.jobs.update.assert_called_once_with({'_id': 'job-id', 'modules.name': 'mod1'},
+                                                   {'$set': {'modules.$.deploy_id': 'id1'}})
@@ -0,0 +1,28 @@
+from mock import mock, MagicMock
+
+from commands.redeploy import Redeploy
+from tests.helpers import get_test_application, mocked_logger, LOG_FILE
+
+
+@mock.patch('commands.redeploy.HostDeploymentManager')
+@mock.patch('commands.redeploy.clean_local_module_workspace')
+@mock.patch('commands.redeploy.update_app_manifest')
+@mock.patch('commands.redeploy.cloud_connections')
+@mock.patch('commands.redeploy.log', new=mocked_logger)
+def test_redeploy_does_not_download_package_on_ghost(cloud_connections, update_app_manifest,
+                                                      clean_local_module_workspace, host_deployment_manager):
+    """
+    Instances switch back to the package themselves, Ghost has no after_all_deploy script to run from it
+    """
+    worker = MagicMock()
+    worker.app = get_test_application()
+    worker.log_file = LOG_FILE
+    worker._db.deploy_histories.find_one.return_value = {
+        'module_path': '/var/www', 'module': 'symfony2', 'package': 'symfony2_1500000000_abcdef.tar.gz'}
+
+    with mock.patch.object(Redeploy, '_local_extract_package') as local_extract_package:
+        cmd = Redeploy(worker)
+        cmd._execute_redeploy('5a0000000000000000000000', None, None)
+
+    host_deployment_manager.return_value.deployment.assert_called_once_with(None)
+    local_extract_package.assert_not_called()
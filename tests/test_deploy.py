@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+from mock import mock
+
+from libs.deploy import prepare_module_cache, limit_module_cache_size
+from tests.helpers import mocked_logger
+
+
+@mock.patch('libs.deploy.log', new=mocked_logger)
+@mock.patch('ghost_tools.log', new=mocked_logger)
+def test_module_cache_invalidation_and_size_limit():
+    cache_path = os.path.join(tempfile.mkdtemp(), 'mod1')
+    app = {'name': 'app1', 'env': 'prod', 'role': 'webfront'}
+    module = {'name': 'mod1'}
+    log_file = open(os.devnull, 'w')
+
+    with mock.patch('libs.deploy.get_module_cache_path_from_module', return_value=cache_path):
+        assert prepare_module_cache(app, module, log_file) == cache_path
+        open(os.path.join(cache_path, 'dependency.tgz'), 'w').close()
+
+        # Kept between deploys
+        prepare_module_cache(app, module, log_file)
+        assert os.path.exists(os.path.join(cache_path, 'dependency.tgz'))
+
+        # Explicitly invalidated
+        module['cache_version'] = '2'
+        prepare_module_cache(app, module, log_file)
+        assert os.listdir(cache_path) == ['.ghost-cache-version']
+
+    with open(os.path.join(cache_path, 'dependency.tgz'), 'w') as f:
+        f.write('0' * 8192)
+    limit_module_cache_size(cache_path, 1024 * 1024, log_file)
+    assert os.path.exists(cache_path)
+    limit_module_cache_size(cache_path, 1024, log_file)
+    assert not os.path.exists(cache_path)
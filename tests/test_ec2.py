@@ -0,0 +1,61 @@
+from mock import MagicMock
+
+from libs.ec2 import find_ec2_instances, find_ec2_pending_instances
+
+
+def _get_instance(instance_id):
+    instance = MagicMock()
+    instance.id = instance_id
+    instance.private_ip_address = '10.0.0.{}'.format(instance_id.split('-')[1])
+    instance.subnet_id = 'subnet-test'
+    return instance
+
+
+def _get_cloud_connection(conn, conn_as):
+    cloud_connection = MagicMock()
+    cloud_connection.get_connection.side_effect = \
+        lambda region, services, boto_version='boto2': conn_as if services == ['autoscaling'] else conn
+    return cloud_connection
+
+
+def test_find_ec2_instances_batches_autoscaling_lookups():
+    conn, conn_as = MagicMock(), MagicMock()
+    conn.get_only_instances.return_value = [_get_instance('i-{}'.format(i)) for i in range(120)]
+
+    def describe_auto_scaling_instances(InstanceIds, MaxRecords):
+        return {'AutoScalingInstances': [
+            {'InstanceId': instance_id, 'LifecycleState': 'Terminating:Wait' if instance_id == 'i-60' else 'InService'}
+            for instance_id in InstanceIds if instance_id != 'i-119']}
+    conn_as.describe_auto_scaling_instances.side_effect = describe_auto_scaling_instances
+
+    hosts = find_ec2_instances(_get_cloud_connection(conn, conn_as), 'app', 'env', 'role', 'region', 'running')
+
+    assert conn_as.describe_auto_scaling_instances.call_count == 3
+    assert len(hosts) == 119
+    assert {'id': 'i-60', 'private_ip_address': '10.0.0.60', 'subnet_id': 'subnet-test'} not in hosts
+    assert {'id': 'i-119', 'private_ip_address': '10.0.0.119', 'subnet_id': 'subnet-test'} in hosts
+    assert hosts[0] == {'id': 'i-0', 'private_ip_address': '10.0.0.0', 'subnet_id': 'subnet-test'}
+
+
+def test_find_ec2_pending_instances_fetches_untagged_instances_at_once():
+    conn, conn_as = MagicMock(), MagicMock()
+
+    def get_only_instances(filters=None, instance_ids=None):
+        if filters:
+            return [_get_instance('i-1')]
+        return [_get_instance(instance_id) for instance_id in instance_ids]
+    conn.get_only_instances.side_effect = get_only_instances
+    conn_as.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [{'Instances': [
+        {'InstanceId': 'i-1', 'LifecycleState': 'Pending'},
+        {'InstanceId': 'i-2', 'LifecycleState': 'Pending:Wait'},
+        {'InstanceId': 'i-3', 'LifecycleState': 'Pending'},
+        {'InstanceId': 'i-4', 'LifecycleState': 'InService'},
+    ]}]}
+
+    hosts = find_ec2_pending_instances(_get_cloud_connection(conn, conn_as), 'app', 'env', 'role', 'region', 'asg')
+
+    assert hosts == [{'id': 'i-1', 'private_ip_address': '10.0.0.1'},
+                     {'id': 'i-2', 'private_ip_address': '10.0.0.2'},
+                     {'id': 'i-3', 'private_ip_address': '10.0.0.3'}]
+    assert conn.get_only_instances.call_count == 2
+    conn.get_only_instances.assert_called_with(instance_ids=['i-2', 'i-3'])
@@ -0,0 +1,21 @@
+from mock import mock
+
+import ghost_data
+
+
+@mock.patch('ghost_data.MongoClient')
+def test_mongo_client_is_shared_by_process(MongoClient):
+    ghost_data._mongo_client = None
+
+    assert ghost_data.get_db_connection() is ghost_data.get_db_connection()
+    assert MongoClient.call_count == 1
+
+    # A forked process gets its own client
+    with mock.patch('ghost_data.os.getpid', return_value=-1):
+        ghost_data.get_db_connection()
+    assert MongoClient.call_count == 2
+    ghost_data._mongo_client = None
+
+
+def test_redis_connections_share_a_pool():
+    assert ghost_data.get_redis_connection().connection_pool is ghost_data.get_redis_connection().connection_pool
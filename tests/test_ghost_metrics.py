@@ -0,0 +1,57 @@
+import boto3
+from mock import mock, MagicMock
+
+from ghost_metrics import observe_histogram, render_metrics, count_boto3_throttling
+
+
+def test_observe_histogram_increments_reached_buckets():
+    connection = MagicMock()
+    pipeline = connection.pipeline.return_value
+
+    observe_histogram(connection, 'ghost_job_wait_seconds', 7, {'command': 'deploy'})
+
+    key = 'ghost:metrics:ghost_job_wait_seconds'
+    assert [c[0] for c in pipeline.hincrby.call_args_list] == [
+        (key, 'command="deploy"|10', 1), (key, 'command="deploy"|30', 1), (key, 'command="deploy"|60', 1),
+        (key, 'command="deploy"|300', 1), (key, 'command="deploy"|600', 1), (key, 'command="deploy"|1800', 1),
+        (key, 'command="deploy"|3600', 1), (key, 'command="deploy"|+Inf', 1)]
+    pipeline.hincrbyfloat.assert_called_once_with(key, 'command="deploy"|sum', 7)
+    pipeline.execute.assert_called_once_with()
+
+
+def test_render_metrics():
+    connection = MagicMock()
+    recorded = {
+        'ghost:metrics:ghost_jobs_finished_total': {'command="deploy",status="done"': '3'},
+    }
+    connection.pipeline.return_value.execute.side_effect = lambda: [
+        recorded.get(c[0][0], {}) for c in connection.pipeline.return_value.hgetall.call_args_list]
+    queue = MagicMock(count=2)
+    queue.name = 'prod:app1:web'
+    workers = [MagicMock(**{'get_state.return_value': state}) for state in ['busy', 'idle', 'busy']]
+
+    with mock.patch('ghost_metrics.Queue.all', return_value=[queue]), \
+            mock.patch('ghost_metrics.Worker.all', return_value=workers):
+        metrics = render_metrics(connection).splitlines()
+
+    assert '# TYPE ghost_jobs_finished_total counter' in metrics
+    assert 'ghost_jobs_finished_total{command="deploy",status="done"} 3' in metrics
+    assert 'ghost_rq_queue_jobs{queue="prod:app1:web"} 2' in metrics
+    assert 'ghost_rq_workers{state="busy"} 2' in metrics
+    assert 'ghost_rq_workers{state="idle"} 1' in metrics
+
+
+def test_count_boto3_throttling():
+    client = count_boto3_throttling(boto3.client('ec2', region_name='eu-west-1', aws_access_key_id='key',
+                                                 aws_secret_access_key='secret'))
+    throttled = (MagicMock(status_code=503), {'Error': {'Code': 'RequestLimitExceeded'}})
+    ok = (MagicMock(status_code=200), {'Reservations': []})
+
+    with mock.patch.object(client._endpoint, '_get_response', side_effect=[(throttled, None), (ok, None)]), \
+            mock.patch('ghost_metrics.inc_counter') as inc_counter, \
+            mock.patch('ghost_data.get_redis_connection'), \
+            mock.patch('time.sleep'):
+        client.describe_instances()
+
+    assert inc_counter.call_args[0][1:] == ('ghost_aws_throttled_requests_total',
+                                            {'service': 'ec2', 'operation': 'DescribeInstances'})
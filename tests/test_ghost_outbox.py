@@ -0,0 +1,87 @@
+import io
+from datetime import datetime
+
+from mock import mock, MagicMock
+
+from ghost_outbox import claim_outbox_entry, process_outbox_entry, push_log_to_s3, push_outbox_entries
+from ghost_outbox import OUTBOX_COLLECTION
+from ghost_tools import get_job_log_remote_path
+from libs.job_log import compress_log_chunk
+
+
+def _get_db():
+    db = MagicMock()
+    return db, db.__getitem__.return_value
+
+
+def test_push_outbox_entries():
+    db, outbox = _get_db()
+
+    push_outbox_entries(db, 'job-id', [('slack', {'slack_msg': 'done'}), ('s3_log', {'log_id': 'log-id'})],
+                        host='worker-1')
+
+    db.__getitem__.assert_called_with(OUTBOX_COLLECTION)
+    entries = outbox.insert_many.call_args[0][0]
+    assert [(entry['job_id'], entry['action'], entry['host'], entry['attempts']) for entry in entries] == \
+        [('job-id', 'slack', 'worker-1', 0), ('job-id', 's3_log', 'worker-1', 0)]
+
+
+def test_claim_outbox_entry_only_claims_entries_of_the_host():
+    db, outbox = _get_db()
+
+    claim_outbox_entry(db, 'worker-1')
+
+    query = outbox.find_one_and_update.call_args[0][0]
+    # Entries without a host (packages purge...) can be processed by any host
+    assert query['host'] == {'$in': [None, 'worker-1']}
+
+
+def test_process_outbox_entry_deletes_entry_on_success():
+    db, outbox = _get_db()
+    action = MagicMock()
+
+    with mock.patch.dict('ghost_outbox.OUTBOX_ACTIONS', {'s3_log': action}):
+        assert process_outbox_entry(db, {'_id': 'entry-id', 'job_id': 'job-id', 'action': 's3_log',
+                                         'payload': {'log_id': 'log-id'}, 'attempts': 1})
+
+    action.assert_called_once_with({'log_id': 'log-id'})
+    outbox.delete_one.assert_called_once_with({'_id': 'entry-id'})
+    outbox.update_one.assert_not_called()
+
+
+def test_process_outbox_entry_schedules_retry_on_failure():
+    db, outbox = _get_db()
+    action = MagicMock(side_effect=Exception('SES unavailable'))
+
+    with mock.patch.dict('ghost_outbox.OUTBOX_ACTIONS', {'mail': action}):
+        assert not process_outbox_entry(db, {'_id': 'entry-id', 'job_id': 'job-id', 'action': 'mail',
+                                             'payload': {}, 'attempts': 2})
+
+    outbox.delete_one.assert_not_called()
+    query, update = outbox.update_one.call_args[0]
+    assert query == {'_id': 'entry-id'}
+    assert update['$set']['last_error'] == 'SES unavailable'
+    assert 55 < (update['$set']['next_attempt'] - datetime.utcnow()).total_seconds() <= 60
+
+
+@mock.patch.dict('ghost_outbox.config', {'bucket_s3': 'my-bucket'})
+@mock.patch('ghost_outbox.cloud_connections')
+def test_push_log_to_s3_assembles_missing_local_log_from_shipped_chunks(cloud_connections):
+    s3_client = cloud_connections.get.return_value.return_value.get_connection.return_value
+    parts = {'log/job/log-id.parts/000000.gz': compress_log_chunk('line 1\n'),
+             'log/job/log-id.parts/000001.gz': compress_log_chunk('line 2\n')}
+    s3_client.get_paginator.return_value.paginate.return_value = [{'Contents': [{'Key': key}
+                                                                                for key in sorted(parts)]}]
+    s3_client.get_object.side_effect = lambda Bucket, Key: {'Body': io.BytesIO(parts[Key])}
+    uploaded = {}
+
+    def upload_fileobj(fileobj, bucket, key, Config=None):
+        uploaded[(bucket, key)] = fileobj.read()
+    s3_client.upload_fileobj.side_effect = upload_fileobj
+
+    push_log_to_s3({'log_id': 'log-id', 'log_path': '/nonexistent/log-id.txt', 'region': 'eu-west-1'})
+
+    s3_client.upload_file.assert_not_called()
+    assert uploaded == {('my-bucket', get_job_log_remote_path('log-id')): 'line 1\nline 2\n'}
+    s3_client.delete_objects.assert_called_once_with(Bucket='my-bucket', Delete={
+        'Objects': [{'Key': key} for key in sorted(parts)], 'Quiet': True})
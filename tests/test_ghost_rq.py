@@ -0,0 +1,109 @@
+from mock import mock, MagicMock
+
+from rq.job import JobStatus
+
+from ghost_rq import KeyedLockWorker, cancel_rq_job, requeue_stalled_pending_jobs
+from ghost_rq import _ACQUIRE_SCRIPT, _DISCARD_SCRIPT, _RELEASE_SCRIPT
+
+
+def _get_job(job_id, status=JobStatus.QUEUED):
+    job = MagicMock()
+    job.id = job_id
+    job.meta = {'lock_key': 'ghost:rq:lock:prod:App1:webfront'}
+    job.timeout = 600
+    job.get_status.return_value = status
+    return job
+
+
+def _get_worker(connection):
+    worker = KeyedLockWorker.__new__(KeyedLockWorker)
+    worker.connection = connection
+    worker.log = MagicMock()
+    return worker
+
+
+@mock.patch('ghost_rq.Job')
+@mock.patch('ghost_rq.Worker.execute_job')
+def test_keyed_lock_worker_runs_job_and_requeues_next_pending_job(execute_job, job_class):
+    connection, queue = MagicMock(), MagicMock()
+    connection.eval.side_effect = lambda script, numkeys, *args: 1 if script == _ACQUIRE_SCRIPT else 'job2'
+    job_class.exists.return_value = True
+
+    _get_worker(connection).execute_job(_get_job('job1'), queue)
+
+    assert execute_job.call_count == 1
+    connection.eval.assert_called_with(_RELEASE_SCRIPT, 2, 'ghost:rq:lock:prod:App1:webfront',
+                                       'ghost:rq:lock:prod:App1:webfront:pending', 'job1')
+    queue.push_job_id.assert_called_once_with('job2', at_front=True)
+
+
+@mock.patch('ghost_rq.Worker.execute_job')
+def test_keyed_lock_worker_parks_job_when_lock_is_held(execute_job):
+    connection, queue = MagicMock(), MagicMock()
+    connection.eval.return_value = 0
+
+    _get_worker(connection).execute_job(_get_job('job2'), queue)
+
+    execute_job.assert_not_called()
+    assert connection.eval.call_count == 1
+    assert connection.eval.call_args[0][:5] == (_ACQUIRE_SCRIPT, 2, 'ghost:rq:lock:prod:App1:webfront',
+                                                'ghost:rq:lock:prod:App1:webfront:pending', 'job2')
+    queue.push_job_id.assert_not_called()
+
+
+@mock.patch('ghost_rq.Worker.execute_job')
+def test_keyed_lock_worker_does_not_run_a_job_twice(execute_job):
+    connection, queue = MagicMock(), MagicMock()
+    connection.eval.return_value = None
+
+    _get_worker(connection).execute_job(_get_job('job1', status=JobStatus.FINISHED), queue)
+
+    execute_job.assert_not_called()
+    queue.push_job_id.assert_not_called()
+
+
+@mock.patch('ghost_rq.Job')
+def test_requeue_stalled_pending_jobs(job_class):
+    connection, queue = MagicMock(), MagicMock()
+    connection.scan_iter.return_value = ['ghost:rq:lock:prod:App1:webfront:pending',
+                                         'ghost:rq:lock:prod:App2:webfront:pending']
+    connection.lindex.side_effect = lambda key, index: 'job1' if 'App1' in key else 'job2'
+    connection.exists.side_effect = lambda key: key == 'ghost:rq:lock:prod:App2:webfront'
+    job_class.exists.return_value = True
+    queue.job_ids = []
+
+    requeue_stalled_pending_jobs(connection, queue)
+
+    queue.push_job_id.assert_called_once_with('job1', at_front=True)
+
+
+@mock.patch('ghost_rq.Queue')
+@mock.patch('ghost_rq.Job')
+def test_cancel_rq_job_removes_parked_job_from_pending_list(job_class, queue_class):
+    connection = MagicMock()
+    job = _get_job('job2')
+    job_class.fetch.return_value = job
+    # job1 still holds the lock
+    connection.eval.return_value = None
+
+    cancel_rq_job(connection, 'job2')
+
+    job.cancel.assert_called_once_with()
+    connection.eval.assert_called_once_with(_DISCARD_SCRIPT, 2, 'ghost:rq:lock:prod:App1:webfront',
+                                            'ghost:rq:lock:prod:App1:webfront:pending', 'job2')
+    queue_class.return_value.push_job_id.assert_not_called()
+
+
+@mock.patch('ghost_rq.Queue')
+@mock.patch('ghost_rq.Job')
+def test_cancel_rq_job_requeues_next_pending_job_of_a_free_lock(job_class, queue_class):
+    connection = MagicMock()
+    job_class.fetch.return_value = _get_job('job2')
+    job_class.exists.return_value = True
+    # job2 was requeued when job1 released the lock, job3 waits behind it
+    connection.eval.return_value = 'job3'
+    queue_class.return_value.job_ids = []
+
+    cancel_rq_job(connection, 'job2')
+
+    queue_class.return_value.push_job_id.assert_called_once_with('job3', at_front=True)
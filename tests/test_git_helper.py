@@ -0,0 +1,56 @@
+import os
+import tempfile
+import time
+from multiprocessing import Event, Process
+
+from mock import MagicMock
+
+from libs.git_helper import git_acquire_lock, git_release_lock, get_lock_holder
+
+
+def _hold_lock(lock_path, locked, seconds, release=True):
+    git_acquire_lock(lock_path)
+    locked.set()
+    time.sleep(seconds)
+    if release:
+        git_release_lock(lock_path)
+    else:
+        # Crash while holding the lock
+        os._exit(1)
+
+
+def test_lock_handoff_wakes_up_waiter():
+    lock_path = os.path.join(tempfile.mkdtemp(), '.locks', 'git@bitbucket.org:morea', 'ghost.git')
+    locked = Event()
+    holder = Process(target=_hold_lock, args=(lock_path, locked, 0.5))
+    holder.start()
+    locked.wait()
+    log_file = MagicMock()
+    waiting = time.time()
+
+    git_acquire_lock(lock_path, log_file)
+    waited = time.time() - waiting
+    holder.join()
+    try:
+        assert get_lock_holder(lock_path)['pid'] == os.getpid()
+        assert 'locked by process {0}'.format(holder.pid) in log_file.write.call_args_list[0][0][0]
+    finally:
+        git_release_lock(lock_path)
+    # The waiter was woken up by the release, not by a polling interval
+    assert waited < 2
+
+
+def test_lock_of_crashed_holder_is_released():
+    lock_path = tempfile.mktemp()
+    locked = Event()
+    holder = Process(target=_hold_lock, args=(lock_path, locked, 0, False))
+    holder.start()
+    locked.wait()
+    holder.join()
+    log_file = MagicMock()
+
+    git_acquire_lock(lock_path, log_file)
+    git_release_lock(lock_path)
+
+    assert 'process {0}'.format(holder.pid) in log_file.write.call_args_list[0][0][0]
+    assert 'died while holding it' in log_file.write.call_args_list[0][0][0]
@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+from mock import mock, MagicMock
+from sh import git
+
+from libs.git_mirror import update_mirror
+
+
+def _create_repo():
+    repo_path = tempfile.mkdtemp()
+    git('init', '-q', repo_path)
+    git('-c', 'user.name=ghost', '-c', 'user.email=ghost@localhost', 'commit', '-q', '--allow-empty', '-m', 'initial',
+        _cwd=repo_path)
+    return repo_path, git('rev-parse', 'HEAD', _cwd=repo_path, _tty_out=False).strip()
+
+
+@mock.patch('libs.git_mirror.get_lock_path_from_repo', new=lambda git_repo: tempfile.mktemp())
+def test_update_mirror_skips_needless_fetches():
+    repo_path, commit = _create_repo()
+    mirror_path = os.path.join(tempfile.mkdtemp(), 'mirror.git')
+    log_file = MagicMock()
+
+    update_mirror(repo_path, mirror_path, 'master', log_file)
+    assert os.path.exists(os.path.join(mirror_path, 'HEAD'))
+
+    with mock.patch('libs.git_mirror.gcall') as gcall:
+        # Commits can't move, a fresh mirror may serve branches
+        update_mirror(repo_path, mirror_path, commit[:10], log_file)
+        update_mirror(repo_path, mirror_path, 'master', log_file, freshness=60)
+        assert not gcall.called
+
+        update_mirror(repo_path, mirror_path, 'master', log_file)
+        assert gcall.call_args[0][0] == 'git --no-pager -c gc.auto=0 fetch --all --tags --prune'
@@ -0,0 +1,32 @@
+from mock import mock, MagicMock
+
+from libs.host_deployment_manager import HostDeploymentManager
+from tests.helpers import get_test_application, mocked_logger, LOG_FILE
+
+
+@mock.patch('libs.host_deployment_manager.launch_deploy')
+@mock.patch('libs.host_deployment_manager.find_ec2_running_instances')
+@mock.patch('libs.host_deployment_manager.find_ec2_pending_instances', return_value=[])
+@mock.patch('libs.host_deployment_manager.get_autoscaling_group_and_processes_to_suspend',
+            return_value=('as_test', []))
+@mock.patch('libs.host_deployment_manager.suspend_autoscaling_group_processes')
+@mock.patch('libs.host_deployment_manager.resume_autoscaling_group_processes')
+@mock.patch('libs.host_deployment_manager.log', new=mocked_logger)
+def test_safe_deployment_prefetches_before_draining(resume_autoscaling_group_processes,
+                                                    suspend_autoscaling_group_processes,
+                                                    get_autoscaling_group_and_processes_to_suspend,
+                                                    find_ec2_pending_instances, find_ec2_running_instances,
+                                                    launch_deploy):
+    app = get_test_application()
+    module = app['modules'][0]
+    safe_infos = dict(app['safe-deployment'], prefetch=True)
+    find_ec2_running_instances.return_value = [{'id': 'i-1', 'private_ip_address': '10.0.0.1'},
+                                               {'id': 'i-2', 'private_ip_address': '10.0.0.2'}]
+    calls = []
+    launch_deploy.side_effect = lambda *args, **kwargs: calls.append(('launch_deploy', args[2], kwargs))
+
+    manager = HostDeploymentManager(MagicMock(), app, module, LOG_FILE, safe_infos, 'serial')
+    with mock.patch.object(manager, 'safe_manager', side_effect=lambda strategy: calls.append(('safe_manager',))):
+        manager.deployment('1by1')
+
+    assert calls == [('launch_deploy', ['10.0.0.1', '10.0.0.2'], {'prefetch': True}), ('safe_manager',)]
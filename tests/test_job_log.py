@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import os
+import subprocess
+import tempfile
+import zlib
+
+from libs.job_log import JobLogFile
+
+
+def test_job_log_file_buffers_and_ships_chunks():
+    log_path = tempfile.mktemp()
+    chunks = []
+    log_file = JobLogFile(log_path, ship_chunk=lambda sequence, data: chunks.append((sequence, data)),
+                          ship_interval=3600, flush_interval=3600)
+    try:
+        log_file.write('line 1\n')
+        # Not yet written to disk
+        assert os.path.getsize(log_path) == 0
+
+        # The output of subprocesses follows the buffered lines
+        subprocess.call('echo line 2', shell=True, stdout=log_file)
+        log_file.write(u'line 3 ✓\n')
+        log_file.ship()
+        log_file.write('line 4\n')
+        log_file.close()
+
+        with open(log_path) as f:
+            assert f.read() == 'line 1\nline 2\nline 3 \xe2\x9c\x93\nline 4\n'
+        assert [sequence for sequence, data in chunks] == [0, 1]
+        # Chunks form a complete gzip file once concatenated
+        assert gzip.GzipFile(fileobj=io.BytesIO(''.join(data for sequence, data in chunks))).read() == \
+            'line 1\nline 2\nline 3 \xe2\x9c\x93\nline 4\n'
+    finally:
+        os.remove(log_path)
+
+
+def test_job_log_file_retries_failed_chunks():
+    log_path = tempfile.mktemp()
+    chunks = []
+
+    def ship_chunk(sequence, data):
+        if not chunks and len(data) and not ship_chunk.failed:
+            ship_chunk.failed = True
+            raise Exception('S3 unavailable')
+        chunks.append((sequence, zlib.decompress(data, 16 + zlib.MAX_WBITS)))
+    ship_chunk.failed = False
+
+    log_file = JobLogFile(log_path, ship_chunk=ship_chunk, ship_interval=3600, flush_interval=3600)
+    try:
+        log_file.write('line 1\n')
+        log_file.flush()
+        log_file.ship()
+        log_file.write('line 2\n')
+        log_file.close()
+
+        assert chunks == [(0, 'line 1\nline 2\n')]
+    finally:
+        os.remove(log_path)
@@ -150,3 +150,36 @@ def test_purge(lxd_client_cls, gcall_lxd):
 
     # Test
     assert lxd_image.delete.call_count == 3
+
+
+@mock.patch('libs.image_builder_lxd.log', new=mocked_logger)
+@mock.patch('libs.image_builder.log', new=mocked_logger)
+@mock.patch('libs.image_builder_lxd.time.sleep', new=void)  # Avoid waiting
+@mock.patch('libs.image_builder_lxd.LXDClient')
+def test_deploy_with_module_cache(lxd_client_cls):
+    app = get_test_application()
+    app['build_infos']['container_image'] = 'lxd-container-image-test'
+    job = {
+        "_id": "test_job_id",
+        "app_id": "test_app_id",
+        "command": "deploy",
+        "instance_type": "test_instance_type",
+        "options": []
+    }
+    module = {'name': 'mod1', 'path': '/var/www'}
+    lxd_client = mock.MagicMock()
+    lxd_client_cls.return_value = lxd_client
+    lxd_container_mock = lxd_client.containers.create.return_value
+    lxd_container_mock.execute.return_value = mock.MagicMock(exit_code=0, stdout='', stderr='')
+
+    with mock.patch('ghost_tools.config', new=get_test_config()):
+        image_builder = LXDImageBuilder(app, job, None, LOG_FILE, get_test_config())
+        image_builder.deploy('/ghost/app/mod1/tmpbuildpack', module, '/ghost/app/mod1',
+                             '/ghost/.cache/app/prod/webfront/mod1')
+
+    devices = lxd_client.profiles.create.call_args[1]['devices']
+    assert devices['module_cache'] == {'path': '/ghost/.cache/app/prod/webfront/mod1',
+                                       'source': '/ghost/.cache/app/prod/webfront/mod1', 'type': 'disk'}
+    lxd_container_mock.execute.assert_any_call(['sh', '/var/www/tmpbuildpack'],
+                                               environment={'GHOST_MODULE_CACHE_DIR': '/ghost/.cache/app/prod/webfront/mod1'})
+    lxd_container_mock.execute.assert_any_call(['chown', '-R', '1001:1002', '/ghost/.cache/app/prod/webfront/mod1'])
@@ -0,0 +1,89 @@
+import copy
+
+from mock import mock, MagicMock
+from pymongo.errors import DuplicateKeyError
+
+from libs.deploy import update_app_manifest_modules, rollback_app_manifest
+from libs.manifest import update_manifest
+from tests.helpers import get_test_application, mocked_logger, LOG_FILE
+
+KEY_PATH = '/ghost/test-app/prod/webfront/blue/MANIFEST'
+
+
+class FakeManifestsCollection(object):
+    """ In-memory `app_manifests` collection, `on_update` simulates concurrent jobs """
+
+    def __init__(self):
+        self.documents = {}
+        self.on_update = None
+
+    def find_one(self, query, projection=None):
+        return copy.deepcopy(self.documents.get(query['_id']))
+
+    def insert_one(self, document):
+        if document['_id'] in self.documents:
+            raise DuplicateKeyError('duplicate key')
+        self.documents[document['_id']] = copy.deepcopy(document)
+
+    def update_one(self, query, update):
+        if self.on_update:
+            on_update, self.on_update = self.on_update, None
+            on_update()
+        document = self.documents.get(query['_id'])
+        matched = document is not None and document['version'] == query['version']
+        if matched:
+            document.update(update['$set'])
+            document['version'] += update['$inc']['version']
+        return MagicMock(matched_count=1 if matched else 0)
+
+
+def _get_published_manifest(bucket):
+    return bucket.new_key.return_value.set_contents_from_string.call_args[0][0]
+
+
+@mock.patch('libs.manifest.log', new=mocked_logger)
+@mock.patch('libs.manifest.get_db_connection')
+def test_update_manifest_retries_concurrent_updates(get_db_connection):
+    collection = FakeManifestsCollection()
+    get_db_connection.return_value = {'app_manifests': collection}
+    bucket = MagicMock()
+    bucket.get_key.return_value.get_contents_as_string.return_value = 'mod1:mod1_1.tar.gz:/var/www\n'
+
+    def concurrent_update():
+        collection.documents[KEY_PATH]['modules'].append({'name': 'mod2', 'package': 'mod2_2.tar.gz',
+                                                          'path': '/var/lib/mod2'})
+        collection.documents[KEY_PATH]['version'] += 1
+    collection.on_update = concurrent_update
+
+    def update(modules):
+        return [dict(mod, package='mod1_3.tar.gz') if mod['name'] == 'mod1' else mod for mod in modules]
+
+    previous_modules, modules = update_manifest(bucket, KEY_PATH, update, LOG_FILE)
+
+    assert [mod['package'] for mod in previous_modules] == ['mod1_1.tar.gz', 'mod2_2.tar.gz']
+    assert collection.documents[KEY_PATH]['version'] == 2
+    assert _get_published_manifest(bucket) == 'mod1:mod1_3.tar.gz:/var/www\nmod2:mod2_2.tar.gz:/var/lib/mod2\n'
+
+
+@mock.patch('libs.deploy.cloud_connections')
+@mock.patch('libs.manifest.log', new=mocked_logger)
+@mock.patch('libs.manifest.get_db_connection')
+def test_rollback_keeps_modules_updated_by_other_jobs(get_db_connection, cloud_connections):
+    collection = FakeManifestsCollection()
+    get_db_connection.return_value = {'app_manifests': collection}
+    bucket = cloud_connections.get.return_value.return_value.get_connection.return_value.get_bucket.return_value
+    bucket.get_key.return_value = None
+    mod1, mod2 = {'name': 'mod1', 'path': '/var/www'}, {'name': 'mod2', 'path': '/var/lib/mod2'}
+    app = get_test_application(modules=[mod1, mod2])
+    collection.insert_one({'_id': KEY_PATH, 'version': 1, 'modules': [
+        {'name': mod1['name'], 'package': 'mod1_1.tar.gz', 'path': mod1['path']},
+        {'name': mod2['name'], 'package': 'mod2_1.tar.gz', 'path': mod2['path']}]})
+
+    with mock.patch('libs.deploy.get_path_from_app_with_color', return_value=KEY_PATH[:-len('/MANIFEST')]):
+        old_manifest = update_app_manifest_modules(app, {'bucket_s3': 'my-bucket'},
+                                                   [(mod1, 'mod1_2.tar.gz'), (mod2, 'mod2_2.tar.gz')], LOG_FILE)
+        # Another job deployed mod2 meanwhile
+        collection.documents[KEY_PATH]['modules'][1]['package'] = 'mod2_3.tar.gz'
+        rollback_app_manifest(app, {'bucket_s3': 'my-bucket'}, old_manifest, LOG_FILE)
+
+    assert [mod['package'] for mod in collection.documents[KEY_PATH]['modules']] == ['mod1_1.tar.gz', 'mod2_3.tar.gz']
@@ -0,0 +1,30 @@
+from mock import MagicMock
+
+from libs.package_catalog import purge_packages, S3_DELETE_BATCH_SIZE
+
+
+def test_purge_packages_deletes_by_batches():
+    db = MagicMock()
+    packages = db['packages']
+    packages.find.return_value.sort.return_value.skip.return_value = [
+        {'key': 'ghost/app/prod/webfront/mod1/{0}_mod1_abcdef1'.format(ts), 'package': '{0}_mod1_abcdef1'.format(ts)}
+        for ts in range(S3_DELETE_BATCH_SIZE + 2)]
+    s3_client = MagicMock()
+    failed_key = 'ghost/app/prod/webfront/mod1/1_mod1_abcdef1'
+    s3_client.delete_objects.side_effect = [{'Errors': [{'Key': failed_key, 'Code': 'AccessDenied'}]}, {}, {}]
+
+    deleted_keys = purge_packages(db, s3_client, 'my-bucket', 'ghost/app/prod/webfront/mod1', 42,
+                                  ['9999_mod1_abcdef1'])
+
+    assert packages.find.call_args[0][0] == {'bucket': 'my-bucket', 'prefix': 'ghost/app/prod/webfront/mod1',
+                                             'package': {'$nin': ['9999_mod1_abcdef1']}}
+    packages.find.return_value.sort.return_value.skip.assert_called_once_with(42)
+    assert [len(c[1]['Delete']['Objects']) for c in s3_client.delete_objects.call_args_list] == [
+        S3_DELETE_BATCH_SIZE, S3_DELETE_BATCH_SIZE, 4]
+    # Packages reused from the build cache have their metadata beside them
+    assert s3_client.delete_objects.call_args_list[0][1]['Delete']['Objects'][:2] == [
+        {'Key': 'ghost/app/prod/webfront/mod1/0_mod1_abcdef1'},
+        {'Key': 'ghost/app/prod/webfront/mod1/0_mod1_abcdef1.ghost-metadata'}]
+    assert len(deleted_keys) == S3_DELETE_BATCH_SIZE + 1
+    assert failed_key not in deleted_keys
+    assert packages.delete_many.call_args[0][0]['key'] == {'$in': deleted_keys}
@@ -0,0 +1,26 @@
+from bson.objectid import ObjectId
+from mock import mock, MagicMock
+
+import run
+
+
+@mock.patch('run.get_deployments_db')
+def test_post_fetched_apps_resolves_last_deployments_with_index_lookups(get_deployments_db):
+    app1_id, app2_id = ObjectId(), ObjectId()
+    deployment1_id, deployment2_id = ObjectId(), ObjectId()
+    deployments = {(app1_id, 'mod1'): [{'_id': deployment1_id}], (app2_id, 'mod1'): [{'_id': deployment2_id}]}
+    get_deployments_db.return_value.find.side_effect = lambda query, **kwargs: iter(
+        deployments.get((query['app_id'], query['module']), []))
+    response = {'_items': [
+        {'_id': app1_id, 'modules': [{'name': 'mod1'}, {'name': 'mod2'}]},
+        {'_id': app2_id, 'modules': [{'name': 'mod1'}]},
+    ]}
+
+    with run.ghost.test_request_context('/apps'):
+        run.post_fetched_apps(response)
+
+    assert get_deployments_db.return_value.find.call_count == 3
+    get_deployments_db.return_value.find.assert_any_call({'app_id': app1_id, 'module': 'mod2'}, projection=['_id'],
+                                                         sort=run.DEPLOYMENTS_LAST_DEPLOYMENT_INDEX, limit=1)
+    assert response['_items'][0]['modules'] == [{'name': 'mod1', 'last_deployment': deployment1_id}, {'name': 'mod2'}]
+    assert response['_items'][1]['modules'] == [{'name': 'mod1', 'last_deployment': deployment2_id}]
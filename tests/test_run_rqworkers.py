@@ -0,0 +1,76 @@
+from mock import mock, MagicMock
+
+from ghost_tools import config
+from run_rqworkers import manage_rq_workers, reconcile_app_rq_workers, refresh_rq_workers
+from run_rqworkers import APPS_RQ_WORKER_PROJECTION, RQ_WORKERS_FAILURE_BACKOFF
+
+
+@mock.patch.dict(config, {'rq_worker_strategy': 'one_worker_per_app'})
+@mock.patch('run_rqworkers.delete_rq_queue_and_worker')
+@mock.patch('run_rqworkers.create_rq_queue_and_worker')
+def test_reconcile_app_rq_workers(create_rq_queue_and_worker, delete_rq_queue_and_worker):
+    apps_db = MagicMock()
+    apps_db.find.return_value = [{'env': 'prod', 'name': 'App1', 'role': 'webfront', 'blue_green': {'color': 'green'}}]
+    ghost_rq_queues, connection = {}, MagicMock()
+    ghost_rq_workers = {'prod-blue:App1:webfront': MagicMock(), 'prod:App2:webfront': MagicMock()}
+
+    reconcile_app_rq_workers({'env': 'prod', 'name': 'App1', 'role': 'webfront'}, apps_db,
+                             ghost_rq_queues, ghost_rq_workers, connection)
+
+    apps_db.find.assert_called_once_with({'env': 'prod', 'name': 'App1', 'role': 'webfront'}, APPS_RQ_WORKER_PROJECTION)
+    create_rq_queue_and_worker.assert_called_once_with('prod-green:App1:webfront', ghost_rq_queues,
+                                                       ghost_rq_workers, connection)
+    delete_rq_queue_and_worker.assert_called_once_with('prod-blue:App1:webfront', ghost_rq_queues, ghost_rq_workers)
+
+
+@mock.patch.dict(config, {'rq_worker_strategy': 'one_worker_per_app'})
+@mock.patch('run_rqworkers.inc_counter')
+@mock.patch('run_rqworkers.Worker')
+@mock.patch('run_rqworkers.create_rq_queue_and_worker')
+def test_refresh_rq_workers_restarts_dead_workers(create_rq_queue_and_worker, worker_class, inc_counter):
+    apps_db = MagicMock()
+    apps_db.find.return_value = [{'env': 'prod', 'name': 'App1', 'role': 'webfront'}]
+    ghost_rq_queues, connection = {}, MagicMock()
+    dead_rqworker = MagicMock()
+    dead_rqworker.is_alive.return_value = False
+    ghost_rq_workers = {'prod:App1:webfront': dead_rqworker}
+    worker_class.redis_worker_namespace_prefix = 'rq:worker:'
+    worker_class.all.return_value = []
+
+    def create_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection, **kwargs):
+        ghost_rq_workers[rqworker_name] = MagicMock()
+    create_rq_queue_and_worker.side_effect = create_worker
+
+    refresh_rq_workers(apps_db, ghost_rq_queues, ghost_rq_workers, connection)
+
+    # The registration of the killed worker is released for its new process
+    worker_class.find_by_key.assert_called_once_with('rq:worker:prod:App1:webfront', connection=connection)
+    worker_class.find_by_key.return_value.register_death.assert_called_once_with()
+    create_rq_queue_and_worker.assert_called_once_with('prod:App1:webfront', ghost_rq_queues, ghost_rq_workers,
+                                                       connection, queue_name=None, worker_class=mock.ANY)
+    assert ghost_rq_workers['prod:App1:webfront'] is not dead_rqworker
+
+
+class _Stop(Exception):
+    pass
+
+
+@mock.patch.dict(config, {'rq_worker_strategy': 'one_worker_per_app', 'rq_worker_warm_runner': False})
+@mock.patch('run_rqworkers.signal')
+@mock.patch('run_rqworkers.active_children')
+@mock.patch('run_rqworkers.sleep', side_effect=_Stop)
+@mock.patch('run_rqworkers.refresh_rq_workers', side_effect=Exception('an active worker does not match'))
+@mock.patch('run_rqworkers.manage_background_processes')
+@mock.patch('run_rqworkers.get_db_connection')
+@mock.patch('run_rqworkers.get_redis_connection')
+def test_manage_rq_workers_backs_off_after_a_failure(get_redis_connection, get_db_connection,
+                                                     manage_background_processes, refresh_rq_workers, sleep,
+                                                     active_children, signal):
+    try:
+        manage_rq_workers()
+        assert False, 'The RQ workers manager did not pause'
+    except _Stop:
+        pass
+
+    sleep.assert_called_once_with(RQ_WORKERS_FAILURE_BACKOFF)
+    assert RQ_WORKERS_FAILURE_BACKOFF >= 60
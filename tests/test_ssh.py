@@ -0,0 +1,54 @@
+from mock import mock, MagicMock
+
+from libs.ssh import SSHExecutor
+from tests.helpers import mocked_logger, LOG_FILE
+
+
+def _get_channel(outputs, exit_code):
+    channel = MagicMock()
+    channel.recv.side_effect = outputs + ['']
+    channel.recv_exit_status.return_value = exit_code
+    return channel
+
+
+@mock.patch('libs.ssh.paramiko')
+def test_ssh_executor_reuses_connections(paramiko):
+    paramiko.SSHClient.return_value.get_transport.return_value.is_active.return_value = True
+    paramiko.SSHClient.return_value.get_transport.return_value.open_session.side_effect = \
+        lambda: _get_channel(['ok\r\n'], 0)
+    executor = SSHExecutor()
+
+    with mock.patch('libs.ssh.log', new=mocked_logger):
+        assert executor.run('10.0.0.1', 'admin', '/key.pem', 'ls', LOG_FILE) == 0
+        assert executor.run('10.0.0.1', 'admin', '/key.pem', 'ls', LOG_FILE) == 0
+
+    assert paramiko.SSHClient.return_value.connect.call_count == 1
+    executor.close()
+    paramiko.SSHClient.return_value.close.assert_called_once_with()
+
+
+@mock.patch('libs.ssh.paramiko')
+def test_ssh_executor_streams_output_per_host(paramiko):
+    paramiko.SSHClient.return_value.get_transport.return_value.is_active.return_value = True
+    paramiko.SSHClient.return_value.get_transport.return_value.open_session.return_value = \
+        _get_channel(['line 1\r\nline', ' 2\r\nlast'], 3)
+    logs = []
+
+    with mock.patch('libs.ssh.log', new=lambda message, log_file: logs.append(message)):
+        assert SSHExecutor().run('10.0.0.1', 'admin', '/key.pem', 'ls', LOG_FILE) == 3
+
+    assert logs == ['[10.0.0.1] sudo: ls', '[10.0.0.1] out: line 1', '[10.0.0.1] out: line 2',
+                    '[10.0.0.1] out: last']
+
+
+@mock.patch('libs.ssh.log', new=mocked_logger)
+def test_ssh_executor_execute_on_all_hosts():
+    def task(executor, host, expected_arg):
+        assert expected_arg == 'arg'
+        if host == '10.0.0.3':
+            raise Exception('Unreachable host')
+        return 1 if host == '10.0.0.2' else 0
+
+    result = SSHExecutor(concurrency=2).execute(task, ['10.0.0.1', '10.0.0.2', '10.0.0.3'], LOG_FILE, ('arg',))
+
+    assert result == {'10.0.0.1': 0, '10.0.0.2': 1, '10.0.0.3': None}
@@ -0,0 +1,47 @@
+import threading
+
+import boto3
+from mock import mock, MagicMock
+
+from libs.tracing import start_tracing, span, get_trace, trace_boto3_client
+
+
+def test_span_tree_across_threads_and_errors():
+    tracer = start_tracing()
+    job_span = tracer.start_span('job')
+    tracer.root_span_id = job_span['id']
+
+    def build():
+        with span('build_module', module='mod1'):
+            pass
+    thread = threading.Thread(target=build)
+    thread.start()
+    thread.join()
+    try:
+        with span('gcall', description='Buildpack: Execute'):
+            raise ValueError('exit code 1')
+    except ValueError:
+        pass
+    tracer.end_span(job_span)
+
+    spans = {s['name']: s for s in get_trace()}
+    assert spans['build_module']['parent_id'] == job_span['id']
+    assert spans['build_module']['thread'] != spans['job']['thread']
+    assert spans['gcall']['parent_id'] == job_span['id']
+    assert spans['gcall']['error'] == 'ValueError: exit code 1'
+    assert 'error' not in spans['job']
+
+
+def test_trace_boto3_client():
+    start_tracing()
+    client = trace_boto3_client(boto3.client('s3', region_name='eu-west-1', aws_access_key_id='key',
+                                             aws_secret_access_key='secret'))
+    with mock.patch.object(client._endpoint, 'make_request',
+                           return_value=(MagicMock(status_code=200), {'Buckets': []})):
+        with span('purge'):
+            client.list_buckets()
+
+    spans = get_trace()
+    assert [(s['name'], s['attributes'].get('operation')) for s in spans] == [('purge', None), ('aws', 'ListBuckets')]
+    assert spans[1]['parent_id'] == spans[0]['id']
+    assert spans[1]['attributes']['status'] == 200
@@ -0,0 +1,87 @@
+import os
+import tempfile
+
+from mock import mock, MagicMock
+from sh import git
+
+from libs.workspace import update_workspace, evict_workspaces, record_workspace_size
+
+
+def _commit(repo_path, filename):
+    with open(os.path.join(repo_path, filename), 'w') as f:
+        f.write(filename)
+    git('add', filename, _cwd=repo_path)
+    git('-c', 'user.name=ghost', '-c', 'user.email=ghost@localhost', 'commit', '-q', '-m', filename, _cwd=repo_path)
+
+
+def test_update_workspace_in_place():
+    repo_path = tempfile.mkdtemp()
+    git('init', '-q', '-b', 'master', repo_path)
+    _commit(repo_path, 'file1')
+    mirror_path = os.path.join(tempfile.mkdtemp(), 'mirror.git')
+    git('clone', '-q', '--mirror', repo_path, mirror_path)
+    workspace_path = os.path.join(tempfile.mkdtemp(), 'App1', 'prod', 'webfront', 'mod1')
+    log_file = MagicMock()
+
+    update_workspace(mirror_path, workspace_path, 'master', False, log_file)
+    assert os.path.exists(os.path.join(workspace_path, 'file1'))
+    with open(os.path.join(workspace_path, 'build.out'), 'w') as f:
+        f.write('build artifact')
+
+    _commit(repo_path, 'file2')
+    git('fetch', '-q', _cwd=mirror_path)
+    with mock.patch('libs.workspace.gcall', wraps=__import__('ghost_tools').gcall) as gcall:
+        update_workspace(mirror_path, workspace_path, 'master', False, log_file)
+    assert not any('clone' in c[0][0] for c in gcall.call_args_list)
+    assert sorted(os.listdir(workspace_path)) == ['.git', 'file1', 'file2']
+    assert git('rev-parse', '--abbrev-ref', 'HEAD', _cwd=workspace_path, _tty_out=False).strip() == 'master'
+
+    first_commit = git('rev-parse', 'HEAD~1', _cwd=repo_path, _tty_out=False).strip()
+    update_workspace(mirror_path, workspace_path, first_commit, True, log_file)
+    assert sorted(os.listdir(workspace_path)) == ['.git', 'file1']
+
+
+@mock.patch('libs.workspace._get_size', new=lambda path: 1024)
+def test_evict_workspaces_least_recently_used():
+    workspaces_root = tempfile.mkdtemp()
+    for index, path in enumerate(['App1/prod/webfront/mod1', 'App2/prod/webfront/mod1', 'App3/prod/webfront/mod1']):
+        os.makedirs(os.path.join(workspaces_root, path, '.git'))
+        open(os.path.join(workspaces_root, path, '.git', 'ghost-last-use'), 'w').close()
+        os.utime(os.path.join(workspaces_root, path, '.git', 'ghost-last-use'), (index, index))
+
+    evict_workspaces(2048, 3600, MagicMock(), workspaces_root)
+
+    assert [os.listdir(os.path.join(workspaces_root, app, 'prod', 'webfront')) for app in ['App1', 'App2', 'App3']] == \
+        [[], ['mod1'], ['mod1']]
+
+
+def test_evict_workspaces_uses_recorded_sizes():
+    workspaces_root = tempfile.mkdtemp()
+    for index, path in enumerate(['App1/prod/webfront/mod1', 'App2/prod/webfront/mod1']):
+        os.makedirs(os.path.join(workspaces_root, path, '.git'))
+        with open(os.path.join(workspaces_root, path, '.git', 'ghost-last-use'), 'w') as f:
+            f.write('2048')
+        os.utime(os.path.join(workspaces_root, path, '.git', 'ghost-last-use'), (index, index))
+
+    with mock.patch('libs.workspace.du') as du:
+        evict_workspaces(2048, 3600, MagicMock(), workspaces_root)
+    du.assert_not_called()
+
+    assert [os.listdir(os.path.join(workspaces_root, app, 'prod', 'webfront')) for app in ['App1', 'App2']] == \
+        [[], ['mod1']]
+
+
+def test_record_workspace_size_keeps_last_use():
+    workspace_path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(workspace_path, '.git'))
+    with open(os.path.join(workspace_path, 'build.out'), 'w') as f:
+        f.write('x' * 8192)
+    marker = os.path.join(workspace_path, '.git', 'ghost-last-use')
+    open(marker, 'w').close()
+    os.utime(marker, (1000, 1000))
+
+    record_workspace_size(workspace_path)
+
+    assert os.path.getmtime(marker) == 1000
+    with open(marker) as f:
+        assert int(f.read()) >= 8192